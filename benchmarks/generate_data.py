@@ -0,0 +1,299 @@
+import argparse
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from py_scripts.execute_sql_scripts import CREATE_TABLE, split_statements
+
+# Города, в которых расположены терминалы синтетических данных
+CITIES = [
+    "Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань", "Нижний Новгород", "Челябинск",
+    "Самара", "Омск", "Ростов-на-Дону", "Уфа", "Красноярск", "Воронеж", "Пермь", "Волгоград", "Кемерово",
+    "Стерлитамак", "Баймак", "Тюмень", "Иркутск"
+]
+STREETS = ["Ленина ул.", "Мира пр.", "Садовая ул.", "Электрозаводская ул.", "Лесная ул.", "Школьная ул."]
+LAST_NAMES = ["Иванов", "Петров", "Сидоров", "Смирнов", "Кузнецов", "Попов", "Васильев", "Соколов"]
+FIRST_NAMES = ["Иван", "Петр", "Сергей", "Алексей", "Дмитрий", "Андрей", "Михаил", "Николай"]
+PATRONYMICS = ["Иванович", "Петрович", "Сергеевич", "Алексеевич", "Дмитриевич", "Андреевич"]
+
+def format_card(numbers):
+    """
+    Функция, форматирующая 16-значные номера карт numbers в вид "XXXX XXXX XXXX XXXX", принятый в файлах транзакций
+    """
+    digits = pd.Series(numbers).map("{:016d}".format)
+    return (digits.str[0:4] + " " + digits.str[4:8] + " " + digits.str[8:12] + " " + digits.str[12:16]).to_numpy()
+
+def format_passport(numbers):
+    """
+    Функция, форматирующая 10-значные номера паспортов numbers в вид "XXXX XXXXXX"
+    """
+    digits = pd.Series(numbers).map("{:010d}".format)
+    return (digits.str[0:4] + " " + digits.str[4:10]).to_numpy()
+
+def sql_value(value):
+    """
+    Функция, записывающая значение value в виде литерала sql
+    """
+    if value is None:
+        return "null"
+    return "'" + str(value).replace("'", "''") + "'"
+
+def unique_numbers(rng, base, count):
+    """
+    Функция, генерирующая count различных случайных чисел, начинающихся с base, в случайном порядке
+    """
+    return rng.permutation(base + np.arange(count, dtype=np.int64) * 7 + rng.integers(0, 7, count))
+
+def generate_reference(rng, cards, start_date, expired_share):
+    """
+    Функция, генерирующая справочники карт, счетов и клиентов на cards карт (одна карта на счет, один счет
+    на клиента). Доля expired_share счетов имеет истекший до начала загрузки срок действия договора
+    """
+    card_numbers = format_card(unique_numbers(rng, 4000000000000000, cards))
+    accounts = np.array([f"40817810{i:012d}" for i in range(cards)])
+    client_ids = np.array([str(100000 + i) for i in range(cards)])
+    passports = format_passport(unique_numbers(rng, 1000000000, cards))
+
+    expired = rng.random(cards) < expired_share
+    valid_to = np.where(
+        expired,
+        (start_date - timedelta(days=30)).strftime("%Y-%m-%d"),
+        (start_date + timedelta(days=3650)).strftime("%Y-%m-%d")
+    )
+
+    reference = {
+        "cards": pd.DataFrame({
+            "card_num": card_numbers, "account": accounts, "create_dt": "2001-01-01", "update_dt": None
+        }),
+        "accounts": pd.DataFrame({
+            "account": accounts, "valid_to": valid_to, "client": client_ids,
+            "create_dt": "1900-01-01", "update_dt": None
+        }),
+        "clients": pd.DataFrame({
+            "client_id": client_ids,
+            "last_name": rng.choice(LAST_NAMES, cards),
+            "first_name": rng.choice(FIRST_NAMES, cards),
+            "patronymic": rng.choice(PATRONYMICS, cards),
+            "date_of_birth": "1980-01-01",
+            "passport_num": passports,
+            "passport_valid_to": None,
+            "phone": [f"+7 9{i % 100:02d} {i % 1000:03d}-{i % 100:02d}-{i % 97:02d}" for i in range(cards)],
+            "created_dt": "1900-01-01",
+            "update_dt": None
+        })
+    }
+    return reference, int(expired.sum())
+
+def write_reference(reference, filepath, template="sql_scripts/ddl_dml.sql"):
+    """
+    Функция, записывающая справочники reference в sql скрипт filepath в том же формате, что и sql_scripts/ddl_dml.sql:
+    команды создания таблиц берутся из шаблона template, строки записываются командами insert
+    """
+    with open(template, "r", encoding="utf-8") as f:
+        ddl = [statement for statement in split_statements(f.read()) if CREATE_TABLE.match(statement)]
+
+    with open(filepath, "w", encoding="utf-8") as f:
+        for statement in ddl:
+            f.write(statement + ";\n\n")
+        for table, df in reference.items():
+            columns = ", ".join(df.columns)
+            for row in df.itertuples(index=False):
+                f.write(f"insert into {table} ({columns}) values ({', '.join(sql_value(value) for value in row)});\n")
+
+def generate_terminals(rng, count, first_id=1000):
+    """
+    Функция, генерирующая count терминалов с идентификаторами, начинающимися с first_id
+    """
+    ids = np.arange(first_id, first_id + count)
+    types = rng.choice(["ATM", "POS"], count)
+    cities = rng.choice(CITIES, count)
+    addresses = [
+        f"г. {city}, {street}, д. {house}"
+        for city, street, house in zip(cities, rng.choice(STREETS, count), rng.integers(1, 100, count))
+    ]
+    return pd.DataFrame({
+        "terminal_id": [f"{terminal_type[0]}{terminal_id}" for terminal_type, terminal_id in zip(types, ids)],
+        "terminal_type": types,
+        "terminal_city": cities,
+        "terminal_address": addresses
+    })
+
+def churn_terminals(rng, terminals, churn, next_id):
+    """
+    Функция, формирующая срез терминалов следующего дня: доля churn терминалов меняет город и адрес, столько же
+    терминалов удаляется и добавляется. Возвращает новый срез и следующий свободный идентификатор
+    """
+    count = int(len(terminals) * churn)
+    terminals = terminals.copy()
+
+    moved = rng.choice(len(terminals), count, replace=False)
+    moved_cities = rng.choice(CITIES, count)
+    terminals.loc[terminals.index[moved], "terminal_city"] = moved_cities
+    terminals.loc[terminals.index[moved], "terminal_address"] = [f"г. {city}, Новая ул., д. 1" for city in moved_cities]
+
+    terminals = terminals.drop(terminals.index[rng.choice(len(terminals), count, replace=False)])
+    terminals = pd.concat([terminals, generate_terminals(rng, count, next_id)], ignore_index=True)
+    return terminals, next_id + count
+
+def pick_terminals(rng, terminals, home_cities):
+    """
+    Функция, выбирающая для каждой операции терминал в домашнем городе карты home_cities (индекс в списке городов,
+    в которых есть терминалы). Возвращает индексы строк среза terminals
+    """
+    order = np.argsort(terminals["terminal_city"].to_numpy(), kind="stable")
+    cities, starts, counts = np.unique(terminals["terminal_city"].to_numpy()[order], return_index=True,
+                                       return_counts=True)
+    city = home_cities % len(cities)
+    return order[starts[city] + (rng.random(len(home_cities)) * counts[city]).astype(np.int64)]
+
+def generate_transactions(rng, business_date, count, card_numbers, terminals, first_id, fraud_share):
+    """
+    Функция, генерирующая count операций дня business_date по картам card_numbers через терминалы среза terminals
+    с идентификаторами, начинающимися с first_id. Доля fraud_share операций приходится на специально добавленные
+    мошеннические шаблоны: операции в разных городах в течение часа и подбор суммы. Возвращает датафрейм операций
+    и количество добавленных шаблонов каждого вида
+    """
+    planted = max(int(count * fraud_share) // 5, 1)
+    background = count - planted * 5
+
+    # Фоновые операции: каждая карта пользуется терминалами своего домашнего города
+    cards = rng.integers(0, len(card_numbers), background)
+    terminal_rows = pick_terminals(rng, terminals, cards)
+    seconds = rng.integers(0, 86400, background)
+    df = pd.DataFrame({
+        "card": cards,
+        "seconds": seconds,
+        "amount": np.round(rng.gamma(2.0, 2500.0, background), 2),
+        "oper_type": rng.choice(["PAYMENT", "WITHDRAW", "DEPOSIT"], background, p=[0.45, 0.3, 0.25]),
+        "oper_result": np.where(rng.random(background) < 0.1, "REJECT", "SUCCESS"),
+        "terminal": terminals["terminal_id"].to_numpy()[terminal_rows]
+    })
+
+    # Операции в разных городах в течение часа: две операции по карте в терминалах разных городов
+    cities = terminals["terminal_city"].to_numpy()
+    first = rng.integers(0, len(terminals), planted)
+    second = rng.integers(0, len(terminals), planted)
+    same_city = cities[first] == cities[second]
+    while same_city.any():
+        second[same_city] = rng.integers(0, len(terminals), same_city.sum())
+        same_city = cities[first] == cities[second]
+    cards = rng.integers(0, len(card_numbers), planted)
+    start = rng.integers(0, 86400 - 3600, planted)
+    multi_city = pd.DataFrame({
+        "card": np.repeat(cards, 2),
+        "seconds": np.column_stack([start, start + rng.integers(60, 3000, planted)]).ravel(),
+        "amount": np.round(rng.gamma(2.0, 2500.0, planted * 2), 2),
+        "oper_type": "PAYMENT",
+        "oper_result": "SUCCESS",
+        "terminal": terminals["terminal_id"].to_numpy()[np.column_stack([first, second]).ravel()]
+    })
+
+    # Подбор суммы: три операции по карте за 20 минут с убывающими суммами, отклонены все кроме последней
+    cards = rng.integers(0, len(card_numbers), planted)
+    start = rng.integers(0, 86400 - 1200, planted)
+    amount = rng.uniform(5000, 50000, planted)
+    terminal_rows = np.repeat(pick_terminals(rng, terminals, cards), 3)
+    guessing = pd.DataFrame({
+        "card": np.repeat(cards, 3),
+        "seconds": (start[:, None] + np.array([0, 300, 600])).ravel(),
+        "amount": np.round((amount[:, None] * np.array([1.0, 0.8, 0.6])).ravel(), 2),
+        "oper_type": "PAYMENT",
+        "oper_result": np.tile(["REJECT", "REJECT", "SUCCESS"], planted),
+        "terminal": terminals["terminal_id"].to_numpy()[terminal_rows]
+    })
+
+    df = pd.concat([df, multi_city, guessing], ignore_index=True).sort_values("seconds", kind="stable")
+    day_start = pd.Timestamp(business_date)
+    return pd.DataFrame({
+        "transaction_id": np.arange(first_id, first_id + len(df)),
+        "transaction_date": (day_start + pd.to_timedelta(df["seconds"].to_numpy(), unit="s")).strftime("%Y-%m-%d %H:%M:%S"),
+        "amount": df["amount"].to_numpy(),
+        "card_num": card_numbers[df["card"].to_numpy()],
+        "oper_type": df["oper_type"].to_numpy(),
+        "oper_result": df["oper_result"].to_numpy(),
+        "terminal": df["terminal"].to_numpy()
+    }), {"multi_city": planted, "amount_guessing": planted}
+
+def generate(out_dir, days=3, transactions=100000, cards=10000, terminals=1500, start_date="2021-03-01",
+             terminal_churn=0.02, blacklist_per_day=10, expired_share=0.01, fraud_share=0.001, seed=42):
+    """
+    Функция, записывающая в каталог out_dir синтетический набор данных: sql скрипт справочников ddl_dml.sql
+    и файлы ежедневной загрузки за days дней по transactions операций в день в формате файлов каталога data.
+    Возвращает описание набора с количеством специально добавленных мошеннических шаблонов
+    """
+    rng = np.random.default_rng(seed)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+
+    reference, expired = generate_reference(rng, cards, start_date, expired_share)
+    write_reference(reference, out_dir / "ddl_dml.sql")
+    card_numbers = reference["cards"]["card_num"].to_numpy()
+    passports = reference["clients"]["passport_num"].to_numpy()
+
+    summary = {"days": [], "cards": cards, "expired_accounts": expired, "seed": seed}
+    snapshot = generate_terminals(rng, terminals)
+    next_terminal_id = 1000 + terminals
+    blacklist = pd.DataFrame(columns=["date", "passport"])
+    next_transaction_id = 40000000000
+
+    for i in range(days):
+        business_date = start_date + timedelta(days=i)
+        suffix = business_date.strftime("%d%m%Y")
+        if i > 0:
+            snapshot, next_terminal_id = churn_terminals(rng, snapshot, terminal_churn, next_terminal_id)
+        snapshot.to_excel(out_dir / f"terminals_{suffix}.xlsx", sheet_name="terminals", index=False)
+
+        # "Черный" список паспортов пополняется паспортами клиентов банка, операции которых становятся подозрительными
+        blacklist = pd.concat([blacklist, pd.DataFrame({
+            "date": pd.Timestamp(business_date),
+            "passport": rng.choice(passports, blacklist_per_day, replace=False)
+        })], ignore_index=True).drop_duplicates("passport")
+        blacklist.to_excel(out_dir / f"passport_blacklist_{suffix}.xlsx", sheet_name="blacklist", index=False)
+
+        df, planted = generate_transactions(rng, business_date, transactions, card_numbers, snapshot,
+                                            next_transaction_id, fraud_share)
+        next_transaction_id += len(df)
+        df.to_csv(out_dir / f"transactions_{suffix}.txt", sep=";", decimal=",", float_format="%.2f", index=False)
+
+        summary["days"].append({
+            "business_date": business_date.isoformat(),
+            "transactions": len(df),
+            "terminals": len(snapshot),
+            "blacklist": len(blacklist),
+            **planted
+        })
+
+    with open(out_dir / "summary.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+def main():
+    """
+    Функция, генерирующая синтетический набор данных по параметрам командной строки
+    """
+    parser = argparse.ArgumentParser(description="генератор синтетических файлов ежедневной загрузки")
+    parser.add_argument("out_dir", help="каталог, в который записываются файлы")
+    parser.add_argument("--days", type=int, default=3, help="количество дней")
+    parser.add_argument("--transactions", type=int, default=100000, help="количество операций в день")
+    parser.add_argument("--cards", type=int, default=10000, help="количество карт")
+    parser.add_argument("--terminals", type=int, default=1500, help="количество терминалов")
+    parser.add_argument("--start-date", default="2021-03-01", help="первый день в формате ГГГГ-ММ-ДД")
+    parser.add_argument("--terminal-churn", type=float, default=0.02,
+                        help="доля терминалов, которые ежедневно перемещаются, удаляются и добавляются")
+    parser.add_argument("--blacklist-per-day", type=int, default=10, help="паспортов в день в черный список")
+    parser.add_argument("--expired-share", type=float, default=0.01, help="доля счетов с истекшим договором")
+    parser.add_argument("--fraud-share", type=float, default=0.001,
+                        help="доля операций, приходящихся на мошеннические шаблоны")
+    parser.add_argument("--seed", type=int, default=42, help="начальное значение генератора случайных чисел")
+    args = parser.parse_args()
+
+    summary = generate(args.out_dir, args.days, args.transactions, args.cards, args.terminals, args.start_date,
+                       args.terminal_churn, args.blacklist_per_day, args.expired_share, args.fraud_share, args.seed)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
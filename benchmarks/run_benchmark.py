@@ -0,0 +1,197 @@
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+import psycopg2
+
+from benchmarks.generate_data import generate
+from py_scripts import create_db, execute_sql_scripts, manifest, passports, report, terminals, transactions
+from py_scripts.pipeline_context import PipelineContext
+
+try:
+    import resource
+except ImportError:
+    # Модуль resource доступен только в Unix-системах, на остальных пиковый объем памяти не измеряется
+    resource = None
+
+def reset_peak_rss():
+    """
+    Функция, сбрасывающая пиковый объем резидентной памяти процесса до текущего, чтобы замерить пик отдельного этапа.
+    Сброс поддерживается только в Linux, возвращает False, если он не выполнен
+    """
+    if resource is None:
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """
+    Функция, возвращающая пиковый объем резидентной памяти процесса в мегабайтах с момента последнего сброса
+    функцией reset_peak_rss (в Linux значение ru_maxrss сбрасывается вместе с ним)
+    """
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def measure(results, stage, business_date, func, *args):
+    """
+    Функция, выполняющая этап stage (вызов func с аргументами args) и добавляющая в results время выполнения,
+    количество обработанных строк, скорость обработки и пиковый объем памяти этапа. Пик памяти замеряется только
+    в Linux, где его можно сбросить перед этапом: накопленный с начала работы процесса пик не уменьшается после
+    первого этапа с большим потреблением памяти и ничего не говорит об остальных этапах. Возвращает результат func
+    """
+    measured = reset_peak_rss()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+
+    rows = len(result) if isinstance(result, pd.DataFrame) else result
+    results.append({
+        "business_date": business_date,
+        "stage": stage,
+        "seconds": round(seconds, 3),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds) if rows and seconds else None,
+        "peak_rss_mb": peak_rss_mb() if measured else None
+    })
+    return result
+
+def reset_database(credentials):
+    """
+    Функция, удаляющая базу данных, указанную в credentials, чтобы каждый замер начинался с пустого DWH
+    """
+    connection = psycopg2.connect(
+        host=credentials["host"],
+        user=credentials["user"],
+        password=credentials["password"],
+        port=credentials["port"],
+        database="postgres"
+    )
+    try:
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP DATABASE IF EXISTS {credentials['dbname']}")
+    finally:
+        connection.close()
+
+def fraud_counts(context):
+    """
+    Функция, возвращающая количество строк отчета о мошеннических операциях по типам операций
+    """
+    with context.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT event_type, COUNT(*) FROM dwh.rep_fraud GROUP BY event_type ORDER BY event_type")
+            return dict(cursor.fetchall())
+
+def run(credentials, data_dir, partition_by="month", scoring="sql"):
+    """
+    Функция, выполняющая все этапы ежедневной загрузки по файлам каталога data_dir в базу данных, указанную
+    в credentials, и замеряющая каждый этап. Файлы не перемещаются в архив, поэтому набор можно загружать повторно
+    """
+    results = []
+    create_db.create_db(credentials)
+    context = PipelineContext(credentials, partition_by=partition_by, scoring=scoring)
+    try:
+        context.init_schemas()
+        manifest.manifest_table(context)
+        measure(results, "load_reference", None, execute_sql_scripts.execute_sql_scripts,
+                f"{data_dir}/ddl_dml.sql", context)
+
+        transactions.transactions_stg(context)
+        transactions.transactions_fact_table(context)
+        terminals.terminals_hist(context)
+        passports.passports_fact(context)
+        report.create_report_tables(context)
+
+        for business_date, files in manifest.discover_days(data_dir):
+            day = business_date.isoformat()
+            df = measure(results, "read_terminals", day, terminals.read_terminals, files["terminals"])
+            measure(results, "terminals_increment", day, terminals.terminals_increment, context, df, business_date)
+            df = measure(results, "read_passports", day, passports.read_passports, files["passport_blacklist"])
+            measure(results, "passports_increment", day, passports.passports_increment, context, df, business_date)
+            measure(results, "stage_transactions", day, transactions.stage_transactions, context, files["transactions"])
+            measure(results, "transactions_fact", day, transactions.transactions_fact, context)
+            measure(results, "create_report", day, report.report_engine(scoring), context)
+
+        return results, fraud_counts(context)
+    finally:
+        context.close()
+
+def print_results(results):
+    """
+    Функция, выводящая результаты замеров в виде таблицы с итогами по этапам
+    """
+    df = pd.DataFrame(results)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(df.to_string(index=False))
+        totals = df.groupby("stage", sort=False).agg(seconds=("seconds", "sum"), rows=("rows", "sum"))
+        totals["rows_per_sec"] = (totals["rows"] / totals["seconds"]).round()
+        print()
+        print(totals.to_string())
+
+def main():
+    """
+    Функция, генерирующая синтетический набор данных (или использующая готовый) и замеряющая загрузку
+    по параметрам командной строки
+    """
+    parser = argparse.ArgumentParser(description="замер производительности ежедневной загрузки")
+    parser.add_argument("--cred", default="cred.json", help="файл с параметрами подключения")
+    parser.add_argument("--dbname", help="база данных для замера (по умолчанию <dbname>_bench)")
+    parser.add_argument("--data-dir", help="готовый набор данных; если не указан, набор генерируется")
+    parser.add_argument("--days", type=int, default=3, help="количество дней")
+    parser.add_argument("--transactions", type=int, default=100000, help="количество операций в день")
+    parser.add_argument("--cards", type=int, default=10000, help="количество карт")
+    parser.add_argument("--terminals", type=int, default=1500, help="количество терминалов")
+    parser.add_argument("--terminal-churn", type=float, default=0.02, help="ежедневная доля изменений терминалов")
+    parser.add_argument("--seed", type=int, default=42, help="начальное значение генератора случайных чисел")
+    parser.add_argument("--partition-by", choices=["day", "month", "none"], default="month",
+                        help="секционирование таблицы фактов транзакций")
+    parser.add_argument("--engine", choices=["sql", "python"], default="sql",
+                        help="движок поиска мошеннических операций")
+    parser.add_argument("--keep-db", action="store_true", help="не удалять базу данных перед замером")
+    parser.add_argument("--keep-cache", action="store_true", help="не очищать кэш разобранных файлов Excel")
+    parser.add_argument("--output", help="файл, в который записываются результаты в формате json")
+    args = parser.parse_args()
+
+    with open(args.cred, "r", encoding="utf-8") as f:
+        credentials = json.loads(f.read())
+    credentials["dbname"] = args.dbname or f"{credentials['dbname']}_bench"
+
+    if not args.keep_db:
+        reset_database(credentials)
+    if not args.keep_cache:
+        shutil.rmtree("cache", ignore_errors=True)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="fraud_bench_")
+    summary = None
+    if args.data_dir is None:
+        start = time.perf_counter()
+        summary = generate(data_dir, args.days, args.transactions, args.cards, args.terminals,
+                           terminal_churn=args.terminal_churn, seed=args.seed)
+        print(f"Набор данных сгенерирован в {data_dir} за {time.perf_counter() - start:.1f} с")
+
+    try:
+        results, fraud = run(credentials, data_dir, None if args.partition_by == "none" else args.partition_by,
+                             args.engine)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print_results(results)
+    print()
+    print("Найдено мошеннических операций:", json.dumps(fraud, ensure_ascii=False, indent=2))
+    if summary is not None:
+        print("Добавлено шаблонов:", json.dumps(summary["days"], ensure_ascii=False, indent=2))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"parameters": vars(args), "stages": results, "fraud": fraud, "generated": summary},
+                      f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,319 @@
+import argparse
 import json
 import os
-import re
-
-from py_scripts import create_db, transactions, terminals, passports, execute_sql_scripts, report
-
-#  Считываем параметры подключения к создаваемой базе данных, хранящиеся в json файле 
-with open("cred.json", "r", encoding="utf-8") as f:
-    credentials = json.loads(f.read())
-
-# Вызываем функцию, создающую базу данных  на PostgreSQL сервере, c именем, указанным в файле с параметрами подключения
-create_db.create_db(credentials)
-
-# Вызываем функцию, выполняющую sql скрипты по созданию и заполнению таблиц c информацией о платежных карточках,
-# счетах и клиентах
-execute_sql_scripts.execute_sql_scripts("sql_scripts/ddl_dml.sql", credentials)
-
-# Выполним проверку существования директории дата, в которой содержаться файлы ежедневной загрузки
-if not os.path.exists("data"):
-    raise FileNotFoundError("Директория data не существует")
-if not os.path.isdir("data"):
-    raise NotADirectoryError("data не является директорией")
-
-files_terminals = []
-files_passport_blacklist = []
-files_transactions = []
-
-for filename in os.listdir("data"):
-    if re.compile(r'^terminals_(\d{2})(\d{2})(\d{4})\.xlsx$').match(filename):
-        filepath = os.path.join("data", filename)
-        files_terminals.append(filepath)
-    elif re.compile(r'^passport_blacklist_(\d{2})(\d{2})(\d{4})\.xlsx$').match(filename):
-        filepath = os.path.join("data", filename)
-        files_passport_blacklist.append(filepath)   
-    elif re.compile(r'^transactions_(\d{2})(\d{2})(\d{4})\.txt$').match(filename):
-        filepath = os.path.join("data", filename)
-        files_transactions.append(filepath)
-    
-files_terminals = sorted(files_terminals)
-files_passport_blacklist = sorted(files_passport_blacklist)
-files_transactions = sorted(files_transactions)
-
-for i in range(len(files_terminals)):
-    # Вызываем функцию, загружающие ежедневные данные о терминалах в стейдж
-    terminals.xlsx2sql_terminals(credentials, files_terminals[i])
-    # Вызываем функцию, создающую таблицу, содержащую информацию о терминалах и хранящую историю их "движения"
-    terminals.terminals_hist(credentials)
-    # Вызываем функцию, наполняющую инкрементально данными "историческую" таблицу о терминалах
-    terminals.terminals_increment(credentials)
-
-    # Вызываем функцию, загружающие ежедневные данные о паспортах, находящихся в "черном" списке в стейдж
-    passports.xlsx2sql_passports(credentials, files_passport_blacklist[i])
-    # Вызываем функцию, создающую таблицу, содержащую информацию о паспортах, находящихся в "черном" списке
-    passports.passports_fact(credentials)
-    # Вызываем функцию, наполняющую инкрементально данными таблицу о паспортах, находящихся в "черном" списке
-    passports.passports_increment(credentials)
-
-    # Вызываем функцию, загружающие ежедневные данные о транзакциях в стейдж
-    transactions.csv2sql_transactions(credentials, files_transactions[i])
-    # Вызываем функцию, создающую таблицу транзакций и наполняющую ее данными ежедневно
-    transactions.transactions_fact(credentials)
-
-    # Вызываем функцию, создающую "витрину" данных о выявленных мошеннических операциях
-    report.create_report(credentials)
\ No newline at end of file
+import sys
+from datetime import date
+
+import psycopg2
+
+from py_scripts.pipeline_context import PipelineContext
+
+# Модули этапов импортируются внутри команд: разбор файлов требует pandas, а построение отчета запросом
+# и просмотр состояния загрузки обходятся без него, поэтому легкие команды запускаются быстро
+
+def read_credentials(filepath="cred.json"):
+    """
+    Функция, считывающая параметры подключения к базе данных, хранящиеся в json файле filepath
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        return json.loads(f.read())
+
+def create_context(args):
+    """
+    Функция, создающая контекст загрузки, который хранит единый пул соединений с базой данных для всех этапов,
+    с настройками из параметров запуска args
+    """
+    return PipelineContext(read_credentials(), partition_by=None if args.partition_by == "none" else args.partition_by,
+                           explain=args.explain, scoring=args.engine)
+
+def init_db(context):
+    """
+    Функция, создающая базу данных, схемы STG и DWH, таблицу-манифест загрузки и все таблицы загрузки и отчета.
+    Возвращает True, если все таблицы созданы
+    """
+    from py_scripts import create_db, manifest, passports, report, terminals, transactions
+
+    # Вызываем функцию, создающую базу данных  на PostgreSQL сервере, c именем, указанным в файле с параметрами подключения.
+    # Без базы данных и схем остальные таблицы создать нельзя
+    if not create_db.create_db(context.credentials) or not context.init_schemas():
+        return False
+
+    results = [
+        # Вызываем функцию, создающую таблицу-манифест загрузки файлов
+        manifest.manifest_table(context),
+        # Удаляем представление прежней версии отчета, которое мешает заменить текстовые поля таблицы фактов кодами
+        report.drop_legacy_view(context),
+        # Вызываем функцию, создающую типизированную стейджинговую таблицу транзакций
+        transactions.transactions_stg(context),
+        # Вызываем функцию, создающую таблицу фактов совершенных транзакций
+        transactions.transactions_fact_table(context),
+        # Вызываем функцию, создающую таблицу, содержащую информацию о терминалах и хранящую историю их "движения"
+        terminals.terminals_hist(context),
+        # Вызываем функцию, создающую таблицу, содержащую информацию о паспортах, находящихся в "черном" списке
+        passports.passports_fact(context),
+        # Вызываем функцию, создающую таблицу-отчет о мошеннических операциях и таблицу водяного знака отчета
+        report.create_report_tables(context)
+    ]
+    return all(result is True for result in results)
+
+def load_reference(context):
+    """
+    Функция, выполняющая sql скрипты по созданию и заполнению таблиц c информацией о платежных карточках,
+    счетах и клиентах (если скрипт не изменился с предыдущего запуска, загрузка пропускается)
+    """
+    from py_scripts import execute_sql_scripts
+
+    with context.metrics.stage("reference.loaded", filepath="sql_scripts/ddl_dml.sql") as record:
+        record["rows"] = execute_sql_scripts.execute_sql_scripts("sql_scripts/ddl_dml.sql", context)
+    return record["rows"]
+
+def discover_days():
+    """
+    Функция, проверяющая существование директории data, в которой содержатся файлы ежедневной загрузки,
+    и группирующая ее файлы по бизнес-дате, указанной в имени файла
+    """
+    from py_scripts import manifest
+
+    if not os.path.exists("data"):
+        raise FileNotFoundError("Директория data не существует")
+    if not os.path.isdir("data"):
+        raise NotADirectoryError("data не является директорией")
+    return manifest.discover_days("data")
+
+def run_all(context, args):
+    """
+    Функция, выполняющая ежедневную загрузку всех файлов из директории data в режиме, заданном параметрами запуска
+    args: последовательно, параллельно, за период, в режиме службы или потоковой оценки. Возвращает False, если
+    не удалось создать таблицы или загрузить справочники
+    """
+    from py_scripts import backfill, pipeline
+
+    if not init_db(context):
+        print("Таблицы загрузки созданы не полностью, загрузка не выполняется")
+        return False
+    if load_reference(context) is None:
+        return False
+    days = discover_days()
+
+    if args.backfill:
+        # Вызываем функцию, загружающую все дни периода за один проход и строящую отчет за период одной командой
+        backfill.run_backfill(context, days, *args.backfill)
+    elif args.stream:
+        from py_scripts import stream_scorer
+
+        # Вызываем функцию, оценивающую транзакции по мере их поступления и записывающую найденные
+        # мошеннические операции в отчет пакетами
+        stream_scorer.stream_transactions(context, args.stream)
+    elif args.watch:
+        from py_scripts import watcher
+
+        # Вызываем функцию, загружающую дни по мере прихода их файлов через уже открытый пул соединений,
+        # пока не получен сигнал SIGTERM или SIGINT
+        watcher.FolderWatcher("data", args.poll_interval, args.settle, args.queue_size).run(context, args.metrics_dir)
+    elif args.parallel:
+        # Вызываем функцию, выполняющую загрузку дней с параллельным разбором файлов и загрузкой их в стейдж
+        pipeline.run_parallel(context, days, args.workers)
+    else:
+        for business_date, files in days:
+            # Вызываем функцию, последовательно выполняющую все этапы загрузки одного дня. Дни обрабатываются строго
+            # по порядку, поэтому на первом необработанном дне загрузка останавливается
+            if not pipeline.process_day(context, business_date, files):
+                break
+
+    if args.cross_check:
+        from py_scripts import fraud_engine
+
+        # Сравниваем строки отчета, которые находят движки sql и python, и выводим расхождения
+        mismatches = fraud_engine.cross_check(context)
+        if mismatches.empty:
+            print("Результаты движков sql и python совпадают")
+        else:
+            print(f"Результаты движков sql и python расходятся в {len(mismatches)} строках:")
+            print(mismatches.to_string(index=False))
+
+def ingest(context, args):
+    """
+    Функция, выполняющая все этапы загрузки дня args.date по файлам из директории data. Таблицы должны быть
+    созданы командой init-db, справочники загружены командой load-reference. Дни загружаются по порядку: если
+    в директории data остались не обработанные полностью файлы более раннего дня, загрузка не выполняется.
+    Транзакции дня оцениваются независимо от водяного знака, поэтому повторная загрузка прошлого дня попадает в отчет
+    """
+    from py_scripts import manifest, pipeline, report
+
+    days = discover_days()
+    files = dict(days).get(args.date)
+    if files is None:
+        print(f"За {args.date:%d.%m.%Y} файлы в директории data не найдены")
+        return False
+
+    # Обработанные файлы перемещаются в архив, поэтому файлы более раннего дня в директории data означают,
+    # что этот день еще не загружен полностью
+    stages = {filename: stage for _, _, filename, stage, _, _ in manifest.load_status(context)}
+    pending = [
+        business_date for business_date, day_files in days
+        if business_date < args.date and not all(
+            manifest.is_done(file_type, stages.get(os.path.basename(filepath)))
+            for file_type, filepath in day_files.items()
+        )
+    ]
+    if pending:
+        print(f"Сначала должны быть загружены более ранние дни: {', '.join(f'{day:%d.%m.%Y}' for day in pending)}")
+        return False
+    return pipeline.process_day(context, args.date, files, report.day_window(args.date))
+
+def build_report(context, args):
+    """
+    Функция, строящая отчет о мошеннических операциях: за день args.date (транзакции дня оцениваются повторно
+    независимо от водяного знака) или, если дата не указана, инкрементально от водяного знака
+    """
+    from py_scripts import report
+
+    since, until = report.day_window(args.date) if args.date else (None, None)
+    with context.metrics.stage("transactions.reported", args.date) as record:
+        record["rows"] = report.report_engine(context.scoring)(context, since, until)
+    if record["rows"] is not None:
+        print(f"Добавлено или обновлено строк отчета: {record['rows']}")
+    return record["rows"] is not None
+
+def status(context, args):
+    """
+    Функция, выводящая достигнутые этапы обработки файлов по данным манифеста загрузки и водяной знак отчета
+    """
+    from py_scripts import manifest, report
+
+    try:
+        files = manifest.load_status(context)
+        watermark = report.read_watermark(context)
+    except psycopg2.Error as e:
+        print(f"Не удалось прочитать состояние загрузки: {str(e).strip()}")
+        print('Если база данных еще не создана, выполните команду "python main.py init-db"')
+        return False
+
+    for business_date, file_type, filename, stage, rows_loaded, update_dt in files:
+        day = f"{business_date:%d.%m.%Y}" if business_date else "-"
+        rows = "" if rows_loaded is None else rows_loaded
+        print(f"{day:<10}  {file_type:<18}  {stage:<8}  {rows:>10}  {update_dt:%Y-%m-%d %H:%M:%S}  {filename}")
+
+    if watermark is None:
+        print("Отчет еще не строился")
+    else:
+        print(f"Водяной знак отчета: {watermark[0]}, контрольная точка: {watermark[1] or 'нет'}")
+    return True
+
+def reload_terminals(context, args):
+    """
+    Функция, загружающая историю терминалов заново по срезам из архива args.archive_dir
+    """
+    from py_scripts import terminals
+
+    applied = terminals.reload_terminals(context, args.archive_dir)
+    if applied is not None:
+        print(f"История терминалов загружена заново по {applied} срезам")
+    return applied is not None
+
+def detach_partitions(context, args):
+    """
+    Функция, отсоединяющая от таблицы фактов транзакций секции, все транзакции которых совершены раньше даты
+    args.before, чтобы их можно было заархивировать или удалить, не затрагивая загрузку новых дней
+    """
+    from py_scripts import transactions
+
+    detached = transactions.detach_fact_partitions(context, args.before)
+    if detached is not None:
+        print(f"Отсоединено секций: {len(detached)}" + "".join(f"\n  dwh.{name}" for name in detached))
+    return detached is not None
+
+# Команды запуска: функция команды и признак записи метрик запуска. Команда, вернувшая False, завершает запуск
+# с ненулевым кодом возврата, чтобы планировщик заданий увидел ошибку
+COMMANDS = {
+    "init-db": (lambda context, args: init_db(context), False),
+    "load-reference": (lambda context, args: load_reference(context) is not None, True),
+    "ingest": (ingest, True),
+    "report": (build_report, True),
+    "status": (status, False),
+    "reload-terminals": (reload_terminals, False),
+    "detach-partitions": (detach_partitions, False)
+}
+
+def main():
+    """
+    Функция, выполняющая команду запуска, а без команды - ежедневную загрузку всех файлов из директории data.
+    Вынесена в отдельную функцию, чтобы процессы, разбирающие файлы в параллельном режиме, не выполняли загрузку
+    повторно при импорте модуля
+    """
+    # Параметры, общие для всех команд. В подкомандах значение по умолчанию не задается, чтобы параметр, указанный
+    # до имени команды, не перезаписывался
+    def add_common(parser, defaults=True):
+        default = (lambda value: value) if defaults else (lambda value: argparse.SUPPRESS)
+        parser.add_argument("--partition-by", choices=["day", "month", "none"], default=default("month"),
+                            help="секционирование таблицы фактов транзакций")
+        parser.add_argument("--explain", action="store_true", default=default(False),
+                            help="сохранять планы выполнения (EXPLAIN ANALYZE) команд отчета и обновления истории")
+        parser.add_argument("--metrics-dir", default=default("metrics"),
+                            help="каталог, в который записываются метрики запуска")
+        parser.add_argument("--engine", choices=["sql", "python"], default=default("sql"),
+                            help="движок поиска мошеннических операций: запрос в базе данных или векторная оценка в python")
+
+    # Считываем параметры запуска: режим параллельной загрузки, количество процессов, разбирающих файлы,
+    # и режим секционирования таблицы фактов
+    parser = argparse.ArgumentParser()
+    add_common(parser)
+    parser.add_argument("--parallel", action="store_true", help="параллельный разбор и загрузка файлов")
+    parser.add_argument("--workers", type=int, default=3, help="количество процессов, разбирающих файлы")
+    parser.add_argument("--cross-check", action="store_true",
+                        help="после загрузки сравнить результаты движков sql и python по всем транзакциям")
+    parser.add_argument("--backfill", nargs=2, type=date.fromisoformat, metavar=("START", "END"),
+                        help="загрузка за период (даты в формате ГГГГ-ММ-ДД) за один проход")
+    parser.add_argument("--watch", action="store_true",
+                        help="режим службы: загружать дни по мере прихода файлов в директорию data до сигнала остановки")
+    parser.add_argument("--stream", metavar="SOURCE",
+                        help="потоковая оценка транзакций из дописываемого файла SOURCE или стандартного ввода (-)")
+    parser.add_argument("--poll-interval", type=float, default=1.0,
+                        help="интервал опроса директории data в режиме службы, в секундах")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="время, в течение которого файл не должен меняться, чтобы считаться пришедшим, в секундах")
+    parser.add_argument("--queue-size", type=int, default=2,
+                        help="количество готовых дней, ожидающих загрузки в режиме службы")
+
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    add_common(commands.add_parser("init-db", help="создать базу данных и таблицы загрузки"), False)
+    add_common(commands.add_parser("load-reference", help="загрузить справочники карт, счетов и клиентов"), False)
+    command = commands.add_parser("ingest", help="загрузить файлы одного дня из директории data")
+    command.add_argument("--date", type=date.fromisoformat, required=True, help="бизнес-дата в формате ГГГГ-ММ-ДД")
+    add_common(command, False)
+    command = commands.add_parser("report", help="построить отчет о мошеннических операциях")
+    command.add_argument("--date", type=date.fromisoformat,
+                         help="оценить повторно транзакции дня (ГГГГ-ММ-ДД), по умолчанию - от водяного знака")
+    add_common(command, False)
+    add_common(commands.add_parser("status", help="показать состояние загрузки по данным манифеста"), False)
+    command = commands.add_parser("reload-terminals", help="загрузить историю терминалов заново по срезам из архива")
+    command.add_argument("--archive-dir", default="archive", help="каталог архива обработанных файлов")
+    add_common(command, False)
+    command = commands.add_parser("detach-partitions", help="отсоединить старые секции таблицы фактов транзакций")
+    command.add_argument("--before", type=date.fromisoformat, required=True,
+                         help="отсоединить секции, все транзакции которых раньше даты (ГГГГ-ММ-ДД)")
+    add_common(command, False)
+    args = parser.parse_args()
+
+    context = create_context(args)
+    succeeded = True
+    try:
+        if args.command is None:
+            succeeded = run_all(context, args) is not False
+            write_metrics = True
+        else:
+            func, write_metrics = COMMANDS[args.command]
+            succeeded = func(context, args) is not False
+
+        # Записываем метрики запуска по окончании загрузки, дождавшись архивации обработанных файлов
+        context.wait_archived()
+        if write_metrics:
+            print(f"Метрики запуска записаны в {context.metrics.write(args.metrics_dir)}")
+    finally:
+        # Закрываем соединения пула
+        context.close()
+    if not succeeded:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import queue
+import re
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from .manifest import FILE_PATTERNS
+
+# Журнал архива: по строке json на каждый заархивированный файл
+MANIFEST_NAME = "manifest.jsonl"
+
+# Имя файла в архиве: сжатая копия с префиксом контрольной суммы или, в архиве прежних версий, перемещенный файл
+# с расширением .backup
+ARCHIVE_PATTERN = re.compile(r'^(?:[0-9a-f]{16}_)?(.+?)(?:\.gz|\.backup)$')
+
+# Запись в журнал архива выполняется под блокировкой, чтобы строки параллельных записей не перемешивались
+manifest_lock = threading.Lock()
+
+def archive_file(filepath, directory="archive", chunksize=1024 * 1024):
+    """
+    Функция, потоково сжимающая файл filepath в gzip в каталоге directory (каталог создается при необходимости).
+    Сжатая копия распаковывается и сверяется с исходным файлом по контрольной сумме SHA-256 и размеру, и только
+    после этого исходный файл удаляется, а в журнал архива записываются размеры и контрольная сумма.
+    Имя архива начинается с префикса контрольной суммы: повторно присланный файл с тем же именем, но другим
+    содержимым не перезаписывает архив предыдущего. Возвращает запись журнала архива
+    """
+    source = Path(filepath)
+    temp = Path(directory) / f"{source.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    temp.parent.mkdir(parents=True, exist_ok=True)
+
+    # Сжимаем файл порциями, одновременно вычисляя контрольную сумму исходного содержимого
+    checksum = hashlib.sha256()
+    size = 0
+    with open(source, "rb") as src, open(temp, "wb") as raw:
+        with gzip.GzipFile(filename=source.name, mode="wb", fileobj=raw) as dst:
+            for chunk in iter(lambda: src.read(chunksize), b""):
+                checksum.update(chunk)
+                size += len(chunk)
+                dst.write(chunk)
+        raw.flush()
+        os.fsync(raw.fileno())
+
+    # Проверяем сжатую копию: распакованное содержимое должно совпасть с исходным файлом
+    verified = hashlib.sha256()
+    with gzip.open(temp, "rb") as f:
+        for chunk in iter(lambda: f.read(chunksize), b""):
+            verified.update(chunk)
+    if verified.hexdigest() != checksum.hexdigest() or os.path.getsize(source) != size:
+        os.remove(temp)
+        raise ValueError(f"Сжатая копия файла {source} не совпадает с исходным файлом, файл не перемещен в архив")
+
+    # Архив с тем же префиксом содержит то же содержимое, поэтому его замена ничего не теряет
+    target = temp.with_name(f"{checksum.hexdigest()[:16]}_{source.name}.gz")
+    os.replace(temp, target)
+
+    record = {
+        "filename": source.name,
+        "archive": target.name,
+        "size": size,
+        "compressed_size": os.path.getsize(target),
+        "sha256": checksum.hexdigest(),
+        "archived_dt": datetime.now().isoformat(timespec="seconds")
+    }
+    with manifest_lock:
+        with open(target.parent / MANIFEST_NAME, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    os.remove(source)
+    return record
+
+def archived_files(file_type, directory="archive"):
+    """
+    Функция, находящая в каталоге directory архивные копии файлов ежедневной загрузки типа file_type. Если за дату
+    в архиве несколько копий (файл присылался повторно), берется заархивированная последней. Возвращает
+    упорядоченный по дате список пар (дата, путь)
+    """
+    files = {}
+    if not os.path.isdir(directory):
+        return []
+    for filename in os.listdir(directory):
+        archived = ARCHIVE_PATTERN.match(filename)
+        match = archived and FILE_PATTERNS[file_type].match(archived.group(1))
+        if match:
+            day, month, year = match.groups()
+            business_date = datetime(int(year), int(month), int(day)).date()
+            path = os.path.join(directory, filename)
+            if business_date not in files or os.path.getmtime(path) >= os.path.getmtime(files[business_date]):
+                files[business_date] = path
+    return sorted(files.items())
+
+def read_archived(path):
+    """
+    Функция, возвращающая содержимое архивной копии path в виде файлового объекта в памяти, распаковывая сжатую копию
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return io.BytesIO(f.read())
+
+class Archiver:
+    """
+    Класс, архивирующий обработанные файлы в отдельном потоке, пока загрузка переходит к следующему этапу.
+    Время архивации каждого файла записывается в метрики запуска metrics, файлы, которые не удалось заархивировать,
+    остаются на месте и перечисляются в failed
+    """
+    def __init__(self, metrics, directory="archive"):
+        self.metrics = metrics
+        self.directory = directory
+        self.queue = queue.Queue()
+        self.failed = []
+        self.thread = threading.Thread(target=self.run, name="archiver", daemon=True)
+        self.thread.start()
+
+    def submit(self, filepath, business_date=None):
+        """
+        Функция, ставящая файл filepath дня business_date в очередь архивации
+        """
+        self.queue.put((filepath, business_date))
+
+    def run(self):
+        """
+        Функция, выполняющаяся в отдельном потоке: архивирует файлы из очереди до получения признака завершения None
+        """
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                filepath, business_date = item
+                with self.metrics.stage("archive.compressed", business_date, filepath) as record:
+                    archive_file(filepath, self.directory)
+                    record["rows"] = 1
+            except Exception as e:
+                print(f'''При архивации файла "{item[0]}" возникла ошибка {e}''')
+                self.failed.append(item[0])
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Функция, ожидающая архивации всех файлов, поставленных в очередь
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Функция, дожидающаяся архивации файлов из очереди и завершающая поток архивации
+        """
+        self.queue.put(None)
+        self.thread.join()
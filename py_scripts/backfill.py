@@ -0,0 +1,78 @@
+from datetime import datetime, time, timedelta
+
+from . import passports, report, terminals, transactions
+from .pipeline import complete, needs, open_day, read_file, run_stage
+
+def replay_snapshots(context, days):
+    """
+    Функция, обновляющая историю терминалов и "черный список" паспортов по срезам дней days строго в порядке дат.
+    Версии получают бизнес-дату своего среза, поэтому транзакции каждого дня соединяются с терминалами, действовавшими
+    в этот день. Срезы, уже учтенные по данным манифеста загрузки, повторно не применяются. Возвращает False,
+    если обновление истории завершилось ошибкой
+    """
+    for day in days:
+        if needs(day, "terminals", "merged"):
+            df = read_file(context, day, "terminals", terminals.read_terminals)
+            rows_loaded = run_stage(context, day, "terminals", "merged", terminals.terminals_increment, context, df,
+                                    day["business_date"])
+            if not complete(context, day, "terminals", "merged", rows_loaded):
+                return False
+
+        if needs(day, "passport_blacklist", "merged"):
+            df = read_file(context, day, "passport_blacklist", passports.read_passports)
+            rows_loaded = run_stage(context, day, "passport_blacklist", "merged", passports.passports_increment,
+                                    context, df, day["business_date"])
+            if not complete(context, day, "passport_blacklist", "merged", rows_loaded):
+                return False
+    return True
+
+def run_backfill(context, days, start, end):
+    """
+    Функция, выполняющая загрузку за период с start по end (включительно) из списка дней days (пар из даты и словаря
+    файлов дня): срезы терминалов и "черного списка" применяются по порядку дат, транзакции всех дней загружаются
+    в стейдж и в таблицу фактов за один проход, а отчет строится одной командой за весь период. Транзакции периода
+    оцениваются повторно независимо от водяного знака, поэтому режим подходит и для перезагрузки периода
+    после исправлений. Возвращает True, если период обработан полностью
+    """
+    days = [open_day(context, business_date, files) for business_date, files in days if start <= business_date <= end]
+    if not days:
+        print(f"За период с {start:%d.%m.%Y} по {end:%d.%m.%Y} файлы не найдены")
+        return False
+    if any(day is None for day in days):
+        return False
+
+    if not replay_snapshots(context, days):
+        return False
+
+    # Загружаем транзакции всех дней периода в стейдж, не очищая его между файлами
+    staged = {}
+    for i, day in enumerate(days):
+        filepath = day["files"]["transactions"]
+        staged[day["business_date"]] = run_stage(context, day, "transactions", "staged",
+                                                 transactions.stage_transactions, context, filepath, 100000, i == 0,
+                                                 filepath=filepath)
+        if not complete(context, day, "transactions", "staged", staged[day["business_date"]]):
+            return False
+
+    # Переносим транзакции периода в таблицу фактов одной командой
+    with context.metrics.stage("backfill.transactions.loaded") as record:
+        record["rows"] = transactions.transactions_fact(context)
+    if record["rows"] is None:
+        return False
+    for day in days:
+        complete(context, day, "transactions", "loaded", staged[day["business_date"]])
+
+    # Оцениваем транзакции всего периода одной командой: от начала первого дня до конца последнего дня периода
+    since = datetime.combine(days[0]["business_date"], time.min) - timedelta(microseconds=1)
+    until = datetime.combine(days[-1]["business_date"], time.max)
+    with context.metrics.stage("backfill.transactions.reported") as record:
+        record["rows"] = report.report_engine(context.scoring)(context, since, until)
+    if record["rows"] is None:
+        return False
+
+    # Передаем обработанные файлы на архивацию только после того, как обработан весь период
+    for day in days:
+        complete(context, day, "transactions", "reported", record["rows"])
+        for filepath in day["files"].values():
+            context.archive(filepath, day["business_date"])
+    return True
@@ -2,8 +2,10 @@ import psycopg2
 
 def create_db(credentials):
     """
-    Функция, создающая базу данных на сервере PostgreSQL с именем, указанным в передаваемом словаре credentials 
+    Функция, создающая базу данных на сервере PostgreSQL с именем, указанным в передаваемом словаре credentials.
+    Возвращает True, если база данных существует или создана
     """
+    connection = None
     try:
         # Подключаемся к серверу PostgresSQL(к созданной по умолчанию базе данных postgres)
         connection = psycopg2.connect(
@@ -32,6 +34,7 @@ def create_db(credentials):
                 CREATE DATABASE {dbname};
             """)
             print(f'База данных "{credentials["dbname"]}" успешно создана')
+        return True
     except Exception as e:
         print(f"Ошибка при создании базы данных: {e}")
     finally:
@@ -0,0 +1,70 @@
+import os
+from pathlib import Path
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from .manifest import file_checksum
+
+# Количество последних использованных разборов каждого листа, которые хранятся в кэше
+CACHE_ENTRIES = 7
+
+# Версия формата разобранного листа, входящая в имя файла кэша. Увеличивается при изменении разбора листа,
+# чтобы разборы, сохраненные прежней версией, не использовались
+CACHE_FORMAT = 1
+
+def stream_sheet(filepath, sheet_name):
+    """
+    Функция, построчно считывающая лист sheet_name файла Excel filepath в режиме "только чтение", не строя
+    в памяти полную модель книги, и возвращающая датафрейм, первая строка листа которого - заголовок
+    """
+    workbook = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = next(rows, ())
+        df = pd.DataFrame.from_records(rows, columns=header)
+    finally:
+        workbook.close()
+
+    # Удаляем полностью пустые строки, которые Excel может хранить в конце листа
+    return df.dropna(how="all").reset_index(drop=True)
+
+def prune_cache(cache_dir, sheet_name, keep):
+    """
+    Функция, удаляющая из каталога cache_dir разобранные листы sheet_name, кроме keep последних использованных,
+    и разборы, сохраненные в прежних версиях формата кэша
+    """
+    current = f"_{sheet_name}.v{CACHE_FORMAT}.pkl"
+    entries = sorted(Path(cache_dir).glob(f"*_{sheet_name}*.pkl"), key=lambda path: path.stat().st_mtime, reverse=True)
+    stale = [path for path in entries if not path.name.endswith(current)]
+    for path in stale + [path for path in entries if path.name.endswith(current)][keep:]:
+        path.unlink(missing_ok=True)
+
+def read_sheet(filepath, sheet_name, checksum=None, cache_dir="cache", keep=CACHE_ENTRIES):
+    """
+    Функция, считывающая лист sheet_name файла Excel filepath в датафрейм. Разобранный лист сохраняется в каталоге
+    cache_dir под именем, содержащим контрольную сумму файла checksum (если она не передана, вычисляется по файлу)
+    и версию формата кэша, поэтому повторная загрузка того же файла или файла с неизменившимся содержимым обходится
+    без разбора Excel. В кэше хранятся keep последних использованных разборов каждого листа. Кэш, который не удалось
+    прочитать (поврежден или записан несовместимой версией pandas), заменяется новым разбором
+    """
+    cache_path = Path(cache_dir) / f"{checksum or file_checksum(filepath)}_{sheet_name}.v{CACHE_FORMAT}.pkl"
+    try:
+        df = pd.read_pickle(cache_path)
+        # Отмечаем использование разбора, чтобы он не был удален из кэша раньше давно не использованных
+        os.utime(cache_path)
+        return df
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Кэш листа {sheet_name} файла {filepath} не прочитан и будет заменен: {e}")
+
+    df = stream_sheet(filepath, sheet_name)
+
+    # Записываем кэш во временный файл и переименовываем его, чтобы параллельные процессы не прочли недописанный файл
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    df.to_pickle(temp_path)
+    os.replace(temp_path, cache_path)
+    prune_cache(cache_dir, sheet_name, keep)
+    return df
@@ -1,32 +1,160 @@
-import psycopg2
+import csv
+import io
+import re
 
-def execute_sql_scripts(filepath, credentials):
+from . import manifest
+from .manifest import file_checksum
+
+# Соответствие имен таблиц в sql скрипте именам таблиц-измерений в DWH
+TABLE_NAMES = {
+    "cards": "dwh_dim_cards",
+    "accounts": "dwh_dim_accounts",
+    "clients": "dwh_dim_clients"
+}
+
+CREATE_TABLE = re.compile(r'^create\s+table\s+(?:if\s+not\s+exists\s+)?(\w+)', re.IGNORECASE)
+INSERT_INTO = re.compile(r'^insert\s+into\s+(\w+)\s*\(([^)]*)\)\s*values\s*\((.*)\)$', re.IGNORECASE | re.DOTALL)
+VALUE = re.compile(r"'((?:[^']|'')*)'|([^,\s]+)")
+
+def split_statements(sql_scripts):
+    """
+    Функция, удаляющая из текста sql скрипта комментарии и разбивающая его на отдельные команды по символу ";",
+    находящемуся вне строковых литералов
+    """
+    statements = []
+    current = []
+    i, length = 0, len(sql_scripts)
+    while i < length:
+        char = sql_scripts[i]
+        if char == "'":
+            end = i + 1
+            while end < length:
+                if sql_scripts[end] == "'" and sql_scripts[end + 1:end + 2] == "'":
+                    end += 2
+                elif sql_scripts[end] == "'":
+                    break
+                else:
+                    end += 1
+            current.append(sql_scripts[i:end + 1])
+            i = end + 1
+        elif sql_scripts.startswith("/*", i):
+            end = sql_scripts.find("*/", i + 2)
+            i = length if end == -1 else end + 2
+        elif sql_scripts.startswith("--", i):
+            end = sql_scripts.find("\n", i)
+            i = length if end == -1 else end + 1
+        elif char == ";":
+            statements.append("".join(current).strip())
+            current = []
+            i += 1
+        else:
+            current.append(char)
+            i += 1
+    statements.append("".join(current).strip())
+    return [statement for statement in statements if statement]
+
+def parse_values(values):
+    """
+    Функция, разбирающая список значений команды insert в список python: строковые литералы освобождаются
+    от кавычек, null заменяется на None
+    """
+    row = []
+    for quoted, bare in VALUE.findall(values):
+        if bare:
+            row.append(None if bare.lower() == "null" else bare)
+        else:
+            row.append(quoted.replace("''", "'"))
+    return row
+
+def parse_sql_scripts(sql_scripts):
+    """
+    Функция, разбирающая sql скрипт на команды создания таблиц (с именами таблиц, замененными по TABLE_NAMES)
+    и строки данных команд insert, сгруппированные по таблице и списку полей
+    """
+    ddl = []
+    rows = {}
+    for statement in split_statements(sql_scripts):
+        insert = INSERT_INTO.match(statement)
+        create = CREATE_TABLE.match(statement)
+        if insert:
+            table, columns, values = insert.groups()
+            columns = tuple(column.strip() for column in columns.split(","))
+            rows.setdefault((TABLE_NAMES.get(table, table), columns), []).append(parse_values(values))
+        elif create:
+            table = create.group(1)
+            ddl.append(statement[:create.start(1)] + TABLE_NAMES.get(table, table) + statement[create.end(1):])
+        else:
+            ddl.append(statement)
+    return ddl, rows
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    Функция, загружающая строки rows в таблицу table одной командой COPY в формате csv
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if value is None else value for value in row])
+    buffer.seek(0)
+    cursor.copy_expert(f"""
+        COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')
+    """, buffer)
+
+def execute_sql_scripts(filepath, context):
     """
-    Функция, выпоняяющая sql scripts, прописанные в файле filepath, создающие таблицы в базе данных с
-    параметрами подключения, указанными в credentials, и заполняющие эти таблицы данными
+    Функция, выпоняяющая sql scripts, прописанные в файле filepath, создающие таблицы в базе данных, соединение
+    с которой предоставляет context, и заполняющие эти таблицы данными. Скрипт разбирается на строки, которые
+    загружаются в таблицы командой COPY; если скрипт не изменился с предыдущей загрузки, загрузка пропускается
     """
-    with open(filepath, 'r', encoding='utf-8') as f:
-        sql_scripts = f.read()
-        sql_scripts_modified = sql_scripts.replace("cards","dwh_dim_cards")\
-                                            .replace("accounts","dwh_dim_accounts")\
-                                            .replace("clients","dwh_dim_clients")
+    checksum = file_checksum(filepath)
     try:
-        connection = psycopg2.connect(**credentials)
-        cursor = connection.cursor()
-        # Создадим в используемой базе данных схему DWH, если ее нет
-        cursor.execute("CREATE SCHEMA IF NOT EXISTS DWH")
-        connection.commit()       
-        cursor.execute("SET SEARCH_PATH TO DWH")
-        # Запускаем выполение sql скрипта, прочитанного из файла, предварительно удалив таблицы создаваемые данным скриптом
-        cursor.execute("DROP TABLE IF EXISTS dwh_dim_cards CASCADE")
-        cursor.execute("DROP TABLE IF EXISTS dwh_dim_accounts CASCADE")
-        cursor.execute("DROP TABLE IF EXISTS dwh_dim_clients CASCADE")
-        cursor.execute(sql_scripts_modified)
-        connection.commit()
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                # Пропускаем загрузку, если скрипт с той же контрольной суммой уже загружен и таблицы на месте
+                cursor.execute("""
+                    SELECT to_regclass('dwh.dwh_dim_cards') IS NOT NULL
+                    AND to_regclass('dwh.dwh_dim_accounts') IS NOT NULL
+                    AND to_regclass('dwh.dwh_dim_clients') IS NOT NULL
+                """)
+                tables_exist = cursor.fetchone()[0]
+        if tables_exist and manifest.get_stage(context, filepath, checksum) == "loaded":
+            return 0
+
+        with open(filepath, 'r', encoding='utf-8') as f:
+            ddl, rows = parse_sql_scripts(f.read())
+
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL SEARCH_PATH TO DWH")
+                # Запускаем выполение sql скрипта, прочитанного из файла, предварительно удалив таблицы создаваемые данным скриптом
+                cursor.execute("DROP TABLE IF EXISTS dwh_dim_cards CASCADE")
+                cursor.execute("DROP TABLE IF EXISTS dwh_dim_accounts CASCADE")
+                cursor.execute("DROP TABLE IF EXISTS dwh_dim_clients CASCADE")
+                for statement in ddl:
+                    cursor.execute(statement)
+
+                # Загружаем строки данных скрипта в таблицы пакетно
+                rows_loaded = 0
+                for (table, columns), table_rows in rows.items():
+                    copy_rows(cursor, table, columns, table_rows)
+                    rows_loaded += len(table_rows)
+
+                # Добавляем нормализованные ключи: номер карты без пробелов в виде числа и идентификатор клиента
+                # в нижнем регистре, чтобы соединения в отчете выполнялись по индексам без вычисления выражений
+                cursor.execute("ALTER TABLE dwh_dim_cards ADD COLUMN IF NOT EXISTS card_key BIGINT")
+                cursor.execute("UPDATE dwh_dim_cards SET card_key = REGEXP_REPLACE(card_num, '\\s', '', 'g')::BIGINT")
+                cursor.execute("CREATE INDEX IF NOT EXISTS dwh_dim_cards_card_key_idx ON dwh_dim_cards(card_key)")
+
+                cursor.execute("ALTER TABLE dwh_dim_accounts ADD COLUMN IF NOT EXISTS client_key VARCHAR(128)")
+                cursor.execute("UPDATE dwh_dim_accounts SET client_key = LOWER(client)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS dwh_dim_accounts_client_key_idx ON dwh_dim_accounts(client_key)")
+
+                cursor.execute("ALTER TABLE dwh_dim_clients ADD COLUMN IF NOT EXISTS client_key VARCHAR(128)")
+                cursor.execute("UPDATE dwh_dim_clients SET client_key = LOWER(client_id)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS dwh_dim_clients_client_key_idx ON dwh_dim_clients(client_key)")
+
+        manifest.set_stage(context, filepath, "reference", None, checksum, "loaded", rows_loaded)
+        return rows_loaded
     except Exception as e:
-        print(f'''При попытке подключения к базе данных "{credentials["dbname"]}" и 
+        print(f'''При попытке подключения к базе данных "{context.credentials["dbname"]}" и
         выполнения sql скрипта содержащегося в файле "{filepath}" возникла ошибка {e}''')
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
\ No newline at end of file
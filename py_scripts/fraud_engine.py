@@ -0,0 +1,245 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from . import fraud_rules, report
+
+# Расшифровки признаков мошеннических операций в порядке битов признака fraud_type
+EVENT_TYPES = [label for _, label in fraud_rules.labels()]
+
+# Окна правил поиска мошеннических операций из реестра правил
+CITY_WINDOW = pd.Timedelta(fraud_rules.get_rule("multi_city")["lookback"])
+GUESSING_WINDOW = pd.Timedelta(fraud_rules.get_rule("amount_guessing")["lookback"])
+
+def transactions_query(source):
+    """
+    Функция, формирующая запрос, возвращающий транзакции запроса source вместе с данными договора и клиента,
+    необходимыми правилам поиска мошеннических операций
+    """
+    return f"""
+        SELECT
+            t1.trans_id,
+            t1.trans_date,
+            t1.card_num,
+            t1.oper_type,
+            t1.amt,
+            t1.oper_result,
+            t1.terminal_city,
+            t1.scored,
+            t3.valid_to,
+            t4.passport_num,
+            t4.passport_valid_to,
+            CONCAT_WS(' ', t4.last_name, t4.first_name, t4.patronymic) AS fio
+        FROM ({source}) t1
+        INNER JOIN dwh.dwh_dim_cards t2
+        ON t1.card_key=t2.card_key
+        INNER JOIN dwh.dwh_dim_accounts t3
+        ON t2.account=t3.account
+        INNER JOIN dwh.dwh_dim_clients t4
+        ON t3.client_key=t4.client_key
+    """
+
+def read_query(context, query, params):
+    """
+    Функция, выполняющая в схеме DWH запрос query с параметрами params и возвращающая результат в виде датафрейма
+    """
+    with context.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL SEARCH_PATH TO DWH")
+            cursor.execute(query, params)
+            columns = [column[0] for column in cursor.description]
+            return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+def load_transactions(context, since, until=None, source=None):
+    """
+    Функция, однократно считывающая из DWH транзакции, совершенные позже since и не позже until, вместе с часом
+    истории до since. История берется из запроса source (по умолчанию - из таблицы фактов)
+    """
+    return read_query(context, transactions_query(source or report.TRANSACTIONS_SOURCE),
+                      {"since": since, "until": until})
+
+def load_blacklist(context):
+    """
+    Функция, считывающая текущий "черный список" паспортов в словарь {номер паспорта: дата внесения в список},
+    по которому паспорт каждой операции проверяется поиском по хэшу
+    """
+    df = read_query(context, "SELECT passport_num, entry_dt FROM dwh_dim_passport_blacklist_current", None)
+    return dict(zip(df["passport_num"], df["entry_dt"]))
+
+def window_keys(groups, times):
+    """
+    Функция, строящая для упорядоченных по группе и времени операций монотонный целочисленный ключ: номер группы,
+    умноженный на ширину диапазона времени, плюс смещение времени операции. Поиск границ временных окон по такому ключу
+    не выходит за пределы группы. Смещение считается в микросекундах, а если ключ не помещается в int64, - в секундах.
+    Возвращает ключи и длительность часового окна в единицах ключа
+    """
+    unit = 1000
+    offsets = (times - times.min()) // unit
+    width = int(offsets.max()) + CITY_WINDOW.value // unit + 1
+    if (int(groups.max()) + 1) * width >= 2 ** 62:
+        unit = 1000000000
+        offsets = (times - times.min()) // unit
+        width = int(offsets.max()) + CITY_WINDOW.value // unit + 1
+    return groups * width + offsets, CITY_WINDOW.value // unit
+
+def score(df, blacklist=None):
+    """
+    Функция, векторно вычисляющая признак мошеннической операции fraud_type для каждой транзакции датафрейма df
+    по тем же правилам, что и отчет в базе данных. blacklist - словарь текущего "черного списка" паспортов
+    {номер паспорта: дата внесения}. Признак содержит биты всех выполненных правил реестра fraud_rules.RULES.
+    Возвращает датафрейм, упорядоченный по карте и времени операции, с полем fraud_type
+    """
+    df = df.sort_values(["card_num", "trans_date", "trans_id"], kind="stable")
+    df = df.reset_index(drop=True)
+    if df.empty:
+        return df.assign(fraud_type=pd.Series(dtype="int64"))
+
+    groups = df.groupby("card_num", sort=False).ngroup().to_numpy()
+    times = pd.to_datetime(df["trans_date"]).to_numpy(dtype="datetime64[ns]").view("int64")
+    amounts = df["amt"].astype(float).to_numpy()
+    results = df["oper_result"].to_numpy()
+    types = df["oper_type"].to_numpy()
+    index = np.arange(len(df))
+
+    trans_date = pd.to_datetime(df["trans_date"])
+
+    # Недействующий паспорт или паспорт, внесенный в "черный список" до совершения операции
+    entry_dt = pd.to_datetime(df["passport_num"].map(blacklist or {}))
+    invalid_passport = (
+        (trans_date.dt.normalize() > pd.to_datetime(df["passport_valid_to"]))
+        | (df["passport_num"].isin((blacklist or {}).keys()) & ~(entry_dt > trans_date))
+    ).to_numpy()
+
+    # Просроченный договор: день операции позже даты окончания действия договора
+    expired_contract = (trans_date.dt.normalize() > pd.to_datetime(df["valid_to"])).to_numpy()
+
+    # Операции в разных городах в течение часа: окно [t - 1 час, t] с операциями в то же время включительно.
+    # В окне больше одного города, если внутри окна город меняется хотя бы раз
+    keys, window = window_keys(groups, times)
+    left = np.searchsorted(keys, keys - window, side="left")
+    right = np.searchsorted(keys, keys, side="right") - 1
+    cities = pd.factorize(df["terminal_city"])[0]
+    changed = np.r_[False, cities[1:] != cities[:-1]]
+    last_change = np.maximum.accumulate(np.where(changed, index, 0))
+    multi_city = last_change[right] > left
+
+    # Подбор суммы: три операции подряд по карте за 20 минут, суммы убывают, отклонены все кроме последней
+    def shifted(values, periods):
+        result = np.empty_like(values)
+        result[:periods] = values[:periods]
+        result[periods:] = values[:-periods]
+        return result
+
+    same_group = np.r_[False, False, groups[2:] == groups[:-2]]
+    guessing = (
+        same_group
+        & (shifted(amounts, 2) > shifted(amounts, 1))
+        & (shifted(amounts, 1) > amounts)
+        & (times - shifted(times, 2) <= GUESSING_WINDOW.value)
+        & (shifted(results, 2) == "REJECT")
+        & (shifted(results, 1) == "REJECT")
+        & (results == "SUCCESS")
+        & (shifted(types, 2) != "DEPOSIT")
+        & (shifted(types, 1) != "DEPOSIT")
+        & (types != "DEPOSIT")
+    )
+
+    # Правила вычисляются независимо, и бит каждого выполненного правила добавляется в признак
+    flags = {
+        "passport": invalid_passport,
+        "contract": expired_contract,
+        "multi_city": multi_city,
+        "amount_guessing": guessing
+    }
+    df["fraud_type"] = np.bitwise_or.reduce(
+        [np.where(flags[rule["name"]], 1 << rule["bit"], 0) for rule in fraud_rules.RULES]
+    )
+    return df
+
+def report_rows(df):
+    """
+    Функция, формирующая из оцененных транзакций df строки отчета о мошеннических операциях
+    """
+    df = df[df["scored"].astype(bool) & (df["fraud_type"] != 0)].drop_duplicates("trans_id")
+    event_type = pd.Series("", index=df.index)
+    for bit, label in fraud_rules.labels():
+        flagged = (df["fraud_type"] & (1 << bit)) != 0
+        event_type = event_type.where(~flagged, event_type.where(event_type == "", event_type + ", ") + label)
+    return pd.DataFrame({
+        "trans_id": df["trans_id"],
+        "event_dt": df["trans_date"],
+        "passport": df["passport_num"],
+        "fio": df["fio"],
+        "event_type": event_type
+    }).reset_index(drop=True)
+
+def write_report(cursor, rows):
+    """
+    Функция, загружающая строки отчета rows командой COPY во временную таблицу и переносящая их в отчет одной командой.
+    Возвращает количество добавленных или обновленных строк отчета
+    """
+    cursor.execute("""
+        CREATE TEMP TABLE tmp_rep_fraud ON COMMIT DROP AS
+        SELECT trans_id, event_dt, passport, fio, event_type FROM rep_fraud WITH NO DATA
+    """)
+    buffer = io.StringIO()
+    rows.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert("COPY tmp_rep_fraud FROM STDIN WITH (FORMAT csv)", buffer)
+    cursor.execute("""
+        INSERT INTO rep_fraud(trans_id, event_dt, passport, fio, event_type)
+        SELECT trans_id, event_dt, passport, fio, event_type
+        FROM tmp_rep_fraud
+        ON CONFLICT (trans_id) DO UPDATE
+        SET event_dt = EXCLUDED.event_dt,
+            passport = EXCLUDED.passport,
+            fio = EXCLUDED.fio,
+            event_type = EXCLUDED.event_type,
+            report_dt = current_timestamp;
+    """)
+    return cursor.rowcount
+
+def create_report(context, since=None, until=None):
+    """
+    Функция, инкрементально наполняющая таблицу-отчет о выявленных мошеннических операциях, оценивая транзакции
+    в памяти: транзакции позже водяного знака (или позже since) и не позже until вместе с часом истории считываются из DWH
+    одним запросом, правила вычисляются векторно, а найденные операции записываются в отчет пакетно.
+    Возвращает количество добавленных или обновленных строк отчета
+    """
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL SEARCH_PATH TO DWH")
+                if since is None:
+                    cursor.execute("SELECT last_trans_date FROM rep_fraud_watermark WHERE report_name = 'rep_fraud'")
+                    row = cursor.fetchone()
+                    since = row[0] if row else None
+                # История правил берется из контрольной точки, если она сохранена на водяном знаке
+                source = report.scoring_source(cursor, since)
+
+        rows = report_rows(score(load_transactions(context, since, until, source), load_blacklist(context)))
+
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL SEARCH_PATH TO DWH")
+                rows_reported = write_report(cursor, rows)
+                report.remove_unflagged(cursor, since, until)
+                report.update_watermark(cursor, since, until)
+                report.save_checkpoint(cursor, source, since, until)
+                return rows_reported
+    except Exception as e:
+        print(f'''При выполнении функции "create_report" (движок python) возникла ошибка {e}''')
+
+def cross_check(context, since=None):
+    """
+    Функция, сравнивающая строки отчета, найденные движком python и запросом в базе данных, по транзакциям,
+    совершенным позже since, без записи в отчет. Возвращает датафрейм расхождений (пустой, если результаты совпадают)
+    """
+    expected = read_query(context, report.fraud_query(report.TRANSACTIONS_SOURCE), {"since": since, "until": None})
+    actual = report_rows(score(load_transactions(context, since), load_blacklist(context)))
+
+    merged = expected[["trans_id", "event_type"]].merge(
+        actual[["trans_id", "event_type"]], on="trans_id", how="outer", suffixes=("_sql", "_python"), indicator=True
+    )
+    return merged[(merged["_merge"] != "both") | (merged["event_type_sql"] != merged["event_type_python"])]
@@ -0,0 +1,118 @@
+from datetime import timedelta
+
+# Окно операций карты, упорядоченных по времени, общее для всех правил. Правила с временной рамкой описывают
+# именованные окна на его основе, поэтому все оконные функции запроса вычисляются за одну сортировку
+CARD_WINDOW = "PARTITION BY t1.card_num ORDER BY t1.trans_date"
+
+# Реестр правил поиска мошеннических операций: бит признака fraud_type, расшифровка для отчета, глубина истории,
+# необходимая правилу (lookback), и условие на поля операции t1, договора t3, клиента t4 и текущего "черного списка"
+# паспортов t5. В условии {lookback} заменяется интервалом глубины истории правила, окно card - общим окном операций
+# карты, а windows описывает дополнительные именованные окна правила. Правила вычисляются независимо, и бит каждого
+# выполненного правила добавляется в признак, поэтому добавление правила не требует повторного просмотра операций
+RULES = [
+    {
+        "name": "passport",
+        "bit": 0,
+        "label": "просроченный или заблокированный паспорт",
+        "lookback": timedelta(0),
+        # Недействующий паспорт или паспорт, занесенный в черный список до совершения операции
+        "predicate": """
+            DATE_TRUNC('day', t1.trans_date) > t4.passport_valid_to::TIMESTAMP
+            OR (t5.passport_num IS NOT NULL AND COALESCE(t5.entry_dt, '-infinity') <= t1.trans_date)
+        """
+    },
+    {
+        "name": "contract",
+        "bit": 1,
+        "label": "простроченный договор",
+        "lookback": timedelta(0),
+        # Операция совершена при недействующем договоре
+        "predicate": """
+            DATE_TRUNC('day', t1.trans_date) > t3.valid_to::TIMESTAMP
+        """
+    },
+    {
+        "name": "multi_city",
+        "bit": 2,
+        "label": "операции в разных городах в течение часа",
+        "lookback": timedelta(hours=1),
+        # В окне из операций по карте за последний час (включая текущую) больше одного города тогда и только тогда,
+        # когда минимальный и максимальный город окна различаются
+        "windows": {
+            "card_hour": "card RANGE BETWEEN {lookback} PRECEDING AND CURRENT ROW"
+        },
+        "predicate": """
+            MIN(t1.terminal_city) OVER card_hour != MAX(t1.terminal_city) OVER card_hour
+        """
+    },
+    {
+        "name": "amount_guessing",
+        "bit": 3,
+        "label": "операции подбора суммы",
+        "lookback": timedelta(minutes=20),
+        # Три операции подряд в течение 20 минут: каждая следующая меньше предыдущей, отклонены все кроме последней
+        "predicate": """
+            LAG(t1.amt, 2) OVER card > LAG(t1.amt, 1) OVER card
+            AND LAG(t1.amt, 1) OVER card > t1.amt
+            AND t1.trans_date - LAG(t1.trans_date, 2) OVER card <= {lookback}
+            AND LAG(t1.oper_result, 2) OVER card = 'REJECT'
+            AND LAG(t1.oper_result, 1) OVER card = 'REJECT'
+            AND t1.oper_result = 'SUCCESS'
+            AND LAG(t1.oper_type, 2) OVER card != 'DEPOSIT'
+            AND LAG(t1.oper_type, 1) OVER card != 'DEPOSIT'
+            AND t1.oper_type != 'DEPOSIT'
+        """
+    }
+]
+
+def get_rule(name):
+    """
+    Функция, возвращающая описание правила name из реестра
+    """
+    return next(rule for rule in RULES if rule["name"] == name)
+
+def interval(value):
+    """
+    Функция, возвращающая литерал интервала sql для длительности value
+    """
+    return f"INTERVAL '{int(value.total_seconds())} seconds'"
+
+def history():
+    """
+    Функция, возвращающая литерал интервала истории, необходимой правилам: наибольшую глубину истории правил реестра
+    """
+    return interval(max(rule["lookback"] for rule in RULES))
+
+def labels():
+    """
+    Функция, возвращающая пары (бит, расшифровка) правил реестра в порядке битов
+    """
+    return [(rule["bit"], rule["label"]) for rule in sorted(RULES, key=lambda rule: rule["bit"])]
+
+def compile_windows():
+    """
+    Функция, формирующая раздел WINDOW запроса: общее окно операций карты и именованные окна правил
+    """
+    windows = {"card": CARD_WINDOW}
+    for rule in RULES:
+        for name, definition in rule.get("windows", {}).items():
+            windows[name] = definition.replace("{lookback}", interval(rule["lookback"]))
+    return "WINDOW " + ",\n    ".join(f"{name} AS ({definition})" for name, definition in windows.items())
+
+def compile_fraud_type():
+    """
+    Функция, формирующая выражение признака fraud_type: побитовое ИЛИ битов всех выполненных правил реестра
+    """
+    return "\n    | ".join(
+        f"(CASE WHEN {rule['predicate'].strip().replace('{lookback}', interval(rule['lookback']))} "
+        f"THEN {1 << rule['bit']} ELSE 0 END)"
+        for rule in RULES
+    )
+
+def compile_event_type():
+    """
+    Функция, формирующая выражение расшифровки признака fraud_type: перечисление через запятую расшифровок
+    всех выполненных правил в порядке битов
+    """
+    cases = ",\n    ".join(f"CASE WHEN (fraud_type & {1 << bit}) != 0 THEN '{label}' END" for bit, label in labels())
+    return f"CONCAT_WS(', ',\n    {cases}\n)"
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import re
+from datetime import datetime
+
+# Шаблоны имен файлов ежедневной загрузки: из имени файла извлекается бизнес-дата в формате ДДММГГГГ
+FILE_PATTERNS = {
+    "terminals": re.compile(r'^terminals_(\d{2})(\d{2})(\d{4})\.xlsx$'),
+    "passport_blacklist": re.compile(r'^passport_blacklist_(\d{2})(\d{2})(\d{4})\.xlsx$'),
+    "transactions": re.compile(r'^transactions_(\d{2})(\d{2})(\d{4})\.txt$')
+}
+
+# Этапы обработки файла каждого типа в порядке их выполнения. Файл обработан полностью, когда достигнут последний этап
+STAGES = {
+    "terminals": ["merged"],
+    "passport_blacklist": ["merged"],
+    "transactions": ["staged", "loaded", "reported"],
+    "reference": ["loaded"]
+}
+
+def file_checksum(filepath, chunksize=1024 * 1024):
+    """
+    Функция, вычисляющая контрольную сумму SHA-256 содержимого файла filepath, считывая его порциями по chunksize байт
+    """
+    checksum = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunksize), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+def discover_days(directory):
+    """
+    Функция, находящая в каталоге directory файлы ежедневной загрузки и группирующая их по бизнес-дате,
+    указанной в имени файла. Возвращает упорядоченный по дате список пар (дата, словарь {тип файла: путь})
+    """
+    days = {}
+    for filename in os.listdir(directory):
+        for file_type, pattern in FILE_PATTERNS.items():
+            match = pattern.match(filename)
+            if match:
+                day, month, year = match.groups()
+                business_date = datetime(int(year), int(month), int(day)).date()
+                days.setdefault(business_date, {})[file_type] = os.path.join(directory, filename)
+    return sorted(days.items())
+
+def manifest_table(context):
+    """
+    Функция, создающая в DWH таблицу-манифест загрузки, в которой для каждого файла хранятся его контрольная сумма,
+    бизнес-дата, достигнутый этап обработки и количество загруженных строк
+    """
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS dwh.meta_load_manifest(
+                        filename VARCHAR(256) PRIMARY KEY,
+                        file_type VARCHAR(32),
+                        business_date DATE,
+                        checksum VARCHAR(64),
+                        stage VARCHAR(32),
+                        rows_loaded BIGINT,
+                        update_dt TIMESTAMP DEFAULT current_timestamp
+                    );
+                """)
+        return True
+
+    except Exception as e:
+        print(f'''При выполнении функции "manifest_table" возникла ошибка {e}''')
+
+def get_stage(context, filepath, checksum):
+    """
+    Функция, возвращающая этап, достигнутый при обработке файла filepath, или None, если файл не обрабатывался.
+    Если содержимое файла изменилось (не совпадает контрольная сумма), файл считается новым
+    """
+    with context.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT stage FROM dwh.meta_load_manifest WHERE filename = %s AND checksum = %s
+            """, [os.path.basename(filepath), checksum])
+            row = cursor.fetchone()
+    return row[0] if row else None
+
+def set_stage(context, filepath, file_type, business_date, checksum, stage, rows_loaded=None):
+    """
+    Функция, записывающая в манифест загрузки этап stage, достигнутый при обработке файла filepath
+    """
+    with context.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO dwh.meta_load_manifest(filename, file_type, business_date, checksum, stage, rows_loaded)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (filename) DO UPDATE
+                SET file_type = EXCLUDED.file_type,
+                    business_date = EXCLUDED.business_date,
+                    checksum = EXCLUDED.checksum,
+                    stage = EXCLUDED.stage,
+                    rows_loaded = COALESCE(EXCLUDED.rows_loaded, meta_load_manifest.rows_loaded),
+                    update_dt = current_timestamp
+            """, [os.path.basename(filepath), file_type, business_date, checksum, stage, rows_loaded])
+
+def is_done(file_type, stage):
+    """
+    Функция, проверяющая, достигнут ли последний этап обработки файла типа file_type
+    """
+    return stage == STAGES[file_type][-1]
+
+def needs(file_type, stage, target):
+    """
+    Функция, проверяющая, нужно ли выполнять этап target для файла типа file_type, достигшего этапа stage
+    """
+    if stage is None:
+        return True
+    return STAGES[file_type].index(stage) < STAGES[file_type].index(target)
+
+def load_status(context):
+    """
+    Функция, возвращающая из манифеста загрузки достигнутые этапы обработки файлов: список кортежей
+    (бизнес-дата, тип файла, имя файла, этап, количество строк, время обновления), упорядоченный по дате
+    """
+    with context.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT business_date, file_type, filename, stage, rows_loaded, update_dt
+                FROM dwh.meta_load_manifest
+                ORDER BY business_date NULLS FIRST, file_type
+            """)
+            return cursor.fetchall()
@@ -0,0 +1,290 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from psycopg2.extensions import cursor as base_cursor
+
+# Набор метрик текущего запуска, в который курсоры соединений записывают время выполнения команд
+ACTIVE = None
+
+class TimedCursor(base_cursor):
+    """
+    Класс курсора psycopg2, замеряющего время выполнения каждой команды и количество затронутых строк
+    и записывающего их в набор метрик текущего запуска
+    """
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_statement(query, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_statement(query, time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_statement(sql, time.perf_counter() - start, self.rowcount)
+
+def record_statement(query, seconds, rowcount):
+    """
+    Функция, записывающая время выполнения команды query в набор метрик текущего запуска, если он создан
+    """
+    if ACTIVE is not None:
+        ACTIVE.statement(query, seconds, rowcount)
+
+def timed_call(func, *args):
+    """
+    Функция, вызывающая func с аргументами args и возвращающая пару из результата и времени выполнения в секундах.
+    Используется для замера разбора файлов в отдельных процессах, у которых нет доступа к набору метрик запуска
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def row_count(result):
+    """
+    Функция, возвращающая количество строк результата этапа: число строк или длину датафрейма
+    """
+    if result is None or isinstance(result, int):
+        return result
+    return len(result)
+
+class Metrics:
+    """
+    Класс, накапливающий метрики запуска: время выполнения и количество строк этапов загрузки, время выполнения
+    команд sql, время ожидания соединения из пула, объем считанных файлов и, если explain равен True,
+    планы выполнения (EXPLAIN ANALYZE) основных команд отчета и обновления истории измерений. Повторные выполнения
+    одной команды в одном этапе суммируются в одну запись, поэтому количество записей команд не зависит от того,
+    сколько раз выполнялся этап (например, запись пакетов потоковой оценки)
+    """
+    def __init__(self, explain=False):
+        self.explain_plans = explain
+        self.run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.stages = []
+        self.statements = {}
+        self.plans = []
+        # Признак того, что записанные метрики удалялись из памяти: следующие записи дописываются к файлам
+        self.cleared = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def current(self):
+        """
+        Функция, возвращающая запись этапа, выполняющегося в текущем потоке, или None
+        """
+        return getattr(self.local, "stage", None)
+
+    @contextmanager
+    def stage(self, name, business_date=None, filepath=None):
+        """
+        Функция, замеряющая выполнение этапа name дня business_date. Выдает запись этапа, в поле "rows" которой
+        вызывающий код записывает количество обработанных строк. Для файла filepath записывается его объем в байтах
+        """
+        record = {
+            "stage": name,
+            "business_date": business_date.isoformat() if business_date else None,
+            "rows": None,
+            "bytes_read": os.path.getsize(filepath) if filepath and os.path.exists(filepath) else None,
+            "connection_wait": 0.0,
+            "statements": 0,
+            "status": "ok"
+        }
+        parent = self.current()
+        self.local.stage = record
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["status"] = f"error: {e}"
+            raise
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 3)
+            # Функции этапов перехватывают ошибки и возвращают None, такой этап также считается неуспешным
+            if record["rows"] is None and record["status"] == "ok":
+                record["status"] = "failed"
+            self.local.stage = parent
+            with self.lock:
+                self.stages.append(record)
+
+    def add_stage(self, name, business_date, seconds, rows, filepath=None):
+        """
+        Функция, записывающая этап name, замеренный вне текущего процесса
+        """
+        with self.stage(name, business_date, filepath) as record:
+            record["rows"] = rows
+        record["seconds"] = round(seconds, 3)
+
+    def statement(self, query, seconds, rowcount):
+        """
+        Функция, записывающая время выполнения и количество затронутых строк команды query
+        """
+        if isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+        record = self.current()
+        if record is not None:
+            record["statements"] += 1
+        statement = {
+            "stage": record["stage"] if record else None,
+            "business_date": record["business_date"] if record else None,
+            "statement": re.sub(r"\s+", " ", str(query)).strip()[:300],
+            "calls": 1,
+            "seconds": round(seconds, 4),
+            "max_seconds": round(seconds, 4),
+            "rowcount": rowcount
+        }
+        with self.lock:
+            add_statement(self.statements, statement)
+
+    def connection_wait(self, seconds):
+        """
+        Функция, добавляющая к этапу текущего потока время ожидания соединения из пула
+        """
+        record = self.current()
+        if record is not None:
+            record["connection_wait"] = round(record["connection_wait"] + seconds, 4)
+
+    def explain(self, cursor, name, query, params=None):
+        """
+        Функция, сохраняющая план выполнения команды query с фактическим временем и статистикой буферов.
+        EXPLAIN ANALYZE выполняет команду, поэтому он выполняется внутри точки сохранения, которая затем откатывается
+        """
+        if not self.explain_plans:
+            return
+        cursor.execute("SAVEPOINT explain_plan")
+        try:
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+            plan = cursor.fetchone()[0]
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT explain_plan")
+        record = self.current()
+        with self.lock:
+            self.plans.append({
+                "name": name,
+                "stage": record["stage"] if record else None,
+                "business_date": record["business_date"] if record else None,
+                "plan": plan
+            })
+
+    def summary(self, records, totals=None):
+        """
+        Функция, суммирующая время выполнения, количество строк и время ожидания соединений по этапам,
+        добавляя их к итогам totals, записанным ранее
+        """
+        totals = {stage: dict(total) for stage, total in (totals or {}).items()}
+        for record in records:
+            total = totals.setdefault(record["stage"], {"seconds": 0.0, "rows": 0, "connection_wait": 0.0})
+            total["seconds"] = round(total["seconds"] + record["seconds"], 3)
+            total["rows"] += record["rows"] or 0
+            total["connection_wait"] = round(total["connection_wait"] + record["connection_wait"], 4)
+        return totals
+
+    def write(self, directory="metrics", clear=False):
+        """
+        Функция, записывающая метрики запуска в каталог directory/<идентификатор запуска>: файл run.json
+        с итогами по этапам и метриками и по файлу day_<дата>.json с метриками каждого обработанного дня.
+        Если clear равен True, записанные метрики удаляются из памяти, а следующие записи дописываются к файлам дней,
+        и в run.json дописываются только итоги и метрики, не относящиеся к дню. Так в режиме службы, записывающем
+        метрики после каждого дня, память и объем записи не растут со временем работы
+        """
+        run_dir = Path(directory) / self.run_id
+        run_dir.mkdir(parents=True, exist_ok=True)
+
+        with self.lock:
+            stages, plans = list(self.stages), list(self.plans)
+            statements = [dict(record) for record in self.statements.values()]
+            append = self.cleared
+            if clear:
+                self.stages, self.statements, self.plans = [], {}, []
+                self.cleared = True
+
+        days = {}
+        for kind, records in (("stages", stages), ("statements", statements), ("plans", plans)):
+            for record in records:
+                if record["business_date"]:
+                    days.setdefault(record["business_date"], {"stages": [], "statements": [], "plans": []})
+                    days[record["business_date"]][kind].append(record)
+
+        # Без удаления из памяти run.json содержит все метрики запуска, иначе - метрики, не относящиеся к дню
+        undated = not (clear or append)
+        run = {
+            "stages": [record for record in stages if undated or not record["business_date"]],
+            "statements": [record for record in statements if undated or not record["business_date"]],
+            "plans": [record for record in plans if undated or not record["business_date"]]
+        }
+        totals = None
+        if append:
+            run, totals = merge_file(run_dir / "run.json", run)
+        write_json(run_dir / "run.json", {
+            "run_id": self.run_id,
+            "started": self.started,
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "totals": self.summary(stages, totals),
+            **run
+        })
+
+        for business_date, records in sorted(days.items()):
+            path = run_dir / f"day_{business_date}.json"
+            if append:
+                records, _ = merge_file(path, records)
+            write_json(path, {
+                "run_id": self.run_id,
+                "business_date": business_date,
+                "totals": self.summary(records["stages"]),
+                **records
+            })
+        return run_dir
+
+def add_statement(statements, statement):
+    """
+    Функция, добавляющая запись команды statement к записям statements ({(этап, дата, команда): запись}):
+    время и количество выполнений одной команды в одном этапе суммируются
+    """
+    key = (statement["stage"], statement["business_date"], statement["statement"])
+    total = statements.get(key)
+    if total is None:
+        statements[key] = dict(statement)
+        return
+    total["calls"] += statement["calls"]
+    total["seconds"] = round(total["seconds"] + statement["seconds"], 4)
+    total["max_seconds"] = max(total["max_seconds"], statement["max_seconds"])
+    if statement["rowcount"] is not None:
+        total["rowcount"] = (total["rowcount"] or 0) + statement["rowcount"]
+
+def merge_file(path, records):
+    """
+    Функция, дописывающая к метрикам records ({"stages": ..., "statements": ..., "plans": ...}) метрики,
+    записанные ранее в файл path. Возвращает объединенные метрики и итоги по этапам, записанные в файле
+    """
+    if not path.exists():
+        return records, None
+    with open(path, "r", encoding="utf-8") as f:
+        written = json.load(f)
+    statements = {}
+    for statement in written["statements"] + records["statements"]:
+        add_statement(statements, statement)
+    return {
+        "stages": written["stages"] + records["stages"],
+        "statements": list(statements.values()),
+        "plans": written["plans"] + records["plans"]
+    }, written.get("totals")
+
+def write_json(path, data):
+    """
+    Функция, записывающая data в файл path в формате json
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
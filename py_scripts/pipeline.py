@@ -0,0 +1,205 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import manifest, passports, report, terminals, transactions
+from .manifest import file_checksum
+from .metrics import row_count, timed_call
+
+def open_day(context, business_date, files):
+    """
+    Функция, подготавливающая обработку дня business_date по файлам files ({тип файла: путь}): вычисляет контрольные
+    суммы файлов и считывает из манифеста загрузки достигнутые этапы. Возвращает None, если файлы дня пришли не все
+    """
+    missing = set(manifest.FILE_PATTERNS) - set(files)
+    if missing:
+        print(f"За {business_date:%d.%m.%Y} не хватает файлов: {', '.join(sorted(missing))}")
+        return None
+
+    day = {"business_date": business_date, "files": files, "checksums": {}, "stages": {}}
+    for file_type, filepath in files.items():
+        day["checksums"][file_type] = file_checksum(filepath)
+        day["stages"][file_type] = manifest.get_stage(context, filepath, day["checksums"][file_type])
+    return day
+
+def needs(day, file_type, stage):
+    """
+    Функция, проверяющая, нужно ли выполнять этап stage для файла типа file_type дня day
+    """
+    return manifest.needs(file_type, day["stages"][file_type], stage)
+
+def complete(context, day, file_type, stage, rows_loaded):
+    """
+    Функция, записывающая в манифест загрузки выполнение этапа stage для файла типа file_type дня day.
+    Возвращает False, если этап завершился ошибкой (функция этапа вернула None)
+    """
+    if rows_loaded is None:
+        print(f'Обработка файла "{day["files"][file_type]}" остановлена на этапе "{stage}"')
+        return False
+    manifest.set_stage(context, day["files"][file_type], file_type, day["business_date"],
+                       day["checksums"][file_type], stage, rows_loaded)
+    day["stages"][file_type] = stage
+    return True
+
+def run_stage(context, day, file_type, stage, func, *args, filepath=None):
+    """
+    Функция, выполняющая этап stage файла типа file_type дня day (вызов func с аргументами args) с записью
+    в метрики запуска времени выполнения и количества строк, а для этапа, читающего файл filepath, и его объема.
+    Возвращает результат func
+    """
+    with context.metrics.stage(f"{file_type}.{stage}", day["business_date"], filepath) as record:
+        record["rows"] = func(*args)
+    return record["rows"]
+
+def read_file(context, day, file_type, func):
+    """
+    Функция, разбирающая файл типа file_type дня day функцией func с записью в метрики запуска времени разбора,
+    количества строк и объема файла. В func передаются путь к файлу и его контрольная сумма, вычисленная при открытии
+    дня, чтобы файл не хэшировался повторно. Возвращает датафрейм
+    """
+    filepath = day["files"][file_type]
+    with context.metrics.stage(f"{file_type}.read", day["business_date"], filepath) as record:
+        df = func(filepath, day["checksums"][file_type])
+        record["rows"] = row_count(df)
+    return df
+
+def finish_day(context, day, window=None):
+    """
+    Функция, выполняющая общие для всех режимов завершающие этапы дня: наполнение таблицы фактов, построение отчета
+    и передачу обработанных файлов на архивацию. Отчет строится по транзакциям периода window (пара since, until),
+    а если он не передан - от водяного знака, или за период дня, если транзакции дня не новее водяного знака.
+    Возвращает True, если день обработан полностью
+    """
+    # Вызываем функцию, создающую таблицу транзакций и наполняющую ее данными ежедневно
+    if needs(day, "transactions", "loaded"):
+        rows_loaded = run_stage(context, day, "transactions", "loaded", transactions.transactions_fact, context)
+        if not complete(context, day, "transactions", "loaded", rows_loaded):
+            return False
+
+    # Вызываем функцию, создающую "витрину" данных о выявленных мошеннических операциях. День, транзакции которого
+    # не новее водяного знака, оценивается за период дня, иначе его транзакции не попали бы в отчет
+    if needs(day, "transactions", "reported"):
+        try:
+            window = window or report.staged_window(context, day["business_date"])
+        except Exception as e:
+            print(f'''При выборе периода оценки транзакций за {day["business_date"]:%d.%m.%Y} возникла ошибка {e}''')
+            return False
+        rows_loaded = run_stage(context, day, "transactions", "reported", report.report_engine(context.scoring),
+                                context, *(window or ()))
+        if not complete(context, day, "transactions", "reported", rows_loaded):
+            return False
+
+    # Передаем обработанные файлы на сжатие и перемещение в папку archive только после того, как выполнены все этапы
+    # дня. Архивация выполняется в отдельном потоке, пока загружается следующий день
+    for filepath in day["files"].values():
+        context.archive(filepath, day["business_date"])
+    return True
+
+def process_day(context, business_date, files, window=None):
+    """
+    Функция, последовательно выполняющая все этапы ежедневной загрузки дня business_date по файлам files
+    ({тип файла: путь}). Этапы, выполненные ранее для тех же файлов по данным манифеста загрузки, пропускаются,
+    поэтому после сбоя повторный запуск выполняет только недостающую работу. window - период оценки транзакций
+    при построении отчета (по умолчанию - от водяного знака). Возвращает True, если день обработан полностью
+    """
+    day = open_day(context, business_date, files)
+    if day is None:
+        return False
+
+    # Вызываем функцию, обновляющую по ежедневному срезу "историческую" таблицу о терминалах
+    if needs(day, "terminals", "merged"):
+        df = read_file(context, day, "terminals", terminals.read_terminals)
+        rows_loaded = run_stage(context, day, "terminals", "merged", terminals.terminals_increment, context, df,
+                                business_date)
+        if not complete(context, day, "terminals", "merged", rows_loaded):
+            return False
+
+    # Вызываем функцию, обновляющую по ежедневному срезу таблицу о паспортах, находящихся в "черном" списке
+    if needs(day, "passport_blacklist", "merged"):
+        df = read_file(context, day, "passport_blacklist", passports.read_passports)
+        rows_loaded = run_stage(context, day, "passport_blacklist", "merged", passports.passports_increment, context, df,
+                                business_date)
+        if not complete(context, day, "passport_blacklist", "merged", rows_loaded):
+            return False
+
+    # Вызываем функцию, загружающие ежедневные данные о транзакциях в стейдж
+    if needs(day, "transactions", "staged"):
+        rows_loaded = run_stage(context, day, "transactions", "staged", transactions.stage_transactions, context,
+                                files["transactions"], filepath=files["transactions"])
+        if not complete(context, day, "transactions", "staged", rows_loaded):
+            return False
+
+    return finish_day(context, day, window)
+
+def submit_day(executor, day):
+    """
+    Функция, передающая в пул процессов executor разбор файлов Excel дня day (терминалы и "черный список" паспортов)
+    с контрольными суммами, вычисленными при открытии дня. Каждый разбор возвращает датафрейм и время разбора
+    """
+    files, checksums = day["files"], day["checksums"]
+    return (
+        executor.submit(timed_call, terminals.read_terminals, files["terminals"], checksums["terminals"]),
+        executor.submit(timed_call, passports.read_passports, files["passport_blacklist"],
+                        checksums["passport_blacklist"])
+    )
+
+def collect_day(context, day, parsed):
+    """
+    Функция, дожидающаяся разбора файлов Excel дня day в пуле процессов и записывающая в метрики запуска время
+    разбора каждого файла. Возвращает датафреймы терминалов и "черного списка" паспортов
+    """
+    dfs = []
+    for file_type, future in zip(("terminals", "passport_blacklist"), parsed):
+        df, seconds = future.result()
+        context.metrics.add_stage(f"{file_type}.read", day["business_date"], seconds, row_count(df),
+                                  day["files"][file_type])
+        dfs.append(df)
+    return dfs
+
+def run_parallel(context, days, workers=3):
+    """
+    Функция, выполняющая ежедневную загрузку списка дней days (пар из даты и словаря файлов дня) в параллельном режиме:
+    файлы Excel дня разбираются в пуле из workers процессов, а разбор файлов следующего дня выполняется, пока в DWH
+    загружается текущий день. Файл транзакций загружается в стейдж порциями прямо из файла в потоке загрузки,
+    одновременно с обновлением истории терминалов и паспортов, поэтому не передается между процессами целиком. Запись в DWH и построение отчета выполняются
+    строго в порядке следования дней, этапы, отмеченные в манифесте загрузки как выполненные, пропускаются
+    """
+    if not days:
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as parsers, ThreadPoolExecutor(max_workers=3) as loaders:
+        day = open_day(context, *days[0])
+        parsed = submit_day(parsers, day) if day else None
+
+        for i in range(len(days)):
+            if day is None:
+                break
+            terminals_df, passports_df = collect_day(context, day, parsed)
+
+            # Запускаем разбор файлов следующего дня, пока текущий день загружается в базу данных
+            next_day = open_day(context, *days[i + 1]) if i + 1 < len(days) else None
+            if next_day:
+                parsed = submit_day(parsers, next_day)
+
+            # Обновляем историю терминалов и "черный список" паспортов и загружаем транзакции в стейдж одновременно:
+            # все три источника пишут в разные таблицы
+            staged = {}
+            if needs(day, "terminals", "merged"):
+                staged["terminals", "merged"] = loaders.submit(
+                    run_stage, context, day, "terminals", "merged", terminals.terminals_increment, context, terminals_df,
+                    day["business_date"])
+            if needs(day, "passport_blacklist", "merged"):
+                staged["passport_blacklist", "merged"] = loaders.submit(
+                    run_stage, context, day, "passport_blacklist", "merged", passports.passports_increment, context,
+                    passports_df, day["business_date"])
+            if needs(day, "transactions", "staged"):
+                staged["transactions", "staged"] = loaders.submit(
+                    run_stage, context, day, "transactions", "staged", transactions.stage_transactions, context,
+                    day["files"]["transactions"], filepath=day["files"]["transactions"])
+
+            results = [complete(context, day, file_type, stage, future.result())
+                       for (file_type, stage), future in staged.items()]
+            del terminals_df, passports_df
+
+            # Наполняем таблицу фактов и строим отчет только после того, как загружены все источники дня
+            if not all(results) or not finish_day(context, day):
+                break
+            day = next_day
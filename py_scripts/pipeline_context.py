@@ -0,0 +1,148 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extensions import cursor as base_cursor
+
+from . import metrics
+
+class PipelineContext:
+    """
+    Класс, хранящий единый на весь запуск пул соединений с базой данных с параметрами подключения, указанными
+    в credentials, и настройки загрузки, и передаваемый во все этапы загрузки. partition_by задает секционирование
+    таблицы фактов транзакций: "day", "month" или None. scoring задает движок построения отчета о мошеннических
+    операциях: "sql" (запрос в базе данных) или "python" (векторная оценка в памяти). В metrics накапливаются
+    метрики этапов и команд sql запуска, explain включает сохранение планов выполнения основных команд
+    """
+    def __init__(self, credentials, pool_size=5, max_overflow=5, partition_by="month", explain=False, scoring="sql"):
+        self.credentials = credentials
+        self.partition_by = partition_by
+        self.scoring = scoring
+        self.metrics = metrics.Metrics(explain=explain)
+        metrics.ACTIVE = self.metrics
+
+        # Пул соединений psycopg2: соединения открываются по требованию, одновременно выдается не больше
+        # pool_size + max_overflow соединений, между этапами сохраняется не больше pool_size соединений.
+        # Курсоры всех соединений пула замеряют время выполнения команд
+        self.pool_size = pool_size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(pool_size + max_overflow)
+        self.archiver = None
+
+    def connect(self):
+        """
+        Функция, открывающая новое соединение с базой данных
+        """
+        return psycopg2.connect(
+            host=self.credentials["host"],
+            user=self.credentials["user"],
+            password=self.credentials["password"],
+            port=self.credentials["port"],
+            dbname=self.credentials["dbname"],
+            cursor_factory=metrics.TimedCursor
+        )
+
+    @staticmethod
+    def alive(connection):
+        """
+        Функция, проверяющая перед выдачей из пула, что соединение не разорвано сервером
+        """
+        try:
+            with connection.cursor(cursor_factory=base_cursor) as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self):
+        """
+        Функция, выдающая соединение из пула. Если выданы все соединения, ожидает возврата одного из них
+        """
+        self.slots.acquire()
+        try:
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            if connection is not None and not self.alive(connection):
+                connection.close()
+                connection = None
+            return connection or self.connect()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, connection):
+        """
+        Функция, возвращающая соединение в пул. Соединения сверх pool_size закрываются
+        """
+        with self.lock:
+            keep = not connection.closed and len(self.idle) < self.pool_size
+            if keep:
+                self.idle.append(connection)
+        if not keep:
+            connection.close()
+        self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Функция, выдающая соединение psycopg2 из пула. При успешном завершении блока транзакция фиксируется,
+        при ошибке откатывается, после чего соединение возвращается в пул. Время ожидания соединения записывается
+        в метрики этапа
+        """
+        start = time.perf_counter()
+        connection = self.acquire()
+        self.metrics.connection_wait(time.perf_counter() - start)
+        try:
+            yield connection
+            connection.commit()
+        except Exception:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            self.release(connection)
+
+    def archive(self, filepath, business_date=None):
+        """
+        Функция, передающая обработанный файл filepath дня business_date на сжатие и перемещение в каталог archive
+        в отдельном потоке. Поток архивации запускается при первом обращении
+        """
+        if self.archiver is None:
+            from .archiver import Archiver
+            self.archiver = Archiver(self.metrics)
+        self.archiver.submit(filepath, business_date)
+
+    def wait_archived(self):
+        """
+        Функция, ожидающая архивации всех переданных на архивацию файлов
+        """
+        if self.archiver is not None:
+            self.archiver.join()
+
+    def init_schemas(self):
+        """
+        Функция, однократно при запуске создающая схемы STG и DWH, если их нет. Возвращает True, если схемы созданы
+        """
+        try:
+            with self.connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("CREATE SCHEMA IF NOT EXISTS STG")
+                    cursor.execute("CREATE SCHEMA IF NOT EXISTS DWH")
+            return True
+
+        except Exception as e:
+            print(f'''При выполнении функции "init_schemas" возникла ошибка {e}''')
+
+    def close(self):
+        """
+        Функция, дожидающаяся архивации обработанных файлов и закрывающая все соединения пула по окончании запуска
+        """
+        if self.archiver is not None:
+            self.archiver.close()
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
@@ -1,139 +1,332 @@
-import psycopg2
+from datetime import datetime, time, timedelta
 
-def create_report(credentials):
-    """"
-    Функция, создающая таблицу-отчет о выявленных мошеннических операциях    
+from . import fraud_rules
+
+def drop_legacy_view(context):
+    """
+    Функция, удаляющая представление dwh.transactions_full, которое создавала прежняя версия построения отчета.
+    Представление читает текстовые поля типа и результата операции таблицы фактов и не дает заменить их кодами,
+    поэтому удаляется до обновления таблицы фактов
     """
     try:
-        connection = psycopg2.connect(**credentials)
-        cursor = connection.cursor()
-    
-        cursor.execute("""
-            SET SEARCH_PATH TO DWH;
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS rep_fraud(
-                event_dt TIMESTAMP,
-                passport VARCHAR(128),
-                fio VARCHAR(128),
-                event_type VARCHAR,
-                report_dt TIMESTAMP DEFAULT current_timestamp
-            );       
-        """)
-
-        cursor.execute("DROP VIEW IF EXISTS transactions_full;")
-        cursor.execute("""
-            CREATE VIEW transactions_full AS
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP VIEW IF EXISTS dwh.transactions_full")
+        return True
+
+    except Exception as e:
+        print(f'''При выполнении функции "drop_legacy_view" возникла ошибка {e}''')
+
+def create_report_tables(context):
+    """
+    Функция, создающая таблицу-отчет о выявленных мошеннических операциях и таблицу, хранящую дату и время
+    последней транзакции, учтенной в отчете (водяной знак инкрементального построения отчета)
+    """
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS dwh.rep_fraud(
+                        event_dt TIMESTAMP,
+                        passport VARCHAR(128),
+                        fio VARCHAR(128),
+                        event_type VARCHAR,
+                        report_dt TIMESTAMP DEFAULT current_timestamp
+                    );
+                """)
+
+                # Идентификатор транзакции позволяет обновлять строки отчета при повторной обработке дня без дублей
+                cursor.execute("ALTER TABLE dwh.rep_fraud ADD COLUMN IF NOT EXISTS trans_id VARCHAR(128)")
+                cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS rep_fraud_trans_id_uidx ON dwh.rep_fraud(trans_id)")
+
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS dwh.rep_fraud_watermark(
+                        report_name VARCHAR(64) PRIMARY KEY,
+                        last_trans_date TIMESTAMP,
+                        update_dt TIMESTAMP DEFAULT current_timestamp
+                    );
+                """)
+                # Водяной знак, на котором сохранен хвост операций карт (контрольная точка оценки)
+                cursor.execute("ALTER TABLE dwh.rep_fraud_watermark ADD COLUMN IF NOT EXISTS checkpoint_dt TIMESTAMP")
+
+                # Хвост операций карт: операции за глубину истории правил до водяного знака с городом терминала,
+                # с которых правила продолжают оценку следующего дня без повторного чтения истории из таблицы фактов
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS dwh.rep_fraud_checkpoint(
+                        trans_id VARCHAR(128),
+                        trans_date TIMESTAMP,
+                        card_num VARCHAR(128),
+                        card_key BIGINT,
+                        oper_type VARCHAR(16),
+                        amt DECIMAL,
+                        oper_result VARCHAR(16),
+                        terminal_city VARCHAR(64)
+                    );
+                """)
+        return True
+
+    except Exception as e:
+        print(f'''При выполнении функции "create_report_tables" возникла ошибка {e}''')
+
+# Операции, оцениваемые при построении отчета: транзакции позже since (и не позже until, если он задан) и история
+# до since, необходимая правилам (самая длинная глубина истории в реестре правил). Транзакция соединяется с версией терминала, действовавшей в момент ее совершения,
+# поэтому повторная оценка прошлых дней дает тот же результат, что и ежедневная
+TRANSACTIONS_SOURCE = f"""
+    SELECT
+        t1.trans_id,
+        t1.trans_date,
+        t1.card_num,
+        t1.card_key,
+        t3.oper_type,
+        t1.amt,
+        t4.oper_result,
+        t2.terminal_city,
+        t1.trans_date > COALESCE(%(since)s::TIMESTAMP, '-infinity') AS scored
+    FROM dwh_fact_transactions t1
+    INNER JOIN dwh_dim_terminals_hist t2
+    ON t1.terminal=t2.terminal_id
+    AND t2.valid_period @> t1.trans_date
+    AND t2.deleted_flg=0
+    LEFT JOIN dwh_dim_oper_types t3
+    ON t1.oper_type_id=t3.oper_type_id
+    LEFT JOIN dwh_dim_oper_results t4
+    ON t1.oper_result_id=t4.oper_result_id
+    WHERE t1.trans_date >= COALESCE(%(since)s::TIMESTAMP, '-infinity') - {fraud_rules.history()}
+    AND t1.trans_date <= COALESCE(%(until)s::TIMESTAMP, 'infinity')
+"""
+
+# Операции, оцениваемые при построении отчета, если на водяном знаке since сохранена контрольная точка: история
+# правил берется из хвоста операций карт, а из таблицы фактов считываются только новые транзакции
+CHECKPOINT_SOURCE = f"""
+    SELECT
+        trans_id,
+        trans_date,
+        card_num,
+        card_key,
+        oper_type,
+        amt,
+        oper_result,
+        terminal_city,
+        FALSE AS scored
+    FROM rep_fraud_checkpoint
+    UNION ALL
+    SELECT * FROM ({TRANSACTIONS_SOURCE}) t
+    WHERE t.scored
+"""
+
+def scoring_source(cursor, since):
+    """
+    Функция, выбирающая запрос операций, оцениваемых при построении отчета: если контрольная точка сохранена
+    на водяном знаке since, история правил берется из нее, иначе - из таблицы фактов
+    """
+    if since is not None:
+        cursor.execute("SELECT checkpoint_dt FROM rep_fraud_watermark WHERE report_name = 'rep_fraud'")
+        row = cursor.fetchone()
+        if row and row[0] == since:
+            return CHECKPOINT_SOURCE
+    return TRANSACTIONS_SOURCE
+
+def save_checkpoint(cursor, source, since, until=None):
+    """
+    Функция, сохраняющая контрольную точку на текущем водяном знаке: операции запроса source (с параметрами since
+    и until) за самую длинную глубину истории правил до водяного знака. Если водяной знак позже until (период оценен
+    повторно), запрос не содержит операций перед ним, и контрольная точка сбрасывается
+    """
+    cursor.execute("SELECT last_trans_date FROM rep_fraud_watermark WHERE report_name = 'rep_fraud'")
+    row = cursor.fetchone()
+    watermark = row[0] if row else None
+    if watermark is None or (until is not None and watermark > until):
+        cursor.execute("UPDATE rep_fraud_watermark SET checkpoint_dt = NULL WHERE report_name = 'rep_fraud'")
+        return
+
+    # Хвост считывается до удаления старой контрольной точки: все части команды видят один снимок данных
+    cursor.execute(f"""
+        WITH tail AS (
+            SELECT trans_id, trans_date, card_num, card_key, oper_type, amt, oper_result, terminal_city
+            FROM ({source}) t
+            WHERE trans_date >= %(watermark)s::TIMESTAMP - {fraud_rules.history()}
+        ), removed AS (
+            DELETE FROM rep_fraud_checkpoint
+        )
+        INSERT INTO rep_fraud_checkpoint
+        SELECT * FROM tail
+    """, {"since": since, "until": until, "watermark": watermark})
+    cursor.execute("""
+        UPDATE rep_fraud_watermark SET checkpoint_dt = last_trans_date WHERE report_name = 'rep_fraud'
+    """)
+
+def fraud_query(source):
+    """
+    Функция, формирующая запрос, оценивающий по правилам реестра fraud_rules.RULES транзакции запроса source
+    и возвращающий строки отчета. Правила вычисляются независимо за один проход по операциям карт с общими
+    именованными окнами, и в расшифровку попадают все выполненные правила. Запрос source возвращает транзакции
+    с городом терминала и признаком scored, отмечающим транзакции, которые попадают в отчет (остальные служат
+    историей для правил)
+    """
+    return f"""
+        WITH transactions_full AS (
             SELECT
+                t1.trans_id,
                 t1.trans_date,
-                t1.card_num,
-                t1.oper_type,
-                t1.amt,
-                t1.oper_result,
-                t2.account,
-                t3.valid_to,
+                t1.scored,
                 t4.passport_num,
-                t4.passport_valid_to,
                 CONCAT_WS(' ', t4.last_name, t4.first_name, t4.patronymic) AS fio,
-                t4.phone AS phone,
-                CASE 
-                    /*
-                    Формирование условия для поиска операциий, совершенных при недействующем паспорте
-                    или паспорте, занесенном в черный список
-                    WHEN
-                        DATE_TRUNC('day',t1.trans_date) > t4.passport_valid_to::TIMESTAMP
-                        OR t4.passport_num in (SELECT passport_num FROM dwh.dwh_fact_passport_blacklist)
-                    THEN 0 | (1<<0)
-                    */
-                    WHEN
-                        DATE_TRUNC('day',t1.trans_date) > t3.valid_to::TIMESTAMP
-                    THEN 0 | (1<<1)                    
-                    /*
-                    Формирование условия для поиска операциий, совершенных при недействующем договоре
-                    */
-                    WHEN
-                        DATE_TRUNC('day',t1.trans_date) > t3.valid_to::TIMESTAMP
-                    THEN 0 | (1<<1)
-                    /*
-                    Формирование условия для поиска операциий, совершенных в разных городах в течение часа
-                    */
-                    WHEN                 
-                        (SELECT
-                            COUNT(DISTINCT t55.terminal_city)
-                        FROM dwh_fact_transactions t11
-                        INNER JOIN dwh_dim_terminals_hist t55
-                        ON t11.terminal=t55.terminal_id
-                        AND t55.deleted_flg=0
-                        AND current_timestamp BETWEEN t55.effective_from AND t55.effective_to
-                        WHERE t11.card_num=t1.card_num
-                        AND t11.trans_date BETWEEN t1.trans_date - INTERVAL '1' HOUR
-                        AND t1.trans_date) > 1
-                    THEN 0 | (1<<2)
-                    /* 
-                    Формирование условия для поска 3 операций, совершенных в течене 20 минут,
-                    со следующим  шаблоном: каждая последующая меньше предыдущей, при этом отклонены
-                    все кроме последней
-                    */ 
-                    WHEN 
-                        (LAG(t1.amt, 2) OVER (PARTITION BY t1.card_num ORDER BY t1.trans_date) - 
-                        LAG(t1.amt, 1) OVER (PARTITION BY t1.card_num ORDER BY t1.trans_date) > 0) 
-                        AND 
-                        (LAG(t1.amt, 1) OVER (PARTITION BY t1.card_num ORDER BY t1.trans_date) - 
-                        t1.amt > 0)
-                        AND (t1.trans_date - 
-                        LAG(t1.trans_date, 2) OVER (PARTITION BY t1.card_num ORDER BY t1.trans_date) <= INTERVAL '20' MINUTE) 
-                        AND 
-                        (LAG(t1.oper_result, 2) OVER (PARTITION BY t1.card_num ORDER BY t1.trans_date) = 'REJECT')
-                        AND 
-                        (LAG(t1.oper_result, 1) OVER (PARTITION BY t1.card_num ORDER BY t1.trans_date) = 'REJECT')
-                        AND 
-                        (t1.oper_result = 'SUCCESS')
-                        AND
-                        (LAG(t1.oper_type, 2) OVER (PARTITION BY t1.card_num ORDER BY t1.trans_date) != 'DEPOSIT')
-                        AND 
-                        (LAG(t1.oper_type, 1) OVER (PARTITION BY t1.card_num ORDER BY t1.trans_date) != 'DEPOSIT')
-                        AND 
-                        (t1.oper_type != 'DEPOSIT')                        
-                    THEN 0 | (1<<3)
-                    ELSE 0
-                END AS fraud_type,
-                t5.terminal_city
-            FROM dwh_fact_transactions t1
+                -- Признак мошеннической операции: биты всех выполненных правил реестра fraud_rules.RULES
+                {fraud_rules.compile_fraud_type()} AS fraud_type
+            FROM ({source}) t1
             INNER JOIN dwh_dim_cards t2
-            ON REGEXP_REPLACE(t1.card_num, '\\s', '', 'g')::BIGINT=REGEXP_REPLACE(t2.card_num, '\\s', '', 'g')::BIGINT
+            ON t1.card_key=t2.card_key
             INNER JOIN dwh_dim_accounts t3
             ON t2.account=t3.account
             INNER JOIN dwh_dim_clients t4
-            ON LOWER(t3.client)=LOWER(t4.client_id)
-            INNER JOIN dwh_dim_terminals_hist t5
-            ON t1.terminal=t5.terminal_id
-            AND t5.deleted_flg=0
-            AND current_timestamp BETWEEN t5.effective_from AND t5.effective_to
-            WHERE t1.trans_date>=(SELECT 
-                                    MAX(DATE_TRUNC('day', trans_date)) - INTERVAL '1' HOUR  
-                                  FROM dwh_fact_transactions);
-        """)
-        cursor.execute("""
-            INSERT INTO rep_fraud(event_dt, passport, fio, event_type)
-            SELECT
-                trans_date,
-                passport_num,
-                fio,
-                CONCAT_WS(', ' ,
-                    CASE WHEN (fraud_type & (1<<0)) != 0 THEN 'просроченный или заблокированный паспорт' END,
-                    CASE WHEN (fraud_type & (1<<1)) != 0 THEN 'простроченный договор' END,
-                    CASE WHEN (fraud_type & (1<<2)) != 0 THEN 'операции в разных городах в течение часа' END,
-                    CASE WHEN (fraud_type & (1<<3)) != 0 THEN 'операции подбора суммы' END
-                ) AS event_type
-            FROM transactions_full
-            WHERE trans_date >= (SELECT 
-                                    MAX(DATE_TRUNC('day', trans_date)) 
-                                FROM dwh_fact_transactions)
-            AND fraud_type != 0;
-        """)
-        connection.commit()
-        cursor.close()
-        connection.close()
+            ON t3.client_key=t4.client_key
+            LEFT JOIN dwh_dim_passport_blacklist_current t5
+            ON t4.passport_num=t5.passport_num
+            {fraud_rules.compile_windows()}
+        )
+        SELECT DISTINCT ON (trans_id)
+            trans_id,
+            trans_date,
+            passport_num,
+            fio,
+            {fraud_rules.compile_event_type()} AS event_type
+        FROM transactions_full
+        WHERE scored
+        AND fraud_type != 0
+    """
+
+def report_query(source):
+    """
+    Функция, формирующая команду, добавляющую в отчет мошеннические операции, найденные среди транзакций запроса source.
+    Строки отчета по уже учтенным транзакциям обновляются
+    """
+    return f"""
+        INSERT INTO rep_fraud(trans_id, event_dt, passport, fio, event_type)
+        {fraud_query(source)}
+        ON CONFLICT (trans_id) DO UPDATE
+        SET event_dt = EXCLUDED.event_dt,
+            passport = EXCLUDED.passport,
+            fio = EXCLUDED.fio,
+            event_type = EXCLUDED.event_type,
+            report_dt = current_timestamp;
+    """
+
+def day_window(business_date):
+    """
+    Функция, возвращающая период оценки транзакций дня business_date (since, until): все транзакции дня оцениваются
+    независимо от водяного знака
+    """
+    return datetime.combine(business_date, time.min) - timedelta(microseconds=1), datetime.combine(business_date, time.max)
+
+def staged_window(context, business_date):
+    """
+    Функция, выбирающая период оценки транзакций дня business_date, загруженных в стейдж. Если день не новее водяного
+    знака (пришел с опозданием или его файл прислан повторно с исправлениями), инкрементальная оценка от водяного знака
+    его транзакции не увидит, и они оцениваются за период дня. Для дней, строго более новых, чем водяной знак,
+    возвращает None: отчет строится от водяного знака с контрольной точкой
+    """
+    with context.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(transaction_date) FROM stg.stg_transactions")
+            first_trans_date = cursor.fetchone()[0]
+            cursor.execute("SELECT last_trans_date FROM dwh.rep_fraud_watermark WHERE report_name = 'rep_fraud'")
+            row = cursor.fetchone()
+    watermark = row[0] if row else None
+    if first_trans_date is None or watermark is None or first_trans_date > watermark:
+        return None
+    return day_window(business_date)
+
+def remove_unflagged(cursor, since, until=None):
+    """
+    Функция, удаляющая из отчета строки по транзакциям, совершенным позже since и не позже until, которые при
+    повторной оценке не признаны мошенническими (например, после исправления данных или изменения правил).
+    Вызывается в той же транзакции после записи строк отчета: строки, записанные в ней, имеют report_dt, равный
+    времени начала транзакции current_timestamp, а остальные строки оцененного периода - более раннее время.
+    Возвращает количество удаленных строк
+    """
+    cursor.execute("""
+        DELETE FROM rep_fraud t1
+        USING dwh_fact_transactions t2
+        WHERE t1.trans_id = t2.trans_id
+        AND t2.trans_date > COALESCE(%(since)s::TIMESTAMP, '-infinity')
+        AND t2.trans_date <= COALESCE(%(until)s::TIMESTAMP, 'infinity')
+        AND t1.report_dt < current_timestamp
+    """, {"since": since, "until": until})
+    return cursor.rowcount
+
+def update_watermark(cursor, since, until=None):
+    """
+    Функция, сдвигающая водяной знак отчета на последнюю транзакцию, совершенную позже since и не позже until
+    """
+    cursor.execute("""
+        INSERT INTO rep_fraud_watermark(report_name, last_trans_date)
+        SELECT 'rep_fraud', MAX(trans_date)
+        FROM dwh_fact_transactions
+        WHERE trans_date > COALESCE(%(since)s::TIMESTAMP, '-infinity')
+        AND trans_date <= COALESCE(%(until)s::TIMESTAMP, 'infinity')
+        HAVING MAX(trans_date) IS NOT NULL
+        ON CONFLICT (report_name) DO UPDATE
+        SET last_trans_date = GREATEST(rep_fraud_watermark.last_trans_date, EXCLUDED.last_trans_date),
+            update_dt = current_timestamp;
+    """, {"since": since, "until": until})
+
+def read_watermark(context):
+    """
+    Функция, возвращающая водяной знак отчета и водяной знак, на котором сохранена контрольная точка
+    (или None, если отчет еще не строился)
+    """
+    with context.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT last_trans_date, checkpoint_dt FROM dwh.rep_fraud_watermark WHERE report_name = 'rep_fraud'
+            """)
+            return cursor.fetchone()
+
+def report_engine(scoring):
+    """
+    Функция, возвращающая функцию построения отчета движка scoring: "sql" (запрос в базе данных) или "python"
+    (векторная оценка в памяти). Модуль движка python импортируется только при его выборе, чтобы построение отчета
+    запросом не тратило время на импорт pandas
+    """
+    if scoring == "python":
+        from . import fraud_engine
+        return fraud_engine.create_report
+    return create_report
+
+def create_report(context, since=None, until=None):
+    """"
+    Функция, инкрементально наполняющая таблицу-отчет о выявленных мошеннических операциях. Оцениваются только
+    транзакции, совершенные позже водяного знака (или позже since, если он передан) и не позже until, с учетом
+    истории, необходимой правилам поиска мошеннических операций. Возвращает количество добавленных или обновленных
+    строк отчета
+    """
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SET LOCAL SEARCH_PATH TO DWH;
+                """)
+
+                # Получаем дату и время последней транзакции, учтенной в отчете при предыдущем запуске
+                if since is None:
+                    cursor.execute("SELECT last_trans_date FROM rep_fraud_watermark WHERE report_name = 'rep_fraud'")
+                    row = cursor.fetchone()
+                    since = row[0] if row else None
+
+                params = {"since": since, "until": until}
+                source = scoring_source(cursor, since)
+                query = report_query(source)
+                # Сохраняем план выполнения построения отчета, если это включено в параметрах запуска
+                context.metrics.explain(cursor, "create_report", query, params)
+                cursor.execute(query, params)
+                rows_reported = cursor.rowcount
+                # Удаляем строки отчета по оцененным транзакциям, которые больше не признаются мошенническими,
+                # чтобы повторная оценка периода давала тот же отчет, что и первая
+                remove_unflagged(cursor, since, until)
+
+                # Сдвигаем водяной знак на последнюю транзакцию, учтенную в отчете, и сохраняем на нем контрольную точку
+                update_watermark(cursor, since, until)
+                save_checkpoint(cursor, source, since, until)
+                return rows_reported
     except Exception as e:
-        print(f'При попытке подключения к базе данных "{credentials["dbname"]}" возникла ошибка {e}')
\ No newline at end of file
+        print(f'При попытке подключения к базе данных "{context.credentials["dbname"]}" возникла ошибка {e}')
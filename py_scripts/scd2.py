@@ -0,0 +1,159 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+# Дата окончания действия открытой (действующей) версии записи
+OPEN_EFFECTIVE_TO = "5999-12-31 23:59:59"
+
+# Описание измерений, история которых ведется по SCD2: таблица DWH, бизнес-ключ, хранимые атрибуты, отслеживаемые
+# атрибуты (изменение которых порождает новую версию) и переименование полей файла-источника в поля таблицы.
+# Если задана таблица current_table, в ней в той же транзакции поддерживается текущее состояние измерения
+# (только действующие записи, по одной на ключ). Подключение нового источника сводится к добавлению описания
+# в этот словарь
+DIMENSIONS = {
+    "terminals": {
+        "table": "dwh.dwh_dim_terminals_hist",
+        "key": "terminal_id",
+        "columns": ["terminal_type", "terminal_city", "terminal_address"],
+        "tracked": ["terminal_type", "terminal_city", "terminal_address"],
+        "rename": {}
+    },
+    "passports": {
+        "table": "dwh.dwh_fact_passport_blacklist",
+        "key": "passport_num",
+        "columns": ["entry_dt"],
+        "tracked": [],
+        "rename": {"passport": "passport_num", "date": "entry_dt"},
+        "current_table": "dwh.dwh_dim_passport_blacklist_current"
+    }
+}
+
+def row_hash(df, columns):
+    """
+    Функция, векторно вычисляющая хэш отслеживаемых атрибутов columns для каждой строки датафрейма df.
+    Значения приводятся к строкам, чтобы данные из файла и из базы данных сравнивались независимо от их типов
+    """
+    if not columns:
+        return np.zeros(len(df), dtype="uint64")
+    return pd.util.hash_pandas_object(df[columns].astype("string"), index=False).to_numpy()
+
+def current_snapshot(context, config):
+    """
+    Функция, считывающая из DWH действующие версии записей измерения, описанного в config
+    """
+    columns = [config["key"]] + config["columns"]
+    with context.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT {", ".join(columns)}
+                FROM {config["table"]}
+                WHERE effective_to = '{OPEN_EFFECTIVE_TO}'::TIMESTAMP
+                AND deleted_flg = 0
+            """)
+            return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+def scd2_delta(config, snapshot, current):
+    """
+    Функция, сравнивающая полный срез snapshot из файла с действующими версиями current и возвращающая датафрейм
+    изменений с полем "change_type": N - новая запись, D - удаленная запись, U - запись с измененными атрибутами
+    """
+    key, columns = config["key"], config["columns"]
+
+    snapshot = snapshot.assign(row_hash=row_hash(snapshot, config["tracked"]))
+    current = current.assign(row_hash=row_hash(current, config["tracked"]))
+    snapshot[key] = snapshot[key].astype("string")
+    current[key] = current[key].astype("string")
+
+    merged = snapshot.merge(current, on=key, how="outer", suffixes=("", "_current"), indicator=True)
+
+    new = merged["_merge"] == "left_only"
+    deleted = merged["_merge"] == "right_only"
+    updated = (merged["_merge"] == "both") & (merged["row_hash"] != merged["row_hash_current"])
+
+    # Для удаленных записей сохраняются значения атрибутов их последней действующей версии
+    for column in columns:
+        merged.loc[deleted, column] = merged.loc[deleted, f"{column}_current"]
+
+    merged["change_type"] = np.select([new, deleted, updated], ["N", "D", "U"], default="")
+    return merged.loc[merged["change_type"] != "", [key] + columns + ["change_type"]]
+
+def sync_current(cursor, config):
+    """
+    Функция, применяющая изменения временной таблицы tmp_scd2_delta к таблице текущего состояния измерения,
+    описанного в config: удаленные записи удаляются, новые и измененные добавляются или обновляются
+    """
+    key, columns, current_table = config["key"], config["columns"], config["current_table"]
+    cursor.execute(f"""
+        DELETE FROM {current_table} t1
+        USING tmp_scd2_delta t2
+        WHERE t1.{key} = t2.{key}
+        AND t2.change_type = 'D'
+    """)
+    update = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns)
+    cursor.execute(f"""
+        INSERT INTO {current_table} ({", ".join([key] + columns)})
+        SELECT DISTINCT ON ({key}) {", ".join([key] + columns)}
+        FROM tmp_scd2_delta
+        WHERE change_type IN ('N', 'U')
+        ON CONFLICT ({key}) DO {f"UPDATE SET {update}" if columns else "NOTHING"}
+    """)
+
+def scd2_merge(context, config, snapshot, effective_dt=None):
+    """
+    Функция, обновляющая по SCD2 историю измерения, описанного в config, по полному срезу snapshot, считанному
+    из файла. Изменения вычисляются в памяти, а в базу данных, соединение с которой предоставляет context,
+    одной командой COPY передаются только строки изменений. effective_dt - бизнес-дата среза, с которой действуют
+    новые версии (предыдущие версии закрываются секундой раньше); если она не передана, используется текущее время
+    """
+    key, columns, table = config["key"], config["columns"], config["table"]
+
+    snapshot = snapshot.rename(columns=config["rename"])[[key] + columns]
+    delta = scd2_delta(config, snapshot, current_snapshot(context, config))
+    if delta.empty:
+        return 0
+
+    with context.connection() as connection:
+        with connection.cursor() as cursor:
+            # Создаем временную таблицу изменений с типами полей таблицы измерения, удаляемую по окончании транзакции
+            cursor.execute(f"""
+                CREATE TEMP TABLE tmp_scd2_delta ON COMMIT DROP AS
+                SELECT {", ".join([key] + columns)} FROM {table} WITH NO DATA
+            """)
+            cursor.execute("ALTER TABLE tmp_scd2_delta ADD COLUMN change_type CHAR(1)")
+
+            buffer = io.StringIO()
+            delta.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert("COPY tmp_scd2_delta FROM STDIN WITH (FORMAT csv)", buffer)
+
+            # Закрываем действующие версии удаленных и измененных записей
+            close_versions = f"""
+                UPDATE {table} t1
+                SET effective_to = COALESCE(%(effective_dt)s::TIMESTAMP, current_timestamp) - INTERVAL '1 second'
+                FROM tmp_scd2_delta t2
+                WHERE t1.{key} = t2.{key}
+                AND t2.change_type IN ('D', 'U')
+                AND t1.effective_to = '{OPEN_EFFECTIVE_TO}'::TIMESTAMP
+            """
+            params = {"effective_dt": effective_dt}
+            context.metrics.explain(cursor, f"scd2_close_versions:{table}", close_versions, params)
+            cursor.execute(close_versions, params)
+
+            # Добавляем версии новых и измененных записей и отметки об удалении записей
+            insert_versions = f"""
+                INSERT INTO {table} ({", ".join([key] + columns)}, effective_from, deleted_flg)
+                SELECT
+                    {", ".join([key] + columns)},
+                    COALESCE(%(effective_dt)s::TIMESTAMP, current_timestamp),
+                    CASE WHEN change_type = 'D' THEN 1 ELSE 0 END
+                FROM tmp_scd2_delta
+            """
+            context.metrics.explain(cursor, f"scd2_insert_versions:{table}", insert_versions, params)
+            cursor.execute(insert_versions, params)
+
+            # Обновляем таблицу текущего состояния измерения в той же транзакции, что и историю
+            if config.get("current_table"):
+                sync_current(cursor, config)
+
+    return len(delta)
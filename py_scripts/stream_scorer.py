@@ -0,0 +1,308 @@
+import io
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from . import fraud_rules, scd2
+from .fraud_engine import CITY_WINDOW, GUESSING_WINDOW
+from .transactions import kopecks
+
+# Поля строки файла транзакций в порядке их следования
+FIELDS = ["transaction_id", "transaction_date", "amount", "card_num", "oper_type", "oper_result", "terminal"]
+
+class CardState:
+    """
+    Класс, хранящий компактное состояние карты, достаточное правилам поиска мошеннических операций: две последние
+    операции карты (время, сумма, результат и тип операции) для правила подбора суммы, город и время последней
+    операции и время последней операции в другом городе для правила операций в разных городах в течение часа
+    """
+    __slots__ = ("recent", "city", "last_time", "other_time")
+
+    def __init__(self):
+        self.recent = deque(maxlen=2)
+        self.city = None
+        self.last_time = None
+        self.other_time = None
+
+def multi_city(state, trans_date, city):
+    """
+    Функция, проверяющая, была ли по карте в течение часа до операции trans_date операция в городе, отличном от city,
+    и обновляющая состояние карты state. Время последней операции в другом городе достаточно, чтобы проверить правило
+    без хранения всех операций карты за час
+    """
+    if city is None:
+        return False
+    if state.city is None or state.city == city:
+        flagged = state.other_time is not None and trans_date - state.other_time <= CITY_WINDOW
+    else:
+        flagged = trans_date - state.last_time <= CITY_WINDOW
+        state.other_time = state.last_time
+    state.city = city
+    state.last_time = trans_date
+    return flagged
+
+def amount_guessing(state, trans_date, amount, oper_result, oper_type):
+    """
+    Функция, проверяющая, завершает ли операция шаблон подбора суммы: три операции подряд по карте за 20 минут,
+    каждая следующая меньше предыдущей, отклонены все кроме последней, - и добавляющая операцию в состояние карты state
+    """
+    flagged = (
+        len(state.recent) == 2
+        and oper_result == "SUCCESS"
+        and oper_type != "DEPOSIT"
+        and trans_date - state.recent[0][0] <= GUESSING_WINDOW
+        and state.recent[0][1] > state.recent[1][1] > amount
+        and all(result == "REJECT" and kind != "DEPOSIT" for _, _, result, kind in state.recent)
+    )
+    state.recent.append((trans_date, amount, oper_result, oper_type))
+    return flagged
+
+class StreamScorer:
+    """
+    Класс, оценивающий транзакции по мере их поступления по правилам операций в разных городах в течение часа
+    и подбора суммы. Для каждой карты хранится только ее компактное состояние (CardState), поэтому оценка операции
+    не требует обращения к базе данных. Найденные операции записываются в отчет пакетами: когда накоплено batch_size
+    строк или с момента первой ненаписанной строки прошло flush_interval секунд
+    """
+    def __init__(self, context, batch_size=500, flush_interval=0.1, refresh_interval=60.0):
+        self.context = context
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.cards = {}
+        self.alerts = []
+        self.first_alert = None
+        self.scored = 0
+        self.skipped = 0
+        self.reported = 0
+        self.terminals = {}
+        self.terminals_loaded = None
+        self.stopping = threading.Event()
+
+    def load_terminals(self):
+        """
+        Функция, считывающая города действующих терминалов в словарь {идентификатор терминала: город}
+        """
+        with self.context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT terminal_id, terminal_city
+                    FROM dwh.dwh_dim_terminals_hist
+                    WHERE effective_to = '{scd2.OPEN_EFFECTIVE_TO}'::TIMESTAMP
+                    AND deleted_flg = 0
+                """)
+                self.terminals = dict(cursor.fetchall())
+        self.terminals_loaded = time.monotonic()
+
+    def load_checkpoint(self):
+        """
+        Функция, восстанавливающая состояние карт по контрольной точке ежедневного отчета - операциям карт за час
+        до его водяного знака, чтобы правила учитывали операции, совершенные до начала потоковой оценки
+        """
+        with self.context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT card_num, trans_date, amt, oper_result, oper_type, terminal_city
+                    FROM dwh.rep_fraud_checkpoint
+                    ORDER BY card_num, trans_date, trans_id
+                """)
+                for card_num, trans_date, amount, oper_result, oper_type, city in cursor.fetchall():
+                    state = self.cards.get(card_num)
+                    if state is None:
+                        state = self.cards[card_num] = CardState()
+                    multi_city(state, trans_date, city)
+                    amount_guessing(state, trans_date, int(amount * 100), oper_result, oper_type)
+
+    def terminal_city(self, terminal):
+        """
+        Функция, возвращающая город терминала. Если терминал не найден, справочник терминалов считывается повторно,
+        но не чаще одного раза в refresh_interval секунд
+        """
+        if terminal not in self.terminals and time.monotonic() - self.terminals_loaded >= self.refresh_interval:
+            self.load_terminals()
+        return self.terminals.get(terminal)
+
+    def score(self, line):
+        """
+        Функция, оценивающая транзакцию строки line файла транзакций и добавляющая ее в пакет строк отчета,
+        если она признана мошеннической. Строка заголовка и пустые строки пропускаются. Строки, которые не удалось
+        разобрать, и операции, совершенные раньше последней оцененной операции карты, пропускаются с сообщением:
+        правила рассчитаны на операции карты, поступающие по порядку времени, а строка, пришедшая не по порядку,
+        дала бы ложное срабатывание, которое осталось бы в отчете. Такие операции оценит ежедневный отчет
+        """
+        values = line.rstrip("\r\n").split(";")
+        if len(values) != len(FIELDS) or values[0] == FIELDS[0]:
+            return
+        trans_id, trans_date, amount, card_num, oper_type, oper_result, terminal = values
+        try:
+            trans_date = datetime.fromisoformat(trans_date)
+            amount = kopecks(amount)
+        except ValueError as e:
+            print(f"Строка транзакции {trans_id} пропущена: {e}")
+            self.skipped += 1
+            return
+
+        state = self.cards.get(card_num)
+        if state is None:
+            state = self.cards[card_num] = CardState()
+        if state.recent and trans_date < state.recent[-1][0]:
+            print(f"Транзакция {trans_id} пропущена: поступила позже операций карты, совершенных после нее")
+            self.skipped += 1
+            return
+        self.scored += 1
+
+        # Оба правила обновляют состояние карты, поэтому вычисляются независимо, и в расшифровку попадают
+        # все выполненные правила в порядке их битов
+        flags = {
+            "multi_city": multi_city(state, trans_date, self.terminal_city(terminal)),
+            "amount_guessing": amount_guessing(state, trans_date, amount, oper_result, oper_type)
+        }
+        if any(flags.values()):
+            event_type = ", ".join(rule["label"] for rule in sorted(fraud_rules.RULES, key=lambda rule: rule["bit"])
+                                   if flags.get(rule["name"]))
+            card_key = card_num.replace(" ", "")
+            self.alerts.append((trans_id, trans_date, card_key if card_key.isdigit() else "", event_type))
+            if self.first_alert is None:
+                self.first_alert = time.monotonic()
+
+    def due(self):
+        """
+        Функция, проверяющая, пора ли записать накопленный пакет строк отчета
+        """
+        return bool(self.alerts) and (
+            len(self.alerts) >= self.batch_size or time.monotonic() - self.first_alert >= self.flush_interval
+        )
+
+    def flush(self):
+        """
+        Функция, записывающая накопленный пакет строк отчета командой COPY во временную таблицу и переносящая его
+        в отчет одной командой вместе с паспортом и ФИО клиента. Строки по транзакциям, уже учтенным в отчете,
+        не изменяются. Ежедневный отчет проверяет все правила и сверяет строки потоковой оценки: обновляет их
+        и удаляет те, которые не подтвердились
+        """
+        if not self.alerts:
+            return
+        buffer = io.StringIO()
+        for trans_id, trans_date, card_key, event_type in self.alerts:
+            buffer.write(f"{trans_id};{trans_date.isoformat(sep=' ')};{card_key};{event_type}\n")
+        buffer.seek(0)
+
+        with self.context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    CREATE TEMP TABLE tmp_stream_fraud(
+                        trans_id VARCHAR(128),
+                        event_dt TIMESTAMP,
+                        card_key BIGINT,
+                        event_type VARCHAR
+                    ) ON COMMIT DROP
+                """)
+                cursor.copy_expert("COPY tmp_stream_fraud FROM STDIN WITH (FORMAT csv, DELIMITER ';')", buffer)
+                cursor.execute("""
+                    INSERT INTO dwh.rep_fraud(trans_id, event_dt, passport, fio, event_type)
+                    SELECT
+                        t1.trans_id,
+                        t1.event_dt,
+                        t4.passport_num,
+                        CONCAT_WS(' ', t4.last_name, t4.first_name, t4.patronymic),
+                        t1.event_type
+                    FROM tmp_stream_fraud t1
+                    LEFT JOIN dwh.dwh_dim_cards t2
+                    ON t1.card_key=t2.card_key
+                    LEFT JOIN dwh.dwh_dim_accounts t3
+                    ON t2.account=t3.account
+                    LEFT JOIN dwh.dwh_dim_clients t4
+                    ON t3.client_key=t4.client_key
+                    ON CONFLICT (trans_id) DO NOTHING
+                """)
+                self.reported += cursor.rowcount
+        self.alerts = []
+        self.first_alert = None
+
+    def stop(self, signum=None, frame=None):
+        """
+        Функция, останавливающая оценку. Используется и как обработчик сигналов SIGTERM и SIGINT:
+        накопленный пакет строк отчета записывается перед завершением
+        """
+        self.stopping.set()
+
+    def run(self, lines):
+        """
+        Функция, оценивающая строки транзакций, которые поток чтения передает через очередь lines, пока поток не
+        закончится или не получен сигнал остановки. Возвращает количество добавленных строк отчета
+        """
+        self.load_terminals()
+        self.load_checkpoint()
+        try:
+            while not self.stopping.is_set():
+                try:
+                    line = lines.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    line = ""
+                if line is None:
+                    break
+                if line:
+                    self.score(line)
+                if self.due():
+                    self.flush()
+        finally:
+            # Записываем накопленный пакет и при остановке с ошибкой, чтобы найденные операции не были потеряны
+            self.flush()
+        return self.reported
+
+def read_lines(source, lines, stopping, poll_interval=0.05):
+    """
+    Функция, выполняющаяся в отдельном потоке: передает в очередь lines строки стандартного ввода (source равен "-")
+    или файла source. Файл читается по мере его дозаписи до сигнала остановки stopping, стандартный ввод - до его
+    закрытия, после которого в очередь передается None
+    """
+    if source == "-":
+        for line in sys.stdin:
+            lines.put(line)
+        lines.put(None)
+        return
+
+    with open(source, "r", encoding="utf-8") as f:
+        partial = ""
+        while not stopping.is_set():
+            line = f.readline()
+            if not line:
+                stopping.wait(poll_interval)
+                continue
+            # Строка, дозапись которой еще не закончена, дочитывается при следующем обращении
+            partial += line
+            if partial.endswith("\n"):
+                lines.put(partial)
+                partial = ""
+
+def stream_transactions(context, source, batch_size=500, flush_interval=0.1):
+    """
+    Функция, оценивающая в потоковом режиме транзакции из стандартного ввода (source равен "-") или дописываемого
+    файла source в формате файлов транзакций и записывающая найденные мошеннические операции в отчет пакетами
+    по batch_size строк не реже чем раз в flush_interval секунд. Работает до закрытия стандартного ввода или
+    до сигнала SIGTERM или SIGINT. Возвращает количество добавленных строк отчета
+    """
+    scorer = StreamScorer(context, batch_size, flush_interval)
+    lines = queue.Queue(maxsize=10000)
+    handlers = {signum: signal.signal(signum, scorer.stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+    reader = threading.Thread(target=read_lines, args=(source, lines, scorer.stopping), name="stream-reader",
+                              daemon=True)
+    try:
+        with context.metrics.stage("stream.scored", filepath=None if source == "-" else source) as record:
+            reader.start()
+            scorer.run(lines)
+            record["rows"] = scorer.scored
+        print(f"Оценено транзакций: {scorer.scored}, пропущено: {scorer.skipped}, "
+              f"добавлено строк отчета: {scorer.reported}")
+        return scorer.reported
+
+    except Exception as e:
+        print(f'''При выполнении функции "stream_transactions" возникла ошибка {e}''')
+    finally:
+        scorer.stop()
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
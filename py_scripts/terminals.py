@@ -1,189 +1,133 @@
-import pandas as  pd
-from sqlalchemy import create_engine, text
-import psycopg2
- 
-from . import backup_file
+from . import archiver, excel_cache, scd2
 
-def xlsx2sql_terminals(credentials, filepath):
+def read_terminals(filepath, checksum=None):
     """
-    Функциия, выгружающая список терминалов полным срезом из filepath, и загружающая данные в стейджинговую таблицу
-    базы данных с параметрами подключения, указанными в credentials
+    Функция, считывающая из filepath список терминалов полным срезом в датафрейм без обращения к базе данных.
+    Используется во всех режимах загрузки, а в параллельном режиме выполняется в отдельных процессах.
+    Лист читается потоково, а результат разбора кэшируется по контрольной сумме файла checksum, вычисленной
+    при открытии дня (если она не передана, вычисляется по файлу)
     """
-    # Формируем URL-адрес для подключения к базе данных
-    url = f"postgresql://{credentials['user']}:{credentials['password']}@{credentials['host']}: \
-        {credentials['port']}/{credentials['dbname']}"
-    engine = create_engine(url)
+    return excel_cache.read_sheet(filepath, 'terminals', checksum)
 
-    # Создадим в используемой базе данных схему STG, если ее нет
-    with engine.connect() as conn:
-        conn.execution_options(isolation_level="AUTOCOMMIT")
-        conn.execute(text("CREATE SCHEMA IF NOT EXISTS STG"))
-
-    # Cоздаем датафрэйм из файла списка терминалов полным срезом формата Excel
-    df = pd.read_excel(filepath, sheet_name='terminals')
+def terminals_hist(context):
+    """
+    Функциия, создающая таблицу в DWH базы данных, соединение с которой предоставляет context, 
+    которая будет хранить информацию (с учетом истории) об установленных терминалах. Возвращает True, если таблица
+    готова к загрузке, и None, если ее создать не удалось или история загружена прежней версией и должна быть
+    загружена заново
+    """
+    # Расширение btree_gist позволяет построить один GiST индекс по идентификатору терминала и периоду действия
+    # версии. Создание расширения требует прав, поэтому выполняется в отдельной транзакции
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    except Exception as e:
+        print(f'''Не удалось создать расширение btree_gist, будет использован B-tree индекс: {e}''')
 
-    # Создаем стейджинговую таблицу в базе данных первоначальной загрузки терминалов полным срезом
-    df.to_sql(name="stg_terminals", con=engine, schema="stg", if_exists="replace", index=False)
-    
-    # Удаляем созданный датафрейм
-    del df
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                # Создаем таблицу, которая будет хранить историю расположения терминалов
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS dwh.dwh_dim_terminals_hist(
+                    terminal_id VARCHAR(16),
+                    terminal_type VARCHAR(8),
+                    terminal_city VARCHAR(64),
+                    terminal_address VARCHAR(128),
+                    effective_from TIMESTAMP DEFAULT current_timestamp,
+                    effective_to TIMESTAMP DEFAULT ('5999-12-31 23:59:59'::TIMESTAMP),
+                    deleted_flg INTEGER DEFAULT 0
+                    );
+                """)
+                # Индекс для поиска действующей версии терминала при ежедневном обновлении истории
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS dwh_dim_terminals_hist_terminal_id_effective_to_idx
+                    ON dwh.dwh_dim_terminals_hist(terminal_id, effective_to)
+                """)
 
-    # Вызываем функцию, выполняющую переименование обработанного файла и перемещающая его в папку archive
-    backup_file.backup_file(filepath)
+                # Период действия версии в виде диапазона, по которому транзакция соединяется с версией терминала,
+                # действовавшей в момент ее совершения. Верхняя граница не меньше нижней, даже если версия закрыта
+                # в день ее создания
+                cursor.execute("""
+                    ALTER TABLE dwh.dwh_dim_terminals_hist
+                    ADD COLUMN IF NOT EXISTS valid_period TSRANGE
+                    GENERATED ALWAYS AS (tsrange(effective_from, GREATEST(effective_to, effective_from), '[]')) STORED
+                """)
+                cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'btree_gist'")
+                if cursor.fetchone() is not None:
+                    cursor.execute("""
+                        CREATE INDEX IF NOT EXISTS dwh_dim_terminals_hist_terminal_id_valid_period_idx
+                        ON dwh.dwh_dim_terminals_hist USING GIST (terminal_id, valid_period)
+                    """)
+                else:
+                    # Без расширения btree_gist версия на момент транзакции ищется по B-tree индексу
+                    cursor.execute("""
+                        CREATE INDEX IF NOT EXISTS dwh_dim_terminals_hist_terminal_id_effective_from_idx
+                        ON dwh.dwh_dim_terminals_hist(terminal_id, effective_from, effective_to)
+                    """)
 
+    except Exception as e:
+        print(f'''При выполнении функции "terminals_hist" возникла ошибка {e}''')
+        return None
 
-def terminals_hist(credentials):
-    """
-    Функциия, создающая таблицу в DWH базы данных с параметрами подключения, указанными в credentials, 
-    которая будет хранить информацию (с учетом истории) об установленных терминалах
-    """    
+    # Проверяем, что история не загружена до соединения транзакций с версией терминала на момент операции.
+    # Версии, загруженные по бизнес-дате среза, начинаются в полночь, а прежние версии - со времени загрузки,
+    # и с ними не соединяется ни одна транзакция прошлых дней, поэтому отчет молча оказался бы пустым
     try:
-        connection = psycopg2.connect(**credentials)
-        cursor = connection.cursor()
-        
-        # Создадим в используемой базе данных схему DWH, если ее нет
-        cursor.execute("CREATE SCHEMA IF NOT EXISTS DWH")
-        connection.commit()
-
-        # Создаем таблицу, которая будет хранить историю расположения терминалов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS dwh.dwh_dim_terminals_hist(
-            terminal_id VARCHAR(16),
-            terminal_type VARCHAR(8),
-            terminal_city VARCHAR(64),
-            terminal_address VARCHAR(128),
-            effective_from TIMESTAMP DEFAULT current_timestamp,
-            effective_to TIMESTAMP DEFAULT ('5999-12-31 23:59:59'::TIMESTAMP),
-            deleted_flg INTEGER DEFAULT 0
-            );
-        """)
-        connection.commit()
-        
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT COUNT(*) FROM dwh.dwh_dim_terminals_hist
+                    WHERE effective_from <> DATE_TRUNC('day', effective_from)
+                """)
+                legacy = cursor.fetchone()[0]
     except Exception as e:
         print(f'''При выполнении функции "terminals_hist" возникла ошибка {e}''')
-    
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
+        return None
 
-def terminals_increment(credentials):
-    """Функциия, которая наполняет данными тавлицу в DWH базы данных с параметрами подключения, указанными в credentials, 
-    которая хранит историческую информацию об установленных терминалах
+    if legacy:
+        print(
+            f"История терминалов содержит {legacy} версий, загруженных до перехода на бизнес-даты срезов: они "
+            f"начинаются со времени загрузки, и транзакции прошлых дней с ними не соединяются. Загрузите историю "
+            f"заново из архива срезов командой \"python main.py reload-terminals\", затем постройте отчет повторно "
+            f"командой \"python main.py report --date ГГГГ-ММ-ДД\" за каждый загруженный день"
+        )
+        return None
+    return True
+
+def reload_terminals(context, directory="archive"):
+    """
+    Функция, загружающая историю терминалов заново по срезам из архива directory: история очищается, и срезы
+    применяются по порядку бизнес-дат, с которых действуют их версии. Прерванную загрузку можно повторить
+    с начала. Возвращает количество примененных срезов
     """
     try:
-        connection = psycopg2.connect(**credentials)
-        cursor = connection.cursor()
-        
-        # Создаем представление, которое содержит информацию о действующих терминалах
-        cursor.execute("DROP VIEW IF EXISTS stg.stg_v_terminals")
-        cursor.execute("""
-            CREATE VIEW stg.stg_v_terminals AS
-                SELECT
-                    terminal_id,
-                    terminal_type,
-                    terminal_city,
-                    terminal_address
-                FROM dwh.dwh_dim_terminals_hist
-                WHERE deleted_flg=0
-                AND current_timestamp BETWEEN effective_from AND effective_to        
-        """)
-        connection.commit()
+        snapshots = archiver.archived_files("terminals", directory)
+        if not snapshots:
+            print(f"В каталоге {directory} не найдены срезы терминалов")
+            return None
 
-        # Создаем временную таблицу, которая будет содержать информацию о новых терминалах
-        cursor.execute("DROP TABLE IF EXISTS stg.stg_terminals_new")
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS stg.stg_terminals_new AS
-                SELECT
-                    t1.terminal_id,
-                    t1.terminal_type,
-                    t1.terminal_city,
-                    t1.terminal_address
-                FROM stg.stg_terminals t1
-                LEFT JOIN stg.stg_v_terminals t2
-                ON t1.terminal_id=t2.terminal_id
-                WHERE t2.terminal_id IS NULL
-        """)
-        connection.commit()
-        
-        # Создаем временную таблицу, которая будет содержать информацию об удаленных терминалах
-        cursor.execute("DROP TABLE IF EXISTS stg.stg_terminals_deleted")        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS stg.stg_terminals_deleted AS
-                SELECT
-                    t1.terminal_id,
-                    t1.terminal_type,
-                    t1.terminal_city,
-                    t1.terminal_address
-                FROM stg.stg_v_terminals t1
-                LEFT JOIN stg.stg_terminals t2
-                ON t1.terminal_id=t2.terminal_id
-                WHERE t2.terminal_id IS NULL
-        """)
-        connection.commit()
-        
-        # Создаем временную таблицу, которая будет содержать информацию о терминалах c измененными данными
-        cursor.execute("DROP TABLE IF EXISTS stg.stg_terminals_updated")            
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS stg.stg_terminals_updated AS
-                SELECT
-                    t1.terminal_id,
-                    t1.terminal_type,
-                    t1.terminal_city,
-                    t1.terminal_address
-                FROM stg.stg_terminals t1
-                INNER JOIN stg.stg_v_terminals t2
-                ON t1.terminal_id=t2.terminal_id
-                WHERE (t1.terminal_type != t2.terminal_type
-                    OR (t1.terminal_type IS NULL AND t2.terminal_type IS NOT NULL)
-                    OR (t1.terminal_type IS NOT NULL AND t2.terminal_type IS NULL)
-                    )
-                    OR (t1.terminal_city != t2.terminal_city
-                    OR (t1.terminal_city IS NULL AND t2.terminal_city IS NOT NULL)
-                    OR (t1.terminal_city IS NOT NULL AND t2.terminal_city IS NULL)
-                    )
-                    OR (t1.terminal_address != t2.terminal_address
-                    OR (t1.terminal_address IS NULL AND t2.terminal_address IS NOT NULL)
-                    OR (t1.terminal_address IS NOT NULL AND t2.terminal_address IS NULL)
-                    )                   
-        """)
-        connection.commit()
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("TRUNCATE dwh.dwh_dim_terminals_hist")
 
-        # Обновляем таблицу "terminal_hist" с учетом полученных данных о новых терминалах
-        cursor.execute("""
-            INSERT INTO dwh.dwh_dim_terminals_hist (terminal_id, terminal_type, terminal_city, terminal_address)
-            SELECT terminal_id, terminal_type, terminal_city, terminal_address FROM stg.stg_terminals_new
-        """)
+        for business_date, path in snapshots:
+            df = excel_cache.stream_sheet(archiver.read_archived(path), "terminals")
+            if terminals_increment(context, df, business_date) is None:
+                return None
+        return len(snapshots)
 
-        # Обновляем таблицу "terminal_hist" с учетом полученных данных об удаленных терминалах
-        cursor.execute("""
-            UPDATE dwh.dwh_dim_terminals_hist
-            SET effective_to = current_timestamp - INTERVAL '1 second'
-            WHERE terminal_id IN (SELECT terminal_id FROM stg.stg_terminals_deleted)
-            AND effective_to = '5999-12-31 23:59:59'::TIMESTAMP
-        """)
-        cursor.execute("""
-            INSERT INTO dwh.dwh_dim_terminals_hist (terminal_id, terminal_type, terminal_city, terminal_address, deleted_flg)
-            SELECT terminal_id, terminal_type, terminal_city, terminal_address, 1 FROM stg.stg_terminals_deleted
-        """)
-        
-        # Обновляем таблицу "terminal_hist" с учетом полученных данных об измененной информации о терминалах
-        cursor.execute("""
-            UPDATE dwh.dwh_dim_terminals_hist
-            SET effective_to = current_timestamp - INTERVAL '1 second'
-            WHERE terminal_id IN (SELECT terminal_id FROM stg.stg_terminals_updated)
-            AND effective_to = '5999-12-31 23:59:59'::TIMESTAMP
-        """)
-        cursor.execute("""
-            INSERT INTO dwh.dwh_dim_terminals_hist (terminal_id, terminal_type, terminal_city, terminal_address)
-            SELECT terminal_id, terminal_type, terminal_city, terminal_address FROM stg.stg_terminals_updated
-        """)
-        
-        connection.commit()
+    except Exception as e:
+        print(f'''При выполнении функции "reload_terminals" возникла ошибка {e}''')
+
+def terminals_increment(context, df, business_date):
+    """Функциия, которая наполняет данными тавлицу в DWH базы данных, соединение с которой предоставляет context,
+    которая хранит историческую информацию об установленных терминалах, по полному срезу терминалов df
+    на бизнес-дату business_date. Возвращает количество строк изменений
+    """
+    try:
+        return scd2.scd2_merge(context, scd2.DIMENSIONS["terminals"], df, business_date)
 
     except Exception as e:
         print(f'''При выполнении функции "terminals_increment" возникла ошибка {e}''')
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
\ No newline at end of file
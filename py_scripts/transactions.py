@@ -1,87 +1,442 @@
+import io
+import re
+from datetime import timedelta
+
 import pandas as  pd
-from sqlalchemy import create_engine, text
-import psycopg2
 
-from . import backup_file
+# Форматы суффикса имени секции таблицы фактов для поддерживаемых режимов секционирования
+PARTITION_FORMATS = {"day": "%Y%m%d", "month": "%Y%m"}
+
+# Типы полей файла транзакций: сумма, номер карты и низкокардинальные поля читаются категориями (каждое значение
+# хранится в памяти и разбирается один раз), сумма затем разбирается в целое число копеек без промежуточного float
+TRANSACTION_DTYPES = {
+    "transaction_id": str,
+    "transaction_date": str,
+    "amount": "category",
+    "card_num": "category",
+    "oper_type": "category",
+    "oper_result": "category",
+    "terminal": "category"
+}
+
+# Поля стейджинговой таблицы транзакций в порядке их передачи командой COPY
+STAGE_COLUMNS = ["transaction_id", "transaction_date", "amount_kop", "card_num", "oper_type", "oper_result", "terminal",
+                 "card_key"]
 
-def csv2sql_transactions(credentials, filepath):
+# Справочники кодов низкокардинальных полей транзакций: в таблице фактов вместо значения поля хранится
+# его код <поле>_id из таблицы-справочника DWH
+LOOKUPS = {
+    "oper_type": "dwh.dwh_dim_oper_types",
+    "oper_result": "dwh.dwh_dim_oper_results"
+}
+
+def transactions_stg(context):
     """
-    Функциия, выгружающая из filepath список транзакций за текущий день, и загружающая данные в стейджинговую таблицу
-    базы данных с параметрами подключения, указанными в credentials
+    Функциия, создающая типизированную стейджинговую таблицу транзакций в базе данных, соединение с которой
+    предоставляет context, в которую выполняется потоковая загрузка файлов транзакций
     """
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                # Создаем стейджинговую таблицу транзакций с заранее заданными типами полей
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS stg.stg_transactions(
+                        transaction_id VARCHAR(128),
+                        transaction_date TIMESTAMP,
+                        amount_kop BIGINT,
+                        card_num VARCHAR(128),
+                        oper_type VARCHAR(16),
+                        oper_result VARCHAR(16),
+                        terminal VARCHAR(16),
+                        card_key BIGINT
+                    );
+                """)
+                cursor.execute("ALTER TABLE stg.stg_transactions ADD COLUMN IF NOT EXISTS card_key BIGINT")
+                cursor.execute("ALTER TABLE stg.stg_transactions ADD COLUMN IF NOT EXISTS amount_kop BIGINT")
+        return True
 
-    # Формируем URL-адрес для подключения к базе данных
-    url = f"postgresql://{credentials['user']}:{credentials['password']}@{credentials['host']}: \
-        {credentials['port']}/{credentials['dbname']}"
-    engine = create_engine(url)
-
-    # Создадим в используемой базе данных схему DWH, если ее нет
-    with engine.connect() as conn:
-        conn.execution_options(isolation_level="AUTOCOMMIT")
-        conn.execute(text("CREATE SCHEMA IF NOT EXISTS STG"))
+    except Exception as e:
+        print(f'''При выполнении функции "transactions_stg" возникла ошибка {e}''')
 
-    # Cоздаем датафрэйм из файла списка транзакций за текущий день
-    df = pd.read_csv(filepath, sep=";")
+def kopecks(amount):
+    """
+    Функция, разбирающая сумму вида "1046,40" в целое число копеек без преобразования во float.
+    Сумма с дробной частью длиннее двух знаков округляется до копеек по модулю, половина - в большую сторону
+    """
+    rubles, _, fraction = amount.strip().replace(".", ",").partition(",")
+    value = abs(int(rubles or 0)) * 100 + int(fraction.ljust(2, "0")[:2]) + (fraction[2:3] >= "5")
+    return -value if rubles.startswith("-") else value
 
-    # Приведем поле "transaction_date" к временному типу, а поле "amount" к числовому типу
-    df['transaction_date'] = pd.to_datetime(df['transaction_date'])
-    df['amount'] = df['amount'].str.replace(',','.').astype(float).round(2)
+def parse_kopecks(amounts):
+    """
+    Функция, векторно разбирающая суммы вида "1046,40" в целое число копеек без преобразования во float.
+    Суммы с дробной частью длиннее двух знаков округляются до копеек так же, как в функции kopecks.
+    Пустые суммы становятся пропусками
+    """
+    parts = amounts.str.strip().str.replace(".", ",", regex=False).str.partition(",")
+    negative = parts[0].str.startswith("-").fillna(False).to_numpy()
+    rubles = pd.to_numeric(parts[0].str.lstrip("+-"), errors="coerce").astype("Int64")
+    fraction = parts[2].fillna("")
+    rounding = (fraction.str[2:3] >= "5").astype("Int64")
+    value = rubles * 100 + pd.to_numeric(fraction.str.ljust(2, "0").str[:2]).astype("Int64") + rounding
+    return value.where(~negative, -value)
 
-    # Создаем стейджинговую таблицу транзакций в базе данных первоначальной загрузки транзакции совершенное за текущий день
-    df.to_sql(name="stg_transactions", con=engine, schema="stg", if_exists="replace", index=False)
+def by_category(values, parse):
+    """
+    Функция, вычисляющая целочисленное поле функцией parse один раз для каждого уникального значения поля values
+    и раскладывающая результат по строкам по кодам категорий
+    """
+    values = values.astype('category').cat
+    parsed = pd.array([], dtype='Int64')
+    if len(values.categories):
+        parsed = pd.array(parse(pd.Series(values.categories, dtype=str)), dtype='Int64')
+    return parsed.take(values.codes.to_numpy(), allow_fill=True)
 
-    # Удаляем созданный датафрейм
-    del df
+def prepare_transactions(df):
+    """
+    Функция, приводящая поле "transaction_date" датафрейма df к временному типу, а поле "amount" - к целому числу
+    копеек "amount_kop", и вычисляющая числовой ключ карты "card_key" - номер карты без пробелов. Сумма и ключ карты
+    вычисляются по уникальным значениям полей
+    """
+    df['transaction_date'] = pd.to_datetime(df['transaction_date'], format="ISO8601")
+    df['amount_kop'] = by_category(df.pop('amount'), parse_kopecks)
+    df['card_key'] = by_category(df['card_num'], lambda cards: pd.to_numeric(
+        cards.str.replace(r'\s', '', regex=True), errors='coerce'))
+    return df
 
-    # Вызываем функцию, выполняющую переименование обработанного файла и перемещающая его в папку archive
-    backup_file.backup_file(filepath)
+def copy_transactions(cursor, df):
+    """
+    Функция, передающая порцию транзакций df в стейджинговую таблицу в формате csv через COPY ... FROM STDIN
+    """
+    buffer = io.StringIO()
+    df[STAGE_COLUMNS].to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(f"""
+        COPY stg.stg_transactions ({", ".join(STAGE_COLUMNS)})
+        FROM STDIN WITH (FORMAT csv)
+    """, buffer)
 
-def transactions_fact(credentials):
+def stage_transactions(context, filepath, chunksize=100000, truncate=True):
+    """
+    Функциия, выгружающая из filepath список транзакций за текущий день порциями по chunksize строк, и загружающая
+    данные командой COPY в типизированную стейджинговую таблицу базы данных, соединение с которой предоставляет context.
+    Если truncate равен False, стейджинговая таблица не очищается, и транзакции добавляются к загруженным ранее
+    (так за один проход загружаются файлы нескольких дней). Возвращает количество загруженных строк
     """
-    Функциия, создающая таблицу в DWH базы данных с параметрами подключения, указанными в credentials,
-    и заполняющая ее данными о совершенных транзакциях из стейджинговой таблицы 
-    """        
     try:
-        connection = psycopg2.connect(**credentials)
-        cursor = connection.cursor()
-        
-        # Создадим в используемой базе данных схему DWH, если ее нет
-        cursor.execute("CREATE SCHEMA IF NOT EXISTS DWH")
-        connection.commit()
-
-        # Создаем таблицу, которая будет хранить совершенные транзакции
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS dwh.dwh_fact_transactions(
-                trans_id VARCHAR(128) PRIMARY KEY,
-                trans_date TIMESTAMP,
-                card_num VARCHAR(128),
-                oper_type VARCHAR(16),
-                amt DECIMAL,
-                oper_result VARCHAR(16),
-                terminal VARCHAR(16)
+        rows_loaded = 0
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                # Очищаем стейджинговую таблицу от данных предыдущей загрузки
+                if truncate:
+                    cursor.execute("TRUNCATE TABLE stg.stg_transactions")
+
+                # Читаем файл списка транзакций порциями, чтобы объем используемой памяти не зависел от размера файла
+                for chunk in pd.read_csv(filepath, sep=";", dtype=TRANSACTION_DTYPES, chunksize=chunksize):
+                    copy_transactions(cursor, prepare_transactions(chunk))
+                    rows_loaded += len(chunk)
+        return rows_loaded
+
+    except Exception as e:
+        print(f'''При выполнении функции "stage_transactions" возникла ошибка {e}''')
+
+def lookup_tables(cursor):
+    """
+    Функция, создающая таблицы-справочники кодов низкокардинальных полей транзакций
+    """
+    for column, table in LOOKUPS.items():
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table}(
+                {column}_id SMALLINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+                {column} VARCHAR(16) UNIQUE
             );
         """)
-        # Добавляем данные из стейджинговую таблицу транзакций в таблицу фактов совершенных транзакций        
+
+def fill_lookups(cursor, source, columns=tuple(LOOKUPS)):
+    """
+    Функция, добавляющая в таблицы-справочники полей columns значения этих полей таблицы source, которых в них нет.
+    Значения, уже получившие код, не передаются в команду, чтобы не расходовать коды справочника
+    """
+    for column in columns:
+        table = LOOKUPS[column]
+        cursor.execute(f"""
+            INSERT INTO {table}({column})
+            SELECT DISTINCT t1.{column}
+            FROM {source} t1
+            WHERE t1.{column} IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM {table} t2 WHERE t2.{column} = t1.{column})
+            ON CONFLICT ({column}) DO NOTHING
+        """)
+
+def migrate_lookups(cursor):
+    """
+    Функция, заменяющая в таблице фактов, созданной до появления справочников, текстовые поля типа и результата
+    операции их кодами
+    """
+    for column, table in LOOKUPS.items():
         cursor.execute("""
-            INSERT INTO dwh.dwh_fact_transactions (trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal)
-            SELECT
-                transaction_id,
-                transaction_date,
-                card_num,
-                oper_type,
-                amount,
-                oper_result,
-                terminal
-            FROM stg.stg_transactions
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = 'dwh' AND table_name = 'dwh_fact_transactions' AND column_name = %s
+        """, [column])
+        if cursor.fetchone() is None:
+            continue
+        fill_lookups(cursor, "dwh.dwh_fact_transactions", [column])
+        cursor.execute(f"ALTER TABLE dwh.dwh_fact_transactions ADD COLUMN IF NOT EXISTS {column}_id SMALLINT")
+        cursor.execute(f"""
+            UPDATE dwh.dwh_fact_transactions t1
+            SET {column}_id = t2.{column}_id
+            FROM {table} t2
+            WHERE t1.{column} = t2.{column}
         """)
+        cursor.execute(f"ALTER TABLE dwh.dwh_fact_transactions DROP COLUMN {column}")
+
+def transactions_fact_table(context):
+    """
+    Функциия, создающая таблицу фактов совершенных транзакций в DWH базы данных, соединение с которой предоставляет
+    context, вместе с числовым ключом карты "card_key", индексами и справочниками кодов типа и результата операции.
+    Если в context задан режим секционирования (context.partition_by равен "day" или "month"), новая таблица
+    создается секционированной по диапазонам "trans_date". Секционирование существующей таблицы не меняется
+    """
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                # Создаем справочники кодов типа и результата операции, которые хранятся в таблице фактов
+                lookup_tables(cursor)
+
+                # Создаем таблицу, которая будет хранить совершенные транзакции
+                if context.partition_by in PARTITION_FORMATS:
+                    # Ключ секционирования должен входить в первичный ключ секционированной таблицы
+                    cursor.execute("""
+                        CREATE TABLE IF NOT EXISTS dwh.dwh_fact_transactions(
+                            trans_id VARCHAR(128),
+                            trans_date TIMESTAMP,
+                            card_num VARCHAR(128),
+                            oper_type_id SMALLINT,
+                            amt DECIMAL,
+                            oper_result_id SMALLINT,
+                            terminal VARCHAR(16),
+                            card_key BIGINT,
+                            PRIMARY KEY (trans_id, trans_date)
+                        ) PARTITION BY RANGE (trans_date);
+                    """)
+                else:
+                    cursor.execute("""
+                        CREATE TABLE IF NOT EXISTS dwh.dwh_fact_transactions(
+                            trans_id VARCHAR(128) PRIMARY KEY,
+                            trans_date TIMESTAMP,
+                            card_num VARCHAR(128),
+                            oper_type_id SMALLINT,
+                            amt DECIMAL,
+                            oper_result_id SMALLINT,
+                            terminal VARCHAR(16),
+                            card_key BIGINT
+                        );
+                    """)
+
+                # Если таблица была создана без числового ключа карты, добавляем его и заполняем для загруженных ранее строк
+                cursor.execute("""
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_schema = 'dwh' AND table_name = 'dwh_fact_transactions' AND column_name = 'card_key'
+                """)
+                if cursor.fetchone() is None:
+                    cursor.execute("ALTER TABLE dwh.dwh_fact_transactions ADD COLUMN card_key BIGINT")
+                    cursor.execute("""
+                        UPDATE dwh.dwh_fact_transactions
+                        SET card_key = REGEXP_REPLACE(card_num, '\\s', '', 'g')::BIGINT
+                    """)
+
+                # Если таблица была создана с текстовыми полями типа и результата операции, заменяем их кодами
+                migrate_lookups(cursor)
+
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS dwh_fact_transactions_card_key_idx
+                    ON dwh.dwh_fact_transactions(card_key)
+                """)
+                # Индекс для оконных функций отчета, упорядочивающих операции карты по времени
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS dwh_fact_transactions_card_num_trans_date_idx
+                    ON dwh.dwh_fact_transactions(card_num, trans_date)
+                """)
+                # Индекс для выборки транзакций отчета и водяного знака по диапазону времени операции, чтобы стоимость
+                # построения отчета зависела от объема новых транзакций, а не от всей истории таблицы фактов
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS dwh_fact_transactions_trans_date_idx
+                    ON dwh.dwh_fact_transactions(trans_date)
+                """)
+        return True
+
+    except Exception as e:
+        print(f'''При выполнении функции "transactions_fact_table" возникла ошибка {e}''')
+
+def is_partitioned(cursor):
+    """
+    Функция, проверяющая, является ли таблица фактов совершенных транзакций секционированной
+    """
+    cursor.execute("""
+        SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'dwh.dwh_fact_transactions'::regclass
+    """)
+    return cursor.fetchone() is not None
+
+def partition_bounds(start, partition_by):
+    """
+    Функция, возвращающая имя секции таблицы фактов, начинающейся с start, и верхнюю границу ее диапазона
+    """
+    if partition_by == "day":
+        end = start + timedelta(days=1)
+    else:
+        end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return f"dwh_fact_transactions_{start.strftime(PARTITION_FORMATS[partition_by])}", end
+
+def partition_range(bound):
+    """
+    Функция, возвращающая начало и конец диапазона секции по его описанию bound ("FOR VALUES FROM (...) TO (...)"),
+    или None, если секция не задана диапазоном дат (например, секция по умолчанию)
+    """
+    match = re.fullmatch(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)", bound)
+    if match is None:
+        return None
+    return tuple(pd.Timestamp(value) for value in match.groups())
+
+def fact_partitions(cursor):
+    """
+    Функция, возвращающая секции таблицы фактов, заданные диапазоном дат: список кортежей (имя, начало, конец),
+    упорядоченный по началу диапазона
+    """
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        INNER JOIN pg_class c
+        ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'dwh.dwh_fact_transactions'::regclass
+    """)
+    partitions = []
+    for name, bound in cursor.fetchall():
+        bounds = partition_range(bound)
+        if bounds is not None:
+            partitions.append((name, *bounds))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+def fact_partitioning(cursor, default="month"):
+    """
+    Функция, определяющая режим секционирования существующей таблицы фактов по диапазонам ее секций: "day",
+    если секции занимают сутки, иначе "month". Параметр запуска задает режим только при создании таблицы,
+    поэтому используется (default), лишь пока у таблицы нет ни одной секции
+    """
+    partitions = fact_partitions(cursor)
+    if not partitions:
+        return default if default in PARTITION_FORMATS else "month"
+    _, start, end = partitions[-1]
+    return "day" if end - start <= timedelta(days=1) else "month"
+
+def create_fact_partitions(cursor, partition_by):
+    """
+    Функция, создающая по требованию недостающие секции таблицы фактов (по дням или месяцам в зависимости
+    от partition_by) для дат транзакций, загруженных в стейдж
+    """
+    cursor.execute("""
+        SELECT DISTINCT DATE_TRUNC(%s, transaction_date)
+        FROM stg.stg_transactions
+        WHERE transaction_date IS NOT NULL
+    """, [partition_by])
+    for (start,) in cursor.fetchall():
+        name, end = partition_bounds(start, partition_by)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS dwh.{name}
+            PARTITION OF dwh.dwh_fact_transactions
+            FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')
+        """)
+
+def detach_fact_partitions(context, before):
+    """
+    Функция, отсоединяющая от таблицы фактов секции, все транзакции которых совершены раньше даты before.
+    Отсоединенные секции остаются в схеме DWH как обычные таблицы и могут быть заархивированы или удалены.
+    Возвращает список имен отсоединенных секций
+    """
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                if not is_partitioned(cursor):
+                    print("Таблица фактов транзакций не секционирована")
+                    return []
+                detached = []
+                for name, _, end in fact_partitions(cursor):
+                    if end <= pd.Timestamp(before):
+                        cursor.execute(f"ALTER TABLE dwh.dwh_fact_transactions DETACH PARTITION dwh.{name}")
+                        detached.append(name)
+                return detached
+
+    except Exception as e:
+        print(f'''При выполнении функции "detach_fact_partitions" возникла ошибка {e}''')
+
+def transactions_fact(context):
+    """
+    Функциия, заполняющая таблицу фактов в DWH базы данных, соединение с которой предоставляет context,
+    данными о совершенных транзакциях из стейджинговой таблицы. Транзакция, уже загруженная в таблицу фактов,
+    заменяется пришедшей в стейдж, если ее данные изменились, поэтому повторная загрузка исправленного файла дня
+    исправляет загруженные ранее строки, а каждый идентификатор транзакции встречается в таблице фактов один раз.
+    Возвращает количество добавленных и измененных строк
+    """
+    try:
+        with context.connection() as connection:
+            with connection.cursor() as cursor:
+                # Создаем секции таблицы фактов для дней (месяцев), которые пришли с новым файлом транзакций.
+                # Режим секционирования определяется по существующим секциям, а не по параметру запуска, чтобы
+                # запуск с другим параметром не создавал секции, пересекающиеся с уже созданными
+                partitioned = is_partitioned(cursor)
+                if partitioned:
+                    create_fact_partitions(cursor, fact_partitioning(cursor, context.partition_by))
+
+                # Добавляем в справочники новые типы и результаты операций, пришедшие с файлом транзакций
+                fill_lookups(cursor, "stg.stg_transactions")
+
+                # Первичный ключ секционированной таблицы включает время операции, поэтому транзакция, время которой
+                # исправлено, не конфликтует с загруженной ранее строкой. Удаляем такие строки, чтобы идентификатор
+                # транзакции оставался уникальным
+                cursor.execute("""
+                    DELETE FROM dwh.dwh_fact_transactions t1
+                    USING stg.stg_transactions t2
+                    WHERE t1.trans_id = t2.transaction_id
+                    AND t1.trans_date IS DISTINCT FROM t2.transaction_date
+                """)
 
-        connection.commit()
+                # Добавляем данные из стейджинговую таблицу транзакций в таблицу фактов совершенных транзакций,
+                # заменяя тип и результат операции их кодами, а сумму в копейках - точной суммой в рублях.
+                # Из повторов транзакции в файле берется последняя строка, а загруженная ранее строка обновляется,
+                # только если ее данные отличаются от пришедших
+                conflict = "trans_id, trans_date" if partitioned else "trans_id"
+                cursor.execute(f"""
+                    INSERT INTO dwh.dwh_fact_transactions (trans_id, trans_date, card_num, oper_type_id, amt, oper_result_id, terminal, card_key)
+                    SELECT DISTINCT ON (t1.transaction_id)
+                        t1.transaction_id,
+                        t1.transaction_date,
+                        t1.card_num,
+                        t2.oper_type_id,
+                        t1.amount_kop * 0.01,
+                        t3.oper_result_id,
+                        t1.terminal,
+                        t1.card_key
+                    FROM stg.stg_transactions t1
+                    LEFT JOIN dwh.dwh_dim_oper_types t2
+                    ON t1.oper_type=t2.oper_type
+                    LEFT JOIN dwh.dwh_dim_oper_results t3
+                    ON t1.oper_result=t3.oper_result
+                    ORDER BY t1.transaction_id, t1.ctid DESC
+                    ON CONFLICT ({conflict}) DO UPDATE
+                    SET trans_date = EXCLUDED.trans_date,
+                        card_num = EXCLUDED.card_num,
+                        oper_type_id = EXCLUDED.oper_type_id,
+                        amt = EXCLUDED.amt,
+                        oper_result_id = EXCLUDED.oper_result_id,
+                        terminal = EXCLUDED.terminal,
+                        card_key = EXCLUDED.card_key
+                    WHERE (dwh_fact_transactions.trans_date, dwh_fact_transactions.card_num,
+                           dwh_fact_transactions.oper_type_id, dwh_fact_transactions.amt,
+                           dwh_fact_transactions.oper_result_id, dwh_fact_transactions.terminal,
+                           dwh_fact_transactions.card_key)
+                    IS DISTINCT FROM (EXCLUDED.trans_date, EXCLUDED.card_num, EXCLUDED.oper_type_id, EXCLUDED.amt,
+                                      EXCLUDED.oper_result_id, EXCLUDED.terminal, EXCLUDED.card_key)
+                """)
+                return cursor.rowcount
 
-        
     except Exception as e:
         print(f'''При выполнении функции "transactions_fact" возникла ошибка {e}''')
-    
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
\ No newline at end of file
@@ -0,0 +1,184 @@
+import os
+import queue
+import signal
+import threading
+import time
+
+from . import manifest, pipeline
+
+try:
+    # Уведомления об изменениях каталога доступны только в Linux при установленном пакете inotify_simple,
+    # без него каталог опрашивается с интервалом poll_interval
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+def file_signature(filepath):
+    """
+    Функция, возвращающая размер и время изменения файла filepath, по которым определяется, что запись файла закончена
+    """
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns
+
+class FolderWatcher:
+    """
+    Класс, наблюдающий за каталогом directory и загружающий дни, все файлы которых пришли полностью. Файл считается
+    пришедшим полностью, если его размер и время изменения не менялись settle секунд. Готовые дни передаются
+    в очередь размером queue_size строго по порядку дат: если очередь заполнена, новые дни не принимаются, пока
+    загрузка не освободит место. День, обработка которого завершилась ошибкой, повторно не загружается, пока
+    не изменятся его файлы, и следующие дни до этого не загружаются
+    """
+    def __init__(self, directory, poll_interval=1.0, settle=2.0, queue_size=2):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        # Файлы, замеченные в каталоге: {путь: (размер и время изменения, момент последнего изменения)}
+        self.seen = {}
+        # Дни, переданные в загрузку, и дни, загрузка которых завершилась ошибкой: {дата: подпись файлов дня}
+        self.queued = {}
+        self.failed = {}
+
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.inotify.add_watch(directory, flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO)
+            except OSError as e:
+                print(f"Не удалось подключить inotify, каталог {directory} будет опрашиваться: {e}")
+                self.inotify = None
+
+    def scan(self):
+        """
+        Функция, просматривающая каталог и возвращающая упорядоченный по дате список дней (дата, файлы дня,
+        подпись файлов дня, момент прихода последнего файла или None, если файлы дня пришли не полностью)
+        """
+        now = time.monotonic()
+        seen = {}
+        days = []
+        for business_date, files in manifest.discover_days(self.directory):
+            signatures = []
+            arrived = now if len(files) < len(manifest.FILE_PATTERNS) else 0.0
+            for filepath in files.values():
+                try:
+                    signature = file_signature(filepath)
+                except FileNotFoundError:
+                    arrived = now
+                    continue
+                previous = self.seen.get(filepath)
+                if previous is None or previous[0] != signature:
+                    previous = (signature, now)
+                seen[filepath] = previous
+                signatures.append((filepath, signature))
+                arrived = max(arrived, previous[1])
+            complete = now - arrived >= self.settle
+            days.append((business_date, files, tuple(sorted(signatures)), arrived if complete else None))
+        self.seen = seen
+        return days
+
+    def put(self, item):
+        """
+        Функция, передающая день в очередь загрузки. Пока очередь заполнена, ожидает освобождения места.
+        Возвращает False, если за время ожидания получен сигнал остановки
+        """
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def wait(self):
+        """
+        Функция, ожидающая изменений в каталоге (уведомления inotify) или истечения интервала опроса
+        """
+        if self.inotify is not None:
+            # Уведомления, пришедшие в течение 100 мс, читаются вместе, чтобы не просматривать каталог на каждую запись
+            self.inotify.read(timeout=int(self.poll_interval * 1000), read_delay=100)
+        else:
+            self.stopping.wait(self.poll_interval)
+
+    def watch(self):
+        """
+        Функция, выполняющаяся в отдельном потоке: просматривает каталог при каждом изменении и передает в очередь
+        загрузки дни, все файлы которых пришли полностью. Дни передаются по порядку: на первом дне, файлы которого
+        пришли не все или загрузка которого завершилась ошибкой, просмотр останавливается до следующего изменения
+        """
+        try:
+            while not self.stopping.is_set():
+                days = self.scan()
+                # День, файлы которого после ошибки удалены из каталога, больше не задерживает следующие дни
+                with self.lock:
+                    present = {day[0] for day in days}
+                    self.failed = {key: value for key, value in self.failed.items() if key in present}
+                for business_date, files, signature, arrived in days:
+                    with self.lock:
+                        if self.failed.get(business_date) == signature:
+                            break
+                        if self.queued.get(business_date) == signature:
+                            continue
+                    if arrived is None:
+                        break
+                    with self.lock:
+                        self.queued[business_date] = signature
+                    if not self.put((business_date, files, signature, arrived)):
+                        return
+                self.wait()
+        except Exception as e:
+            print(f'''При выполнении функции "watch" возникла ошибка {e}''')
+            self.stop()
+
+    def stop(self, signum=None, frame=None):
+        """
+        Функция, останавливающая наблюдение. Используется и как обработчик сигналов SIGTERM и SIGINT:
+        загружаемый день дообрабатывается, а дни, ожидающие в очереди, будут загружены при следующем запуске
+        """
+        if signum is not None and not self.stopping.is_set():
+            print(f"Получен сигнал {signal.Signals(signum).name}, загрузка будет остановлена после текущего дня")
+        self.stopping.set()
+
+    def run(self, context, metrics_dir="metrics"):
+        """
+        Функция, загружающая дни из очереди по мере их прихода в каталог через пул соединений контекста context,
+        пока не получен сигнал остановки. После каждого дня дописывает метрики дня в каталог metrics_dir, в том числе
+        время от прихода последнего файла дня до построения отчета (этап watch.latency), и удаляет их из памяти
+        """
+        handlers = {signum: signal.signal(signum, self.stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+        producer = threading.Thread(target=self.watch, name="folder-watcher", daemon=True)
+        producer.start()
+        print(f"Ожидание файлов в каталоге {self.directory} ({'inotify' if self.inotify else 'опрос'})")
+        try:
+            while not self.stopping.is_set():
+                try:
+                    business_date, files, signature, arrived = self.queue.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    continue
+
+                # День, попавший в очередь до ошибки загрузки одного из предыдущих дней, откладываем: он будет
+                # передан в очередь повторно после того, как предыдущий день будет загружен
+                with self.lock:
+                    blocked = any(failed_date < business_date for failed_date in self.failed)
+                    if blocked:
+                        del self.queued[business_date]
+                if blocked:
+                    continue
+
+                # Вызываем функцию, последовательно выполняющую все этапы загрузки дня
+                if pipeline.process_day(context, business_date, files):
+                    context.metrics.add_stage("watch.latency", business_date, time.monotonic() - arrived, len(files))
+                    with self.lock:
+                        self.failed.pop(business_date, None)
+                else:
+                    with self.lock:
+                        self.failed[business_date] = signature
+                context.metrics.write(metrics_dir, clear=True)
+        finally:
+            self.stop()
+            producer.join()
+            if self.inotify is not None:
+                self.inotify.close()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
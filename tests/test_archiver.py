@@ -0,0 +1,79 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from py_scripts import archiver
+
+def test_archive_file(tmp_path):
+    """
+    Файл сжимается, сверяется с исходным и только после этого удаляется, а в журнал архива записывается его копия
+    """
+    source = tmp_path / "transactions_01032021.txt"
+    content = b"transaction_id;transaction_date\n" * 5000
+    source.write_bytes(content)
+    directory = tmp_path / "archive"
+
+    record = archiver.archive_file(str(source), str(directory), chunksize=1000)
+    assert not source.exists()
+    assert record["filename"] == source.name and record["size"] == len(content)
+    assert record["archive"] == f"{record['sha256'][:16]}_{source.name}.gz"
+    with gzip.open(directory / record["archive"], "rb") as f:
+        assert f.read() == content
+    with open(directory / archiver.MANIFEST_NAME, encoding="utf-8") as f:
+        assert [json.loads(line) for line in f] == [record]
+    # Временные файлы сжатия не остаются в архиве
+    assert sorted(os.listdir(directory)) == sorted([record["archive"], archiver.MANIFEST_NAME])
+
+def test_archive_file_keeps_previous_version(tmp_path):
+    """
+    Повторно присланный файл с другим содержимым не перезаписывает архив предыдущего
+    """
+    source = tmp_path / "terminals_01032021.xlsx"
+    directory = tmp_path / "archive"
+    source.write_bytes(b"first")
+    first = archiver.archive_file(str(source), str(directory))
+    source.write_bytes(b"second")
+    second = archiver.archive_file(str(source), str(directory))
+    assert first["archive"] != second["archive"]
+    for record, content in ((first, b"first"), (second, b"second")):
+        with gzip.open(directory / record["archive"], "rb") as f:
+            assert f.read() == content
+
+def test_archive_file_verification_failure(tmp_path, monkeypatch):
+    """
+    Если сжатая копия не совпадает с исходным файлом, файл остается на месте, а копия удаляется
+    """
+    source = tmp_path / "transactions_01032021.txt"
+    source.write_bytes(b"content")
+    directory = tmp_path / "archive"
+    monkeypatch.setattr(archiver.gzip, "open", lambda *args, **kwargs: gzip.GzipFile(fileobj=open(os.devnull, "rb")))
+    with pytest.raises(ValueError):
+        archiver.archive_file(str(source), str(directory))
+    assert source.read_bytes() == b"content"
+    assert os.listdir(directory) == []
+
+def test_archived_files(tmp_path):
+    """
+    Находятся сжатые копии и файлы .backup прежних версий, за дату берется копия, заархивированная последней
+    """
+    for filename, mtime in [("0123456789abcdef_terminals_02032021.xlsx.gz", 1),
+                            ("fedcba9876543210_terminals_02032021.xlsx.gz", 2),
+                            ("terminals_01032021.xlsx.backup", 1),
+                            ("0123456789abcdef_transactions_01032021.txt.gz", 1),
+                            (archiver.MANIFEST_NAME, 1)]:
+        (tmp_path / filename).write_bytes(b"")
+        os.utime(tmp_path / filename, (mtime, mtime))
+    files = archiver.archived_files("terminals", str(tmp_path))
+    assert [(business_date.isoformat(), os.path.basename(path)) for business_date, path in files] == [
+        ("2021-03-01", "terminals_01032021.xlsx.backup"),
+        ("2021-03-02", "fedcba9876543210_terminals_02032021.xlsx.gz")
+    ]
+    assert archiver.archived_files("terminals", str(tmp_path / "missing")) == []
+
+def test_read_archived(tmp_path):
+    source = tmp_path / "terminals_01032021.xlsx"
+    source.write_bytes(b"snapshot")
+    record = archiver.archive_file(str(source), str(tmp_path))
+    assert archiver.read_archived(str(tmp_path / record["archive"])).read() == b"snapshot"
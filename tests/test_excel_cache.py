@@ -0,0 +1,67 @@
+import os
+
+import pandas as pd
+from openpyxl import Workbook
+
+from py_scripts import excel_cache
+
+def create_workbook(filepath, sheet_name, rows):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = sheet_name
+    for row in rows:
+        sheet.append(row)
+    workbook.save(filepath)
+
+def test_stream_sheet(tmp_path):
+    """
+    Первая строка листа - заголовок, пустые строки в конце листа удаляются
+    """
+    filepath = tmp_path / "terminals_01032021.xlsx"
+    create_workbook(filepath, "terminals", [("terminal_id", "terminal_city"), ("A1", "Москва"), ("A2", "Тула"),
+                                            (None, None)])
+    df = excel_cache.stream_sheet(filepath, "terminals")
+    assert df.to_dict("list") == {"terminal_id": ["A1", "A2"], "terminal_city": ["Москва", "Тула"]}
+
+def test_read_sheet_cache(tmp_path, monkeypatch):
+    """
+    Повторное чтение файла с той же контрольной суммой берет разбор из кэша, не разбирая Excel
+    """
+    filepath = tmp_path / "terminals_01032021.xlsx"
+    create_workbook(filepath, "terminals", [("terminal_id",), ("A1",)])
+    cache_dir = tmp_path / "cache"
+    df = excel_cache.read_sheet(str(filepath), "terminals", "abc", str(cache_dir))
+    assert (cache_dir / f"abc_terminals.v{excel_cache.CACHE_FORMAT}.pkl").exists()
+
+    def fail(*args):
+        raise AssertionError("лист разобран повторно")
+    monkeypatch.setattr(excel_cache, "stream_sheet", fail)
+    pd.testing.assert_frame_equal(excel_cache.read_sheet(str(filepath), "terminals", "abc", str(cache_dir)), df)
+
+def test_read_sheet_corrupted_cache(tmp_path):
+    """
+    Поврежденный кэш не прерывает загрузку: лист разбирается заново, и кэш заменяется
+    """
+    filepath = tmp_path / "terminals_01032021.xlsx"
+    create_workbook(filepath, "terminals", [("terminal_id",), ("A1",)])
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    cache_path = cache_dir / f"abc_terminals.v{excel_cache.CACHE_FORMAT}.pkl"
+    cache_path.write_bytes(b"not a pickle")
+    df = excel_cache.read_sheet(str(filepath), "terminals", "abc", str(cache_dir))
+    assert df["terminal_id"].tolist() == ["A1"]
+    pd.testing.assert_frame_equal(pd.read_pickle(cache_path), df)
+
+def test_prune_cache(tmp_path):
+    """
+    В кэше остаются keep последних использованных разборов листа, разборы прежних версий формата удаляются,
+    а разборы других листов не затрагиваются
+    """
+    current = f"terminals.v{excel_cache.CACHE_FORMAT}.pkl"
+    names = [f"a_{current}", f"b_{current}", f"c_{current}", "d_terminals.pkl",
+             f"e_blacklist.v{excel_cache.CACHE_FORMAT}.pkl"]
+    for mtime, name in enumerate(names):
+        (tmp_path / name).write_bytes(b"")
+        os.utime(tmp_path / name, (mtime, mtime))
+    excel_cache.prune_cache(str(tmp_path), "terminals", keep=2)
+    assert sorted(os.listdir(tmp_path)) == [f"b_{current}", f"c_{current}", names[4]]
@@ -0,0 +1,44 @@
+from py_scripts import execute_sql_scripts
+
+def test_split_statements():
+    """
+    Скрипт разбивается по ";" вне строковых литералов, комментарии удаляются
+    """
+    script = """
+        /* таблица
+           карт */
+        create table cards(card_num varchar(128)); -- комментарий; с точкой с запятой
+        insert into cards (card_num) values ('a;b');
+        insert into cards (card_num) values ('it''s; /* not */ -- a comment');
+    """
+    assert execute_sql_scripts.split_statements(script) == [
+        "create table cards(card_num varchar(128))",
+        "insert into cards (card_num) values ('a;b')",
+        "insert into cards (card_num) values ('it''s; /* not */ -- a comment')"
+    ]
+
+def test_split_statements_without_trailing_semicolon():
+    """
+    Последняя команда без ";" не теряется, пустые команды пропускаются
+    """
+    assert execute_sql_scripts.split_statements("select 1;;\nselect 2") == ["select 1", "select 2"]
+
+def test_parse_values():
+    """
+    Строковые литералы освобождаются от кавычек, null заменяется на None, остальные значения сохраняются как есть
+    """
+    values = "'2714 8073 9433 4375', \t'O''Brien', null, 42, '', NULL"
+    assert execute_sql_scripts.parse_values(values) == ["2714 8073 9433 4375", "O'Brien", None, "42", "", None]
+
+def test_parse_sql_scripts():
+    """
+    Таблицы скрипта переименовываются в таблицы DWH, строки insert группируются по таблице и полям
+    """
+    script = """
+        create table if not exists cards(card_num varchar(128), account varchar(128));
+        insert into cards (card_num, account) values ('1', 'a');
+        insert into cards (card_num, account) values ('2', null);
+    """
+    ddl, rows = execute_sql_scripts.parse_sql_scripts(script)
+    assert ddl == ["create table if not exists dwh_dim_cards(card_num varchar(128), account varchar(128))"]
+    assert rows == {("dwh_dim_cards", ("card_num", "account")): [["1", "a"], ["2", None]]}
@@ -0,0 +1,122 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from py_scripts import fraud_engine, fraud_rules
+
+BITS = {rule["name"]: 1 << rule["bit"] for rule in fraud_rules.RULES}
+
+def random_transactions(seed, size=900, cards=6):
+    """
+    Функция, генерирующая случайные транзакции нескольких карт с частыми операциями, сменой городов,
+    убывающими суммами и отклонениями, чтобы срабатывали все правила
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2021-03-01")
+    card = rng.integers(0, cards, size)
+    trans_date = start + pd.to_timedelta(rng.integers(0, 30 * 60, size) // 3 * 3, unit="min")
+    passport = [f"p{c}" for c in card]
+    return pd.DataFrame({
+        "trans_id": [f"t{i:05d}" for i in range(size)],
+        "trans_date": trans_date,
+        "card_num": [f"card{c}" for c in card],
+        "oper_type": rng.choice(["PAYMENT", "WITHDRAW", "DEPOSIT"], size, p=[0.6, 0.3, 0.1]),
+        "amt": rng.choice([100.0, 200.0, 300.0, 400.0], size),
+        "oper_result": rng.choice(["SUCCESS", "REJECT"], size),
+        "terminal_city": rng.choice(["Москва", "Тула", "Омск"], size, p=[0.9, 0.05, 0.05]),
+        "scored": True,
+        "passport_num": passport,
+        "passport_valid_to": [start + timedelta(days=int(c % 4)) for c in card],
+        "valid_to": [start + timedelta(days=int(c % 3)) for c in card],
+        "fio": [f"Клиент {c}" for c in card]
+    })
+
+def reference_score(df, blacklist):
+    """
+    Функция, построчно вычисляющая признак fraud_type по определению правил: для каждой операции перебираются
+    операции ее карты
+    """
+    df = df.sort_values(["card_num", "trans_date", "trans_id"], kind="stable").reset_index(drop=True)
+    rows = df.to_dict("records")
+    cards = {}
+    for row in rows:
+        cards.setdefault(row["card_num"], []).append(row)
+    fraud_types = []
+    for i, row in enumerate(rows):
+        t = row["trans_date"]
+        card = cards[row["card_num"]]
+        fraud_type = 0
+
+        entry_dt = blacklist.get(row["passport_num"])
+        if t.normalize() > row["passport_valid_to"] or (row["passport_num"] in blacklist and not entry_dt > t):
+            fraud_type |= BITS["passport"]
+        if t.normalize() > row["valid_to"]:
+            fraud_type |= BITS["contract"]
+
+        # Окно [t - 1 час, t] включает операции карты, совершенные в то же время, что и текущая
+        window = {other["terminal_city"] for other in card if t - timedelta(hours=1) <= other["trans_date"] <= t}
+        if len(window) > 1:
+            fraud_type |= BITS["multi_city"]
+
+        if i >= 2 and rows[i - 2]["card_num"] == row["card_num"]:
+            first, second = rows[i - 2], rows[i - 1]
+            if (first["amt"] > second["amt"] > row["amt"]
+                    and t - first["trans_date"] <= timedelta(minutes=20)
+                    and first["oper_result"] == second["oper_result"] == "REJECT"
+                    and row["oper_result"] == "SUCCESS"
+                    and "DEPOSIT" not in (first["oper_type"], second["oper_type"], row["oper_type"])):
+                fraud_type |= BITS["amount_guessing"]
+        fraud_types.append(fraud_type)
+    return fraud_types
+
+@pytest.mark.parametrize("seed", range(5))
+def test_score_matches_reference(seed):
+    """
+    Векторная оценка совпадает с построчной на случайных данных
+    """
+    df = random_transactions(seed)
+    blacklist = {"p1": pd.Timestamp("2021-03-02 12:00"), "p2": pd.Timestamp("2020-01-01")}
+    scored = fraud_engine.score(df.copy(), blacklist)
+    assert scored["fraud_type"].tolist() == reference_score(df, blacklist)
+    # Данные подобраны так, что каждое правило срабатывает
+    for bit in BITS.values():
+        assert ((scored["fraud_type"] & bit) != 0).any()
+
+def test_score_reports_all_flags():
+    """
+    Операция, выполняющая несколько правил, получает биты всех правил и их расшифровки в порядке битов
+    """
+    df = pd.DataFrame({
+        "trans_id": ["1", "2", "3"],
+        "trans_date": pd.to_datetime(["2021-03-01 10:00", "2021-03-01 10:05", "2021-03-01 10:10"]),
+        "card_num": ["c"] * 3,
+        "oper_type": ["PAYMENT"] * 3,
+        "amt": [300.0, 200.0, 100.0],
+        "oper_result": ["REJECT", "REJECT", "SUCCESS"],
+        "terminal_city": ["Москва", "Москва", "Тула"],
+        "scored": [True] * 3,
+        "passport_num": ["p"] * 3,
+        "passport_valid_to": pd.to_datetime(["2020-01-01"] * 3),
+        "valid_to": pd.to_datetime(["2030-01-01"] * 3),
+        "fio": ["Клиент"] * 3
+    })
+    scored = fraud_engine.score(df)
+    assert scored["fraud_type"].tolist() == [
+        BITS["passport"],
+        BITS["passport"],
+        BITS["passport"] | BITS["multi_city"] | BITS["amount_guessing"]
+    ]
+    assert fraud_engine.report_rows(scored)["event_type"].iloc[-1] == ", ".join([
+        fraud_rules.get_rule("passport")["label"],
+        fraud_rules.get_rule("multi_city")["label"],
+        fraud_rules.get_rule("amount_guessing")["label"]
+    ])
+
+def test_score_empty():
+    """
+    Пустой набор транзакций оценивается без ошибок
+    """
+    df = random_transactions(0).iloc[:0]
+    assert fraud_engine.score(df)["fraud_type"].empty
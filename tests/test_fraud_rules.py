@@ -0,0 +1,70 @@
+from datetime import timedelta
+
+from py_scripts import fraud_rules
+
+def test_rule_bits_are_unique():
+    bits = [rule["bit"] for rule in fraud_rules.RULES]
+    assert len(set(bits)) == len(bits)
+    assert len({rule["name"] for rule in fraud_rules.RULES}) == len(fraud_rules.RULES)
+
+def test_interval_and_history():
+    """
+    Глубина истории - наибольшая глубина правил реестра
+    """
+    assert fraud_rules.interval(timedelta(minutes=20)) == "INTERVAL '1200 seconds'"
+    assert fraud_rules.history() == fraud_rules.interval(max(rule["lookback"] for rule in fraud_rules.RULES))
+    assert fraud_rules.history() == "INTERVAL '3600 seconds'"
+
+def test_labels_in_bit_order():
+    labels = fraud_rules.labels()
+    assert [bit for bit, _ in labels] == sorted(rule["bit"] for rule in fraud_rules.RULES)
+    assert dict(labels)[fraud_rules.get_rule("multi_city")["bit"]] == fraud_rules.get_rule("multi_city")["label"]
+
+def test_compile_windows():
+    """
+    Раздел WINDOW содержит общее окно карты и окна правил с подставленной глубиной истории
+    """
+    windows = fraud_rules.compile_windows()
+    assert windows.startswith("WINDOW card AS (" + fraud_rules.CARD_WINDOW + ")")
+    assert "card_hour AS (card RANGE BETWEEN INTERVAL '3600 seconds' PRECEDING AND CURRENT ROW)" in windows
+    assert "{lookback}" not in windows
+
+def test_compile_fraud_type():
+    """
+    Признак - побитовое ИЛИ выражений всех правил, каждое дает свой бит, глубина истории подставлена
+    """
+    expression = fraud_rules.compile_fraud_type()
+    assert expression.count("CASE WHEN") == len(fraud_rules.RULES)
+    for rule in fraud_rules.RULES:
+        assert f"THEN {1 << rule['bit']} ELSE 0 END" in expression
+    assert "{lookback}" not in expression
+    assert "INTERVAL '1200 seconds'" in expression
+
+def test_compile_event_type():
+    """
+    Расшифровка перечисляет расшифровки выполненных правил в порядке битов
+    """
+    expression = fraud_rules.compile_event_type()
+    assert expression.startswith("CONCAT_WS(', ',")
+    positions = [expression.index(f"(fraud_type & {1 << bit}) != 0 THEN '{label}'")
+                 for bit, label in fraud_rules.labels()]
+    assert positions == sorted(positions)
+
+def test_added_rule_is_compiled(monkeypatch):
+    """
+    Правило, добавленное в реестр, попадает во все части запроса без изменения кода
+    """
+    rule = {
+        "name": "night",
+        "bit": 4,
+        "label": "ночная операция",
+        "lookback": timedelta(hours=2),
+        "windows": {"card_night": "card RANGE BETWEEN {lookback} PRECEDING AND CURRENT ROW"},
+        "predicate": "COUNT(*) OVER card_night > 3"
+    }
+    monkeypatch.setattr(fraud_rules, "RULES", fraud_rules.RULES + [rule])
+    assert fraud_rules.history() == "INTERVAL '7200 seconds'"
+    assert "card_night AS (card RANGE BETWEEN INTERVAL '7200 seconds' PRECEDING AND CURRENT ROW)" \
+        in fraud_rules.compile_windows()
+    assert "THEN 16 ELSE 0 END" in fraud_rules.compile_fraud_type()
+    assert "(fraud_type & 16) != 0 THEN 'ночная операция'" in fraud_rules.compile_event_type()
@@ -0,0 +1,51 @@
+from datetime import date
+
+from py_scripts import manifest
+
+def test_discover_days(tmp_path):
+    """
+    Файлы группируются по бизнес-дате из имени файла в порядке дат, посторонние файлы пропускаются
+    """
+    for filename in ["transactions_02032021.txt", "terminals_01032021.xlsx", "passport_blacklist_01032021.xlsx",
+                     "transactions_01032021.txt", "transactions_01032021.txt.backup", "terminals_1032021.xlsx",
+                     "readme.txt"]:
+        (tmp_path / filename).write_text("")
+    days = manifest.discover_days(str(tmp_path))
+    assert [business_date for business_date, _ in days] == [date(2021, 3, 1), date(2021, 3, 2)]
+    assert days[0][1] == {
+        "terminals": str(tmp_path / "terminals_01032021.xlsx"),
+        "passport_blacklist": str(tmp_path / "passport_blacklist_01032021.xlsx"),
+        "transactions": str(tmp_path / "transactions_01032021.txt")
+    }
+    assert days[1][1] == {"transactions": str(tmp_path / "transactions_02032021.txt")}
+
+def test_discover_days_empty(tmp_path):
+    assert manifest.discover_days(str(tmp_path)) == []
+
+def test_needs():
+    """
+    Этап нужно выполнять, если файл не обрабатывался или достиг только одного из предыдущих этапов
+    """
+    assert manifest.needs("transactions", None, "staged")
+    assert manifest.needs("transactions", "staged", "loaded")
+    assert manifest.needs("transactions", "staged", "reported")
+    assert not manifest.needs("transactions", "loaded", "loaded")
+    assert not manifest.needs("transactions", "reported", "loaded")
+    assert manifest.needs("terminals", None, "merged")
+    assert not manifest.needs("terminals", "merged", "merged")
+
+def test_is_done():
+    assert manifest.is_done("transactions", "reported")
+    assert not manifest.is_done("transactions", "loaded")
+    assert manifest.is_done("passport_blacklist", "merged")
+
+def test_file_checksum(tmp_path):
+    """
+    Контрольная сумма не зависит от размера порции чтения и меняется вместе с содержимым файла
+    """
+    filepath = tmp_path / "transactions_01032021.txt"
+    filepath.write_bytes(b"transaction_id;transaction_date\n" * 1000)
+    checksum = manifest.file_checksum(str(filepath))
+    assert manifest.file_checksum(str(filepath), chunksize=7) == checksum
+    filepath.write_bytes(b"transaction_id;transaction_date\n" * 999)
+    assert manifest.file_checksum(str(filepath)) != checksum
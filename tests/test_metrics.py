@@ -0,0 +1,50 @@
+import json
+from datetime import date
+
+from py_scripts.metrics import Metrics
+
+def day_stage(metrics, name, business_date, rows):
+    """
+    Функция, записывающая в метрики metrics этап name дня business_date с одной командой sql
+    """
+    with metrics.stage(name, business_date) as record:
+        metrics.statement("SELECT 1", 0.5, rows)
+        record["rows"] = rows
+
+def test_statements_are_aggregated():
+    """
+    Повторные выполнения команды в одном этапе суммируются в одну запись
+    """
+    metrics = Metrics()
+    with metrics.stage("stream.scored") as record:
+        for _ in range(1000):
+            metrics.statement("INSERT  INTO t\n VALUES (1)", 0.01, 1)
+        record["rows"] = 1000
+    assert len(metrics.statements) == 1
+    statement = next(iter(metrics.statements.values()))
+    assert statement["statement"] == "INSERT INTO t VALUES (1)"
+    assert (statement["calls"], statement["rowcount"], statement["seconds"]) == (1000, 1000, 10.0)
+
+def test_write_clear(tmp_path):
+    """
+    После записи с удалением метрики не остаются в памяти, а следующие записи дописываются к файлам дней и итогам
+    """
+    metrics = Metrics()
+    day_stage(metrics, "transactions.loaded", date(2021, 3, 1), 10)
+    run_dir = metrics.write(tmp_path, clear=True)
+    assert metrics.stages == [] and metrics.statements == {}
+
+    day_stage(metrics, "transactions.loaded", date(2021, 3, 1), 5)
+    day_stage(metrics, "transactions.loaded", date(2021, 3, 2), 7)
+    metrics.write(tmp_path, clear=True)
+
+    with open(run_dir / "day_2021-03-01.json", encoding="utf-8") as f:
+        day = json.load(f)
+    assert [stage["rows"] for stage in day["stages"]] == [10, 5]
+    assert day["totals"]["transactions.loaded"]["rows"] == 15
+    assert [(statement["calls"], statement["rowcount"]) for statement in day["statements"]] == [(2, 15)]
+
+    with open(run_dir / "run.json", encoding="utf-8") as f:
+        run = json.load(f)
+    assert run["totals"]["transactions.loaded"]["rows"] == 22
+    assert run["stages"] == []
@@ -0,0 +1,48 @@
+import pandas as pd
+
+from py_scripts import scd2
+
+def test_scd2_delta_terminals():
+    """
+    Срез сравнивается с действующими версиями: новые, удаленные и измененные записи получают тип изменения,
+    неизмененные записи в изменения не попадают
+    """
+    config = scd2.DIMENSIONS["terminals"]
+    snapshot = pd.DataFrame({
+        "terminal_id": ["A1", "A2", "A4"],
+        "terminal_type": ["POS", "ATM", "POS"],
+        "terminal_city": ["Москва", "Тула", "Омск"],
+        "terminal_address": ["ул. Ленина, 1", "ул. Мира, 2", "ул. Лесная, 4"]
+    })
+    current = pd.DataFrame({
+        "terminal_id": ["A1", "A2", "A3"],
+        "terminal_type": ["POS", "ATM", "ATM"],
+        "terminal_city": ["Москва", "Рязань", "Омск"],
+        "terminal_address": ["ул. Ленина, 1", "ул. Мира, 2", "ул. Садовая, 3"]
+    })
+    delta = scd2.scd2_delta(config, snapshot, current).set_index("terminal_id")
+    assert delta["change_type"].sort_index().to_dict() == {"A2": "U", "A3": "D", "A4": "N"}
+    assert delta.loc["A2", "terminal_city"] == "Тула"
+    # Удаленная запись сохраняет атрибуты последней действующей версии
+    assert delta.loc["A3", "terminal_address"] == "ул. Садовая, 3"
+
+def test_scd2_delta_untracked_columns():
+    """
+    Изменение неотслеживаемых атрибутов не порождает новую версию
+    """
+    config = scd2.DIMENSIONS["passports"]
+    snapshot = pd.DataFrame({"passport_num": ["1", "3"], "entry_dt": pd.to_datetime(["2021-03-02", "2021-03-02"])})
+    current = pd.DataFrame({"passport_num": ["1", "2"], "entry_dt": pd.to_datetime(["2021-03-01", "2021-03-01"])})
+    delta = scd2.scd2_delta(config, snapshot, current)
+    assert dict(zip(delta["passport_num"], delta["change_type"])) == {"2": "D", "3": "N"}
+
+def test_scd2_delta_no_changes():
+    """
+    Срез, совпадающий с действующими версиями, не дает изменений, в том числе при разных типах ключа
+    """
+    config = scd2.DIMENSIONS["terminals"]
+    current = pd.DataFrame({
+        "terminal_id": ["1"], "terminal_type": ["POS"], "terminal_city": ["Москва"], "terminal_address": ["ул. Ленина"]
+    })
+    snapshot = current.assign(terminal_id=[1])
+    assert scd2.scd2_delta(config, snapshot, current).empty
@@ -0,0 +1,117 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from py_scripts import fraud_rules
+from py_scripts.stream_scorer import CardState, StreamScorer, amount_guessing, multi_city
+
+START = datetime(2021, 3, 1, 10, 0)
+
+def test_multi_city():
+    """
+    Операция в другом городе в течение часа после предыдущей выполняет правило, как и следующие за ней операции,
+    пока с последней операции в другом городе не прошло больше часа
+    """
+    state = CardState()
+    assert not multi_city(state, START, "Москва")
+    assert not multi_city(state, START + timedelta(minutes=30), "Москва")
+    assert multi_city(state, START + timedelta(minutes=50), "Тула")
+    assert multi_city(state, START + timedelta(minutes=80), "Тула")
+    assert not multi_city(state, START + timedelta(minutes=160), "Тула")
+    assert not multi_city(state, START + timedelta(minutes=300), "Омск")
+
+def test_multi_city_unknown_terminal():
+    """
+    Операция на неизвестном терминале не выполняет правило и не меняет состояние карты
+    """
+    state = CardState()
+    multi_city(state, START, "Москва")
+    assert not multi_city(state, START + timedelta(minutes=5), None)
+    assert state.city == "Москва" and state.last_time == START
+
+def guess(state, minutes, amount, result, kind="PAYMENT"):
+    """
+    Функция, проверяющая правило подбора суммы для операции, совершенной через minutes минут после START
+    """
+    return amount_guessing(state, START + timedelta(minutes=minutes), amount, result, kind)
+
+def test_amount_guessing():
+    """
+    Три операции за 20 минут с убывающими суммами, отклонены все кроме последней, выполняют правило
+    """
+    state = CardState()
+    assert not guess(state, 0, 30000, "REJECT")
+    assert not guess(state, 5, 20000, "REJECT")
+    assert guess(state, 10, 10000, "SUCCESS")
+
+@pytest.mark.parametrize("steps", [
+    # Шаблон растянут дольше 20 минут
+    [(0, 30000, "REJECT"), (10, 20000, "REJECT"), (21, 10000, "SUCCESS")],
+    # Суммы не убывают
+    [(0, 30000, "REJECT"), (5, 30000, "REJECT"), (10, 10000, "SUCCESS")],
+    # Вторая операция не отклонена
+    [(0, 30000, "REJECT"), (5, 20000, "SUCCESS"), (10, 10000, "SUCCESS")],
+    # Последняя операция отклонена
+    [(0, 30000, "REJECT"), (5, 20000, "REJECT"), (10, 10000, "REJECT")]
+])
+def test_amount_guessing_not_matched(steps):
+    """
+    Операции, не подходящие под шаблон подбора суммы, правило не выполняют
+    """
+    state = CardState()
+    assert not any(guess(state, *step) for step in steps)
+
+def test_amount_guessing_deposit():
+    """
+    Пополнение в шаблоне подбора суммы не участвует
+    """
+    state = CardState()
+    guess(state, 0, 30000, "REJECT")
+    guess(state, 5, 20000, "REJECT", "DEPOSIT")
+    assert not guess(state, 10, 10000, "SUCCESS")
+
+def scorer():
+    """
+    Функция, создающая оценщик потока со справочником терминалов без обращения к базе данных
+    """
+    scorer = StreamScorer(None)
+    scorer.terminals = {"T1": "Москва", "T2": "Тула"}
+    scorer.terminals_loaded = time.monotonic()
+    return scorer
+
+def line(trans_id, minutes, amount, terminal, result="SUCCESS"):
+    """
+    Функция, формирующая строку файла транзакций для операции, совершенной через minutes минут после START
+    """
+    trans_date = START + timedelta(minutes=minutes)
+    return f"{trans_id};{trans_date:%Y-%m-%d %H:%M:%S};{amount};1111 2222 3333 4444;PAYMENT;{result};{terminal}\n"
+
+def test_score_reports_all_rules():
+    """
+    Операция, выполняющая оба правила потоковой оценки, попадает в пакет отчета с расшифровками обоих правил
+    """
+    stream = scorer()
+    stream.score("transaction_id;transaction_date;amount;card_num;oper_type;oper_result;terminal\n")
+    stream.score(line("1", 0, "300,00", "T1", "REJECT"))
+    stream.score(line("2", 5, "200,00", "T1", "REJECT"))
+    stream.score(line("3", 10, "100,00", "T2"))
+    assert stream.scored == 3
+    assert stream.alerts == [("3", START + timedelta(minutes=10), "1111222233334444", ", ".join([
+        fraud_rules.get_rule("multi_city")["label"],
+        fraud_rules.get_rule("amount_guessing")["label"]
+    ]))]
+
+def test_score_skips_bad_lines():
+    """
+    Строки, которые не удалось разобрать, и операции, пришедшие не по порядку времени, пропускаются
+    без остановки оценки и без ложных срабатываний
+    """
+    stream = scorer()
+    stream.score(line("1", 30, "10,00", "T1"))
+    stream.score("2;not a date;10,00;1111 2222 3333 4444;PAYMENT;SUCCESS;T1\n")
+    stream.score(line("3", 35, "ten", "T1"))
+    stream.score(line("4", 0, "10,00", "T2"))
+    stream.score(line("5", 40, "10,00", "T1"))
+    assert (stream.scored, stream.skipped) == (2, 3)
+    assert stream.alerts == []
@@ -0,0 +1,92 @@
+import pandas as pd
+import pytest
+
+from py_scripts import transactions
+
+AMOUNTS = [
+    ("1046,40", 104640),
+    ("1046.4", 104640),
+    ("10", 1000),
+    ("0,5", 50),
+    ("-25,10", -2510),
+    ("3.456", 346),
+    ("3.454", 345),
+    ("3,455", 346),
+    ("99,995", 10000),
+    ("-1,005", -101),
+    (" 7,01 ", 701)
+]
+
+@pytest.mark.parametrize("amount, expected", AMOUNTS)
+def test_kopecks(amount, expected):
+    """
+    Сумма разбирается в целое число копеек, лишние знаки дробной части округляются, половина - в большую сторону
+    """
+    assert transactions.kopecks(amount) == expected
+
+def test_parse_kopecks_matches_kopecks():
+    """
+    Векторный разбор сумм совпадает с построчным, пустые суммы становятся пропусками
+    """
+    amounts = pd.Series([amount for amount, _ in AMOUNTS] + [None])
+    parsed = transactions.parse_kopecks(amounts)
+    assert parsed.iloc[:-1].tolist() == [expected for _, expected in AMOUNTS]
+    assert parsed.isna().iloc[-1]
+
+def test_by_category():
+    """
+    Поле разбирается по уникальным значениям и раскладывается по строкам, пропуски сохраняются
+    """
+    values = pd.Series(["1,00", "2,50", "1,00", None], dtype="category")
+    parsed = transactions.by_category(values, transactions.parse_kopecks)
+    assert parsed.tolist() == [100, 250, 100, pd.NA]
+
+def test_by_category_empty():
+    """
+    Поле без значений разбирается в пропуски
+    """
+    parsed = transactions.by_category(pd.Series([None, None], dtype="category"), transactions.parse_kopecks)
+    assert parsed.isna().all()
+
+def test_partition_range():
+    """
+    Диапазон секции извлекается из описания, возвращаемого pg_get_expr, секция по умолчанию пропускается
+    """
+    bound = "FOR VALUES FROM ('2021-03-01 00:00:00') TO ('2021-04-01 00:00:00')"
+    assert transactions.partition_range(bound) == (pd.Timestamp("2021-03-01"), pd.Timestamp("2021-04-01"))
+    assert transactions.partition_range("DEFAULT") is None
+
+@pytest.mark.parametrize("start, partition_by, expected", [
+    ("2021-03-01", "day", ("dwh_fact_transactions_20210301", "2021-03-02")),
+    ("2021-12-31", "day", ("dwh_fact_transactions_20211231", "2022-01-01")),
+    ("2021-02-01", "month", ("dwh_fact_transactions_202102", "2021-03-01")),
+    ("2021-12-01", "month", ("dwh_fact_transactions_202112", "2022-01-01"))
+])
+def test_partition_bounds(start, partition_by, expected):
+    name, end = transactions.partition_bounds(pd.Timestamp(start), partition_by)
+    assert (name, end) == (expected[0], pd.Timestamp(expected[1]))
+
+class PartitionsCursor:
+    """
+    Курсор, возвращающий на запрос секций таблицы фактов заданные пары (имя, описание диапазона)
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+def test_fact_partitioning():
+    """
+    Режим секционирования определяется по существующим секциям, параметр запуска - только для таблицы без секций
+    """
+    day = [("dwh_fact_transactions_20210301", "FOR VALUES FROM ('2021-03-01 00:00:00') TO ('2021-03-02 00:00:00')")]
+    month = [("dwh_fact_transactions_202103", "FOR VALUES FROM ('2021-03-01 00:00:00') TO ('2021-04-01 00:00:00')")]
+    assert transactions.fact_partitioning(PartitionsCursor(day), "month") == "day"
+    assert transactions.fact_partitioning(PartitionsCursor(month), "day") == "month"
+    assert transactions.fact_partitioning(PartitionsCursor(month), None) == "month"
+    assert transactions.fact_partitioning(PartitionsCursor([]), "day") == "day"
+    assert transactions.fact_partitioning(PartitionsCursor([]), None) == "month"
@@ -0,0 +1,84 @@
+import os
+
+from py_scripts import watcher
+
+DAY_FILES = ["terminals_01032021.xlsx", "passport_blacklist_01032021.xlsx", "transactions_01032021.txt"]
+
+class Clock:
+    """
+    Часы, заменяющие time.monotonic: время меняется только вызовом tick
+    """
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def tick(self, seconds):
+        self.now += seconds
+
+def create_files(directory, filenames):
+    for filename in filenames:
+        (directory / filename).write_text("data")
+
+def scan(folder):
+    """
+    Функция, возвращающая моменты прихода дней, найденных при просмотре каталога: {дата: момент или None}
+    """
+    return {business_date.isoformat(): arrived for business_date, _, _, arrived in folder.scan()}
+
+def test_scan_settle(tmp_path, monkeypatch):
+    """
+    День готов к загрузке, когда пришли все его файлы и ни один не менялся settle секунд
+    """
+    clock = Clock()
+    monkeypatch.setattr(watcher.time, "monotonic", clock)
+    folder = watcher.FolderWatcher(str(tmp_path), settle=2.0)
+
+    create_files(tmp_path, DAY_FILES[:2])
+    assert scan(folder) == {"2021-03-01": None}
+    clock.tick(5)
+    # Пока пришли не все файлы дня, день не готов, сколько бы времени ни прошло
+    assert scan(folder) == {"2021-03-01": None}
+
+    create_files(tmp_path, DAY_FILES[2:])
+    assert scan(folder) == {"2021-03-01": None}
+    clock.tick(1)
+    assert scan(folder) == {"2021-03-01": None}
+    clock.tick(1)
+    assert scan(folder) == {"2021-03-01": 105.0}
+
+def test_scan_modified_file_resets_settle(tmp_path, monkeypatch):
+    """
+    Изменение файла дня откладывает готовность дня на settle секунд от изменения
+    """
+    clock = Clock()
+    monkeypatch.setattr(watcher.time, "monotonic", clock)
+    folder = watcher.FolderWatcher(str(tmp_path), settle=2.0)
+
+    create_files(tmp_path, DAY_FILES)
+    scan(folder)
+    clock.tick(1.5)
+    filepath = tmp_path / DAY_FILES[2]
+    filepath.write_text("data, appended")
+    os.utime(filepath, ns=(0, 1))
+    assert scan(folder) == {"2021-03-01": None}
+    clock.tick(1.5)
+    assert scan(folder) == {"2021-03-01": None}
+    clock.tick(0.5)
+    assert scan(folder) == {"2021-03-01": 101.5}
+
+def test_scan_days_in_order(tmp_path, monkeypatch):
+    """
+    Дни возвращаются по порядку дат, готовность каждого дня определяется по его файлам
+    """
+    clock = Clock()
+    monkeypatch.setattr(watcher.time, "monotonic", clock)
+    folder = watcher.FolderWatcher(str(tmp_path), settle=2.0)
+
+    create_files(tmp_path, [filename.replace("01032021", "02032021") for filename in DAY_FILES])
+    clock.tick(3)
+    create_files(tmp_path, DAY_FILES[:1])
+    scan(folder)
+    clock.tick(3)
+    assert scan(folder) == {"2021-03-01": None, "2021-03-02": 103.0}